@@ -21,20 +21,35 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import argparse
+import collections
+import hashlib
+import io
 import os
-import re
 import shutil
 import socket
+import stat
 import subprocess
 import sys
+import tarfile
 import tempfile
 
-from .utils import getch, native_to_unicode
+from multiprocessing.pool import ThreadPool
 
-try:
-    import cPickle as pickle
-except ImportError as _:
-    import pickle
+from . import trace
+from .bundle import COMPRESSIONS, BundleError, guess_compression, read_bundle, write_bundle
+from .capacity import choose_targets, free_space, space_needed
+from .fetch import FetchError, acquire_config, fetch_all, is_fetchable
+from .gc import collect_garbage, installed_archives, parse_queue_entry, parse_size, queue_entry_matches
+from .index import PackageIndex, update_index
+from .localrepo import update_local_repo
+from .plans import STEP_UNPACK, dpkg_commands, dpkg_hooks, load_plan, make_plan, plan_file, parse_apt_config, remove_plan, save_plan, stale_reason
+from .resolve import PlannedPackage, anonymize_target, hash_tree, missing_packages, pin_spec, resolve, resolve_key, split_archive_filename, uri_line
+from .serve import MediumServer, fetch_archives, fetch_plan, mirror_lists
+from .state import add_target, connect, dump_queues, has_target, merge_queues, pins_add, queue_add, queue_move, queue_pins, queue_remove, read_state, transaction
+from .sync import compare_manifests, copy_files, scan_medium
+from .packages import LIST_COMPRESSION_EXTS, is_compressible_list, referenced_lists, split_list_name
+from .utils import compress_file, copy_file, file_digest, getch, load_pickle, make_dirs, native_to_unicode, save_pickle
+from .verify import CORRUPT, UNKNOWN, record_verified, verify_archives
 
 try:
     from distutils.spawn import find_executable as find_exe
@@ -67,6 +82,7 @@ def parse_args(in_args):
     sub_parsers.required = True
     
     main_parser.add_argument('-m', '--install-medium', type=native_to_unicode, default=os.getcwd(), help='path to installation medium (defaults to current working directory)')
+    main_parser.add_argument('--trace', metavar='FILE', type=native_to_unicode, default=os.environ.get('APT_MEDIUM_TRACE'), help='record how long each step took (subprocesses, file syncs, state access, downloads) to FILE as JSON for a trace viewer such as chrome://tracing or Perfetto (defaults to $APT_MEDIUM_TRACE)')
     
     # Create a parser for the init command
     sub_parsers.add_parser('init', help='initialize or update the dpkg status and apt configuration for this system in the installation medium')
@@ -74,6 +90,7 @@ def parse_args(in_args):
     # Create a parser for the update command
     update_parser = sub_parsers.add_parser('update', help='retrieve new lists of packages (network connectivity required)')
     update_parser.add_argument('-t', '--target', metavar='hostname', type=native_to_unicode, help='the hostname of the system to update package lists for (default is all systems)')
+    update_parser.add_argument('-j', '--jobs', metavar='N', type=int, default=4, help='maximum number of package list updates to run at once (default 4)')
     
     # Create a parser for the upgrade command
     upgrade_parser = sub_parsers.add_parser('upgrade', help='update all currently installed packages to latest versions (based on current package lists, may need to use "update" first to achieve desired effect)')
@@ -92,6 +109,7 @@ def parse_args(in_args):
     install_parser.add_argument('-t', '--target', metavar='hostname', type=native_to_unicode, default=socket.gethostname(), help='the hostname of the target system to perform the install/upgrade on (defaults to the current system)')
     install_parser.add_argument('--force', action='store_true', help='force apt-get to proceed (--force-yes) even if a dangerous situation is detected')
     install_parser.add_argument('-f', '--fix-broken', action='store_true', help='Tell apt-get to attempt to resolve broken dependencies (not fully implemented yet, must manually copy resulting package list)')
+    install_parser.add_argument('--server', metavar='URL', type=native_to_unicode, help='apt-medium server (see "serve") to take package lists and missing packages from, e.g. http://host:8080')
     install_parser.add_argument('packages', type=native_to_unicode, nargs='*', help='package name(s) to be installed')
     
     # Create a parser for the download command
@@ -99,6 +117,46 @@ def parse_args(in_args):
     download_parser.add_argument('-t', '--target', metavar='hostname', type=native_to_unicode, help='the hostname of the system to complete pending downloads for (default is all systems)')
     download_parser.add_argument('--force', action='store_true', help='force apt-get to proceed (--force-yes) even if a dangerous situation is detected')
     download_parser.add_argument('--allow-unauthenticated', action='store_true', help='tell apt-get to proceed even if downloads cannot be authenticated')
+    download_parser.add_argument('-j', '--jobs', metavar='N', type=int, default=4, help='maximum number of concurrent downloads and dependency resolutions (default 4)')
+    download_parser.add_argument('--reserve', metavar='SIZE', type=native_to_unicode, default='128M', help='free space to leave on the installation medium (default 128M)')
+    download_parser.add_argument('-p', '--priority', metavar='hostname', type=native_to_unicode, action='append', default=[], help='complete downloads for this system first if space on the medium runs short (may be given more than once)')
+    
+    # Create a parser for the verify command
+    verify_parser = sub_parsers.add_parser('verify', help='check downloaded packages on the installation medium against their expected checksums')
+    verify_parser.add_argument('-j', '--jobs', metavar='N', type=int, help='number of files to hash at once (defaults to the number of CPUs)')
+    verify_parser.add_argument('--remove', action='store_true', help='delete packages that fail verification so they are downloaded again')
+    
+    # Create a parser for the prune-lists command
+    prune_lists_parser = sub_parsers.add_parser('prune-lists', help='move package lists that none of the targets\' sources use out of the lists directory')
+    prune_lists_parser.add_argument('--delete', action='store_true', help='delete unused lists instead of moving them to var/lib/apt-medium/lists-archive')
+    prune_lists_parser.add_argument('-n', '--dry-run', action='store_true', help='list the unused lists without moving or deleting them')
+    
+    # Create a parser for the gc command
+    gc_parser = sub_parsers.add_parser('gc', help='remove downloaded packages that no target has queued or installed')
+    gc_parser.add_argument('--max-size', metavar='SIZE', type=native_to_unicode, help='only remove as many packages (oldest first) as needed to bring the archives down to SIZE, e.g. 32G (default is to remove every unreferenced package)')
+    gc_parser.add_argument('-n', '--dry-run', action='store_true', help='list the packages that would be removed without removing them')
+    
+    # Create a parser for the serve command
+    serve_parser = sub_parsers.add_parser('serve', help='share the package lists and downloaded packages on the installation medium with other systems over HTTP')
+    serve_parser.add_argument('--bind', metavar='ADDRESS', type=native_to_unicode, default='0.0.0.0', help='address to listen on (default 0.0.0.0, every interface)')
+    serve_parser.add_argument('-p', '--port', type=int, default=8080, help='port to listen on (default 8080)')
+    serve_parser.add_argument('-q', '--quiet', action='store_true', help='don\'t log each request')
+    
+    # Create a parser for the sync command
+    sync_parser = sub_parsers.add_parser('sync', help='bring this installation medium and another copy of it in step, copying only files that are missing or changed on either side and merging their queues')
+    sync_parser.add_argument('other_medium', type=native_to_unicode, help='path to the other installation medium')
+    sync_parser.add_argument('--batch-size', metavar='SIZE', type=native_to_unicode, default='256M', help='amount of data to copy before flushing it to disk (default 256M)')
+    sync_parser.add_argument('-n', '--dry-run', action='store_true', help='list the files that would be copied without copying them')
+    
+    # Create a parser for the export command
+    export_parser = sub_parsers.add_parser('export', help='write the packages, package lists and system info one system\'s queues need to a tar bundle, e.g. to carry them on a smaller medium')
+    export_parser.add_argument('-t', '--target', metavar='hostname', type=native_to_unicode, default=socket.gethostname(), help='the hostname of the system to export (defaults to the current system)')
+    export_parser.add_argument('-o', '--output', metavar='FILE', type=native_to_unicode, default='-', help='file to write the bundle to (default is standard output)')
+    export_parser.add_argument('-z', '--compression', choices=COMPRESSIONS, help='compression to use (default is guessed from the output file name, none for standard output)')
+    
+    # Create a parser for the import command
+    import_parser = sub_parsers.add_parser('import', help='unpack a bundle made by "export" into the installation medium')
+    import_parser.add_argument('bundle', metavar='FILE', type=native_to_unicode, nargs='?', default='-', help='bundle to import (default is standard input)')
     
     # TODO: Create a parser for the show-queue command
     
@@ -107,6 +165,12 @@ def parse_args(in_args):
     args = main_parser.parse_args(in_args)
     args.action = native_to_unicode(args.action)
     args.install_medium = os.path.abspath(args.install_medium)
+    if args.trace:
+        args.trace = os.path.abspath(args.trace)
+    if args.action == 'export' and args.output != '-':
+        args.output = os.path.abspath(args.output)
+    if args.action == 'import' and args.bundle != '-':
+        args.bundle = os.path.abspath(args.bundle)
     
     if os.path.isdir(args.install_medium):
         os.chdir(args.install_medium)
@@ -124,6 +188,23 @@ def parse_args(in_args):
     return args
 
 def process_args(args):
+    if getattr(args, 'trace', None):
+        trace.start()
+    
+    with trace.span(args.action, 'action', install_medium=args.install_medium) as s:
+        retCode = run_action(args)
+        s.set(exit_code=retCode)
+    
+    # Cleanup temporary files
+    for f in tempfiles:
+        f.close()
+    
+    if getattr(args, 'trace', None):
+        trace.save(args.trace)
+    
+    return retCode
+
+def run_action(args):
     if args.action == 'init':
         retCode = init_action()
     elif args.action == 'update':
@@ -136,11 +217,20 @@ def process_args(args):
         retCode = install_action(args)
     elif args.action == 'download':
         retCode = download_action(args)
-    
-    # Cleanup temporary files
-    for f in tempfiles:
-        f.close()
-    
+    elif args.action == 'verify':
+        retCode = verify_action(args)
+    elif args.action == 'prune-lists':
+        retCode = prune_lists_action(args)
+    elif args.action == 'gc':
+        retCode = gc_action(args)
+    elif args.action == 'serve':
+        retCode = serve_action(args)
+    elif args.action == 'sync':
+        retCode = sync_action(args)
+    elif args.action == 'export':
+        retCode = export_action(args)
+    elif args.action == 'import':
+        retCode = import_action(args)
     return retCode
 
 def check_sysreqs():
@@ -158,41 +248,259 @@ def check_sysreqs():
     if not find_exe('dpkg'):
         raise Exception('Cannot find dpkg in PATH.')
 
-def sync_local_lists():
+def compress_lists(lists_dir):
+    # Replaces lists apt-get left uncompressed on the medium with gzipped copies (same timestamp)
+    # apt-get reads them just the same, and they take a fraction of the space and I/O
+    for f in sorted(os.listdir(lists_dir)):
+        path = os.path.join(lists_dir, f)
+        if not is_compressible_list(f) or not os.path.isfile(path):
+            continue
+        if os.path.exists(path + '.gz'):
+            os.unlink(path + '.gz')
+        compress_file(path, path + '.gz')
+        os.unlink(path)
+
+def remove_other_compressions(lists_dir, name, medium_lists):
+    # Drops copies of the same list stored with a different (or no) compression
+    base = split_list_name(name)[0]
+    for ext in ('',) + LIST_COMPRESSION_EXTS:
+        other = base + ext
+        if other != name and other in medium_lists:
+            os.unlink(os.path.join(lists_dir, other))
+            medium_lists.discard(other)
+
+def sync_local_lists(local_lists_dir='/var/lib/apt/lists'):
     medium_lists_dir = 'lists'
-    local_lists_dir = '/var/lib/apt/lists'
+    
+    # The manifest records size, mtime and hash of each local list as of the last time
+    # we wrote it to the medium, so unchanged lists can be skipped without touching the medium at all
+    manifest_file = medium_data_file('.', 'lists-manifest')
+    manifest = load_pickle(manifest_file, {})
+    changed = False
+    
+    # A single directory read tells us which lists exist on the medium
+    medium_lists = set(os.listdir(medium_lists_dir))
+    
     for f in os.listdir(local_lists_dir):
         src_file = os.path.join(local_lists_dir, f)
-        dst_file = os.path.join(medium_lists_dir, f)
         
-        if f == 'lock' or not os.path.isfile(src_file):
+        if f == 'lock':
+            continue
+        src_st = os.stat(src_file)
+        if not stat.S_ISREG(src_st.st_mode):
             continue
         
-        if not os.path.exists(dst_file) or os.path.getmtime(src_file) > os.path.getmtime(dst_file):
-            shutil.copy(src_file,dst_file)
+        # Lists are kept compressed on the medium
+        dst_name = f + '.gz' if is_compressible_list(f) else f
+        dst_file = os.path.join(medium_lists_dir, dst_name)
+        
+        entry = manifest.get(f) if dst_name in medium_lists else None
+        if entry is not None and src_st.st_mtime <= entry[1]:
+            continue
+        
+        if dst_name in medium_lists:
+            # The medium's copy may have been refreshed by "update" since the manifest was written
+            dst_st = os.stat(dst_file)
+            if src_st.st_mtime <= dst_st.st_mtime:
+                manifest[f] = (src_st.st_size, dst_st.st_mtime, None)
+                changed = True
+                continue
+        
+        digest = file_digest(src_file)
+        if entry is not None and entry[0] == src_st.st_size and entry[2] == digest:
+            # Only the timestamp moved on, no need to rewrite the data
+            os.utime(dst_file, (src_st.st_atime, src_st.st_mtime))
+        else:
+            if dst_name != f:
+                compress_file(src_file, dst_file)
+            else:
+                copy_file(src_file, dst_file)
+            medium_lists.add(dst_name)
+            remove_other_compressions(medium_lists_dir, dst_name, medium_lists)
+        manifest[f] = (src_st.st_size, src_st.st_mtime, digest)
+        changed = True
+    
+    if changed:
+        save_pickle(manifest_file, manifest)
     
+def file_signature(path):
+    # (size, mtime) of a file, None if it doesn't exist
+    try:
+        st = os.stat(path)
+    except OSError as _:
+        return None
+    return (st.st_size, st.st_mtime)
+
+def sync_file(src_file, dst_file, manifest, key):
+    # Brings dst_file up to date with src_file, manifest[key] records (size, mtime, hash) of src_file
+    # as last written. Returns whether the manifest changed.
+    src_st = os.stat(src_file)
+    entry = manifest.get(key)
+    if entry is not None and entry[:2] == (src_st.st_size, src_st.st_mtime) and os.path.isfile(dst_file):
+        return False
+    
+    digest = file_digest(src_file)
+    if entry is not None and entry[2] == digest and os.path.isfile(dst_file):
+        # Only the timestamp moved on, no need to rewrite the data
+        os.utime(dst_file, (src_st.st_atime, src_st.st_mtime))
+    else:
+        copy_file(src_file, dst_file)
+    manifest[key] = (src_st.st_size, src_st.st_mtime, digest)
+    return True
+
+def sync_tree(src_dir, dst_dir, manifest):
+    # Mirrors the files under src_dir (following symlinks, like copytree) into dst_dir, only writing
+    # those that changed and removing those that are gone. Returns whether the manifest changed.
+    changed = False
+    seen = set()
+    for dirpath, dirnames, filenames in os.walk(src_dir, followlinks=True):
+        rel_dir = os.path.relpath(dirpath, src_dir)
+        dst_subdir = os.path.normpath(os.path.join(dst_dir, rel_dir))
+        if not os.path.isdir(dst_subdir):
+            os.makedirs(dst_subdir)
+        for name in filenames:
+            src_file = os.path.join(dirpath, name)
+            if not os.path.isfile(src_file):
+                # Dangling symlink or special file
+                continue
+            key = os.path.normpath(os.path.join(rel_dir, name))
+            seen.add(key)
+            if sync_file(src_file, os.path.join(dst_subdir, name), manifest, key):
+                changed = True
+    
+    for key in list(manifest):
+        if key in seen:
+            continue
+        dst_file = os.path.join(dst_dir, key)
+        if os.path.isfile(dst_file):
+            os.unlink(dst_file)
+        # Take directories that are left empty along with it
+        parent = os.path.dirname(key)
+        while parent and not os.path.isdir(os.path.join(src_dir, parent)) and os.path.isdir(os.path.join(dst_dir, parent)) and not os.listdir(os.path.join(dst_dir, parent)):
+            os.rmdir(os.path.join(dst_dir, parent))
+            parent = os.path.dirname(parent)
+        del manifest[key]
+        changed = True
+    
+    return changed
+
 def load_medium_state():
     if not os.path.isfile('medium_state'):
         print('medium_state file not found on the installation medium (' + os.getcwd() + ')')
         print('Check you have specified the correct medium and that at least one system has been initialized on the medium')
         exit(-1)
-    state_file = open('medium_state', 'rb')
-    state = pickle.load(state_file)
-    state_file.close()
-    return state
+    return read_state('medium_state')
+
+def queue_packages(queue, target, packages, description, pins=()):
+    # Queue several packages for a target in a single transaction, along with the resolved versions (pins) they install
+    with transaction('medium_state') as conn:
+        added = queue_add(conn, queue, target, packages)
+        pins_add(conn, queue, target, pins)
+    for package in packages:
+        if package in added:
+            print('Queued ' + package + ' for ' + description)
+        else:
+            print(package + ' already queued for ' + description)
+
+def unqueue_packages(queue, target, packages):
+    with transaction('medium_state') as conn:
+        queue_remove(conn, queue, target, packages)
+
+def load_pins(queue, target):
+    conn = connect('medium_state')
+    try:
+        return [ PlannedPackage(*row) for row in queue_pins(conn, queue, target) ]
+    finally:
+        conn.close()
+
+def apt_mark(install_medium, target_apt_dir, env, args):
+    parms = ['apt-mark']
+    parms.append('--option')
+    parms.append('Dir=' + install_medium)
+    parms.append('--config-file')
+    parms.append(os.path.join(target_apt_dir, 'apt-medium.conf'))
+    parms.extend(args)
+    return trace.check_output(parms, env=env).decode('utf-8').splitlines()
+
+def medium_data_file(install_medium, name):
+    # apt-medium's own bookkeeping (manifests, caches) lives in var/lib/apt-medium on the medium
+    data_dir = os.path.join(install_medium, 'var', 'lib', 'apt-medium')
+    if not os.path.isdir(data_dir):
+        make_dirs(data_dir)
+    return os.path.join(data_dir, name)
+
+def load_package_index(install_medium):
+    # Opens the index of the Packages lists on the medium, first re-indexing any list that changed
+    index_dir = medium_data_file(install_medium, 'pkgindex')
+    update_index(os.path.join(install_medium, 'lists'), index_dir)
+    return PackageIndex(index_dir)
+
+def update_archive_index(install_medium):
+    # Keeps the flat repository index over archives/ in step with the packages on the medium
+    archives_dir = os.path.join(install_medium, 'archives')
+    checksums = load_pickle(medium_data_file(install_medium, 'archives-manifest'), {})
+    update_local_repo(archives_dir, medium_data_file(install_medium, 'local-repo'), checksums)
 
-def save_medium_state(state):
-    state_file = open('medium_state', 'wb')
-    pickle.dump(state, state_file, protocol=2)
-    state_file.close()
-    
 def validate_queues():
     raise NotImplementedError()
 
+def etc_fingerprint(target_apt_dir, target):
+    digest = hashlib.sha256()
+    hash_tree(digest, target_apt_dir, anonymize_target(target))
+    return digest.hexdigest()
+
+def list_references(install_medium, target):
+    # Names of every list file the target's sources can give rise to (as apt-get indextargets reports them),
+    # None if apt-get can't tell. Cached on the medium against the target's apt configuration.
+    target_apt_dir = os.path.join(install_medium, 'system_info', target, 'etc', 'apt')
+    key = etc_fingerprint(target_apt_dir, target)
+    cache_file = medium_data_file(install_medium, 'list-references')
+    cache = load_pickle(cache_file, {})
+    if key not in cache:
+        env = setup_config_redirect(dict(os.environ), target_apt_dir)
+        
+        parms = ['apt-get']
+        
+        # Set RootDir to installation medium location
+        parms.append('--option')
+        parms.append('Dir=' + install_medium)
+        
+        # Load target's apt-medium.conf file
+        parms.append('--config-file')
+        parms.append(os.path.join(target_apt_dir, 'apt-medium.conf'))
+        
+        parms.extend(['indextargets', '--no-release-info', '--format', '$(FILENAME)'])
+        
+        try:
+            output = trace.check_output(parms, env=env)
+        except (subprocess.CalledProcessError, OSError) as _:
+            return None
+        cache[key] = sorted(set(os.path.basename(line) for line in output.decode('utf-8').splitlines() if line.strip()))
+        save_pickle(cache_file, cache)
+    return cache[key]
+
+def target_lists(install_medium, target):
+    # The files in lists/ that make up the target's view of the package lists, None if unknown
+    names = list_references(install_medium, target)
+    if names is None:
+        return None
+    return referenced_lists(names, os.listdir(os.path.join(install_medium, 'lists')))
+
+def srcpkgcache_file(target_apt_dir):
+    # apt's source package cache only depends on the lists a target uses and its architectures,
+    # so targets with the same sources share one instead of each building their own after every update
+    cache_dir = medium_data_file('.', 'srcpkgcache')
+    if not os.path.isdir(cache_dir):
+        # Called from update's worker threads, which may all get here at once on a fresh medium
+        make_dirs(cache_dir)
+    return os.path.join(os.path.abspath(cache_dir), sources_fingerprint(target_apt_dir)[:32] + '.bin')
+
 def setup_config_redirect(env, config_location):
     redir_conf = tempfile.NamedTemporaryFile(mode='w')
     tempfiles.append(redir_conf)
-    redir_conf.write('Dir::Etc "' + config_location + '";')
+    redir_conf.write('Dir::Etc "' + config_location + '";\n')
+    redir_conf.write('Dir::Cache::srcpkgcache "' + srcpkgcache_file(config_location) + '";\n')
+    redir_conf.flush()
     env['APT_CONFIG'] = redir_conf.name
     return env
 
@@ -212,26 +520,35 @@ def init_action():
     var_dir = 'var'
     var_log_dir = os.path.join(var_dir, 'log')
     var_log_apt_dir = os.path.join(var_log_dir, 'apt')
+    var_lib_dir = os.path.join(var_dir, 'lib')
+    var_lib_am_dir = os.path.join(var_lib_dir, 'apt-medium')
     
     # Create directory structure
     for directory in [info_dir, system_dir, system_etc_dir,
                       lists_dir, lists_partial_dir, archives_dir,
-                      archives_partial_dir, var_dir, var_log_dir, var_log_apt_dir]:
+                      archives_partial_dir, var_dir, var_log_dir, var_log_apt_dir,
+                      var_lib_dir, var_lib_am_dir]:
         if not os.path.exists(directory):
             os.mkdir(directory)
     
-    if not os.path.exists('medium_state'):
-        state = {}
-        state['install_queue'] = {}
-        state['download_queue'] = {}
-        save_medium_state(state)
+    # Copy necessary information about the system, skipping anything that hasn't changed since the last init
+    manifest_file = medium_data_file('.', 'init-manifest')
+    manifests = load_pickle(manifest_file, {})
+    manifest = manifests.setdefault(hostname, {'files': {}})
+    changed = False
     
-    # Copy necessary information about the system
     system_apt_dir = os.path.join(system_etc_dir, 'apt')
-    shutil.copy('/var/lib/dpkg/status', os.path.join(system_dir, 'dpkg-status'))
-    if os.path.exists(system_apt_dir):
-        shutil.rmtree(system_apt_dir)
-    shutil.copytree('/etc/apt', system_apt_dir)
+    with trace.span('sync /var/lib/dpkg/status', 'sync'):
+        if sync_file('/var/lib/dpkg/status', os.path.join(system_dir, 'dpkg-status'), manifest['files'], 'dpkg-status'):
+            changed = True
+    if 'etc' not in manifest:
+        # Nothing is known about what's on the medium yet, start from a clean copy
+        if os.path.exists(system_apt_dir):
+            shutil.rmtree(system_apt_dir)
+        manifest['etc'] = {}
+    with trace.span('sync /etc/apt', 'sync'):
+        if sync_tree('/etc/apt', system_apt_dir, manifest['etc']):
+            changed = True
     
     # Create an empty apt.conf.d folder if one doesn't exist
     apt_conf_d_dir = os.path.join(system_apt_dir, 'apt.conf.d')
@@ -240,68 +557,167 @@ def init_action():
     
     # Create an empty apt.conf file if one doesn't exist
     apt_conf = os.path.join(system_apt_dir, 'apt.conf')
-    open(apt_conf, 'a').close()
+    if not os.path.exists(apt_conf):
+        open(apt_conf, 'a').close()
+    
+    # dpkg only reports different architectures after its own package or its arch file changed
+    arch_inputs = [ file_signature(path) for path in ['/var/lib/dpkg/status', '/var/lib/dpkg/arch'] ]
+    if manifest.get('arch_inputs') != arch_inputs:
+        manifest['archs'] = (trace.check_output(['dpkg', '--print-architecture']).splitlines()[0].decode('utf-8'),
+                             trace.check_output(['dpkg', '--print-foreign-architectures']).decode('utf-8').splitlines())
+        manifest['arch_inputs'] = arch_inputs
+        changed = True
+    arch, foreign_archs = manifest['archs']
     
     # Create a base configuration that loads apt.conf.d and apt.conf
-    apt_medium_conf = os.path.join(system_apt_dir, 'apt-medium.conf')
-    am_conf = open(apt_medium_conf, 'w')
+    am_conf = []
     
-    am_conf.write('APT\n')
-    am_conf.write('    {\n')
-    am_conf.write('    Architecture "' + subprocess.check_output(['dpkg', '--print-architecture']).splitlines()[0].decode('utf-8') + '";\n');
-    foreign_archs = subprocess.check_output(['dpkg', '--print-foreign-architectures']).decode('utf-8').splitlines()
+    am_conf.append('APT\n')
+    am_conf.append('    {\n')
+    am_conf.append('    Architecture "' + arch + '";\n');
     if len(foreign_archs) > 0:
-        am_conf.write('    Architectures {')
-        for arch in foreign_archs:
-            am_conf.write('"' + arch + '";')
-        am_conf.write('};\n')
+        am_conf.append('    Architectures {')
+        for foreign_arch in foreign_archs:
+            am_conf.append('"' + foreign_arch + '";')
+        am_conf.append('};\n')
     # keep all lists (i.e. those not in current sources.list file) on apt-medium for use by offline machines
-    am_conf.write('    Get::List-Cleanup "false";\n')
-    am_conf.write('    };\n')
-    
-    am_conf.write('Dir\n')
-    am_conf.write('    {\n')
-    am_conf.write('    State "./' + system_dir + '";\n')
-    am_conf.write('    State::status "dpkg-status";\n')
-    am_conf.write('    State::Lists "./' + lists_dir + '";\n')
-    am_conf.write('    Cache "./' + system_dir + '";\n')
-    am_conf.write('    Cache::archives "./' + archives_dir + '";\n')
-    am_conf.write('    Etc "./' + system_apt_dir + '";\n')
-    am_conf.write('    };\n')
+    am_conf.append('    Get::List-Cleanup "false";\n')
+    am_conf.append('    };\n')
+    
+    # keep lists compressed on the medium, preferring gzip which apt-medium can read without help
+    am_conf.append('Acquire\n')
+    am_conf.append('    {\n')
+    am_conf.append('    GzipIndexes "true";\n')
+    am_conf.append('    CompressionTypes::Order { "gz"; };\n')
+    am_conf.append('    };\n')
+    
+    am_conf.append('Dir\n')
+    am_conf.append('    {\n')
+    am_conf.append('    State "./' + system_dir + '";\n')
+    am_conf.append('    State::status "dpkg-status";\n')
+    am_conf.append('    State::Lists "./' + lists_dir + '";\n')
+    am_conf.append('    Cache "./' + system_dir + '";\n')
+    am_conf.append('    Cache::archives "./' + archives_dir + '";\n')
+    am_conf.append('    Etc "./' + system_apt_dir + '";\n')
+    am_conf.append('    };\n')
+    
+    # Only rewrite the configuration when it would actually change
+    apt_medium_conf = os.path.join(system_apt_dir, 'apt-medium.conf')
+    am_conf = ''.join(am_conf)
+    current_conf = None
+    if os.path.isfile(apt_medium_conf):
+        with io.open(apt_medium_conf, encoding='utf-8') as f:
+            current_conf = f.read()
+    if current_conf != am_conf:
+        with io.open(apt_medium_conf, 'w', encoding='utf-8') as f:
+            f.write(am_conf)
     
-    am_conf.close()
+    if changed:
+        save_pickle(manifest_file, manifests)
     
-    sync_local_lists()
+    with trace.span('sync /var/lib/apt/lists', 'sync'):
+        sync_local_lists()
     
-    state = load_medium_state()
-    if hostname not in state['install_queue']:
-        state['install_queue'][hostname] = []
-        state['download_queue'][hostname] = []
-        save_medium_state(state)
+    if not has_target('medium_state', hostname):
+        with transaction('medium_state') as conn:
+            add_target(conn, hostname)
     
     return 0
 
-def update_action(args):
-    install_medium = args.install_medium
-    target = args.target
+def sources_fingerprint(target_apt_dir):
+    # Hash everything that decides which package lists "apt-get update" fetches for a target,
+    # targets with the same fingerprint can share a single update run
+    digest = hashlib.sha256()
+    
+    def add_file(path):
+        digest.update(os.path.relpath(path, target_apt_dir).encode('utf-8') + b'\0')
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+        digest.update(b'\0')
+    
+    for name in ['sources.list', 'trusted.gpg']:
+        path = os.path.join(target_apt_dir, name)
+        if os.path.isfile(path):
+            add_file(path)
+    
+    for name in ['sources.list.d', 'trusted.gpg.d']:
+        path = os.path.join(target_apt_dir, name)
+        if os.path.isdir(path):
+            for f in sorted(os.listdir(path)):
+                if os.path.isfile(os.path.join(path, f)):
+                    add_file(os.path.join(path, f))
+    
+    # Only the architecture settings of apt-medium.conf affect which lists are fetched
+    apt_medium_conf = os.path.join(target_apt_dir, 'apt-medium.conf')
+    if os.path.isfile(apt_medium_conf):
+        with open(apt_medium_conf, 'rb') as f:
+            for line in f:
+                if line.strip().startswith(b'Architecture'):
+                    digest.update(line.strip() + b'\n')
+    
+    return digest.hexdigest()
+
+def stage_lists(lists_dir, staging_dir):
+    # Give a concurrent update its own view of the lists directory so that parallel apt-get runs
+    # don't fight over the lock file and the partial directory. Hardlinks keep this cheap,
+    # apt-get replaces lists by renaming so the originals are never modified through the links.
+    os.mkdir(os.path.join(staging_dir, 'partial'))
+    for f in os.listdir(lists_dir):
+        src_file = os.path.join(lists_dir, f)
+        if f == 'lock' or not os.path.isfile(src_file):
+            continue
+        try:
+            os.link(src_file, os.path.join(staging_dir, f))
+        except OSError as _:
+            shutil.copy2(src_file, os.path.join(staging_dir, f))
+
+def merge_staged_lists(staging_dir, lists_dir):
+    for f in sorted(os.listdir(staging_dir)):
+        src_file = os.path.join(staging_dir, f)
+        dst_file = os.path.join(lists_dir, f)
+        if f == 'lock' or not os.path.isfile(src_file):
+            continue
+        if os.path.exists(dst_file) and os.path.samefile(src_file, dst_file):
+            continue
+        os.rename(src_file, dst_file)
+
+def run_update_group(install_medium, systems, staging_dir=None):
+    # Any member of the group can stand in for the rest since they share their sources
+    target_apt_dir = os.path.join(install_medium, 'system_info', systems[0], 'etc', 'apt')
+    # Prepare configuration file to redirect location of /etc/apt in apt-get
+    env = setup_config_redirect(dict(os.environ), target_apt_dir)
     
-    state = load_medium_state()
-    if target:
-        all_systems = False
-        if not os.path.exists(os.path.join(install_medium, 'system_info', target)):
-            print('Cannot find target (' + target + ') on medium (' + install_medium + ') check that your spelling is correct and that the target has been initialized on the medium')
-            return -1
+    parms = ['apt-get']
+    
+    # Set RootDir to installation medium location
+    parms.append('--option')
+    parms.append('Dir=' + install_medium)
+    
+    # Load target's apt-medium.conf file
+    parms.append('--config-file')
+    parms.append(os.path.join(target_apt_dir, 'apt-medium.conf'))
+    
+    if staging_dir:
+        parms.append('--option')
+        parms.append('Dir::State::Lists=' + staging_dir)
+        proc = trace.Popen(parms + ['update'], env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.communicate()[0].decode('utf-8', 'replace')
     else:
-        all_systems = True
+        proc = trace.Popen(parms + ['update'], env=env)
+        proc.wait()
+        output = None
     
+    return (proc.returncode, output)
+
+def warm_caches(install_medium, systems):
+    # Builds apt's caches for a group of targets sharing their sources: the first run builds the shared
+    # source package cache, the rest only add their own installed packages on top of it
     success = True
-    for system in (state['download_queue'] if all_systems else [target]):
-        target_info_dir = os.path.join(install_medium, 'system_info', system)
-        target_apt_dir = os.path.join(target_info_dir, 'etc', 'apt')
-        # Prepare configuration file to redirect location of /etc/apt in apt-get
-        env = setup_config_redirect(os.environ, target_apt_dir)
+    for system in systems:
+        target_apt_dir = os.path.join(install_medium, 'system_info', system, 'etc', 'apt')
+        env = setup_config_redirect(dict(os.environ), target_apt_dir)
         
-        parms = ['apt-get']
+        parms = ['apt-cache']
         
         # Set RootDir to installation medium location
         parms.append('--option')
@@ -311,20 +727,134 @@ def update_action(args):
         parms.append('--config-file')
         parms.append(os.path.join(target_apt_dir, 'apt-medium.conf'))
         
-        parms.append('update')
-        
-        proc = subprocess.Popen(parms, env=env)
+        parms.append('gencaches')
         
-        if proc.wait() != 0:
-            print('\napt-get failed while updating package lists for target: ' +  system)
+        proc = trace.Popen(parms, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        proc.communicate()
+        if proc.returncode != 0:
             success = False
+    return success
+
+def prune_srcpkgcaches(install_medium, keep):
+    # Drops source package caches no target uses anymore
+    cache_dir = medium_data_file(install_medium, 'srcpkgcache')
+    if not os.path.isdir(cache_dir):
+        return
+    for f in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, f)
+        if path not in keep and os.path.isfile(path):
+            os.unlink(path)
+
+def update_action(args):
+    install_medium = args.install_medium
+    target = args.target
+    jobs = max(1, args.jobs)
+    
+    state = load_medium_state()
+    if target:
+        all_systems = False
+        if not os.path.exists(os.path.join(install_medium, 'system_info', target)):
+            print('Cannot find target (' + target + ') on medium (' + install_medium + ') check that your spelling is correct and that the target has been initialized on the medium')
+            return -1
+    else:
+        all_systems = True
+    
+    # Group targets with identical sources so each distinct set of lists is only fetched once
+    groups = {}
+    for system in sorted(state['download_queue'] if all_systems else [target]):
+        target_apt_dir = os.path.join(install_medium, 'system_info', system, 'etc', 'apt')
+        groups.setdefault(sources_fingerprint(target_apt_dir), []).append(system)
+    groups = sorted(groups.values())
+    
+    success = True
+    if jobs == 1 or len(groups) == 1:
+        for systems in groups:
+            print('Updating package lists for: ' + ", ".join(systems))
+            retCode, _ = run_update_group(install_medium, systems)
+            if retCode != 0:
+                print('\napt-get failed while updating package lists for target(s): ' + ", ".join(systems))
+                success = False
+    else:
+        lists_dir = os.path.join(install_medium, 'lists')
+        staging_dirs = []
+        try:
+            for systems in groups:
+                staging_dir = tempfile.mkdtemp(prefix='update-', dir=install_medium)
+                staging_dirs.append(staging_dir)
+                stage_lists(lists_dir, staging_dir)
+            
+            pool = ThreadPool(min(jobs, len(groups)))
+            try:
+                results = pool.map(lambda g: run_update_group(install_medium, g[0], g[1]), zip(groups, staging_dirs))
+            finally:
+                pool.close()
+                pool.join()
+            
+            # Report and merge in a fixed order so the outcome doesn't depend on which run finished first
+            for systems, staging_dir, (retCode, output) in zip(groups, staging_dirs, results):
+                print('Updating package lists for: ' + ", ".join(systems))
+                print(output, end='')
+                merge_staged_lists(staging_dir, lists_dir)
+                if retCode != 0:
+                    print('\napt-get failed while updating package lists for target(s): ' + ", ".join(systems))
+                    success = False
+        finally:
+            for staging_dir in staging_dirs:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+    
+    # Compress anything apt-get stored uncompressed (e.g. for targets initialized before lists were kept compressed)
+    compress_lists(os.path.join(install_medium, 'lists'))
+    
+    # Index the new lists now, on the connected system, rather than on the first slow target that needs them
+    update_index(os.path.join(install_medium, 'lists'), medium_data_file(install_medium, 'pkgindex'))
+    
+    # Likewise build apt's own caches now instead of on every target's next apt-get run
+    if groups:
+        print('\nBuilding package caches')
+        sys.stdout.flush()
+        pool = ThreadPool(min(jobs, len(groups)))
+        try:
+            results = pool.map(lambda systems: warm_caches(install_medium, systems), groups)
+        finally:
+            pool.close()
+            pool.join()
+        for systems, warmed in zip(groups, results):
+            if not warmed:
+                print('Failed to build package caches for target(s): ' + ", ".join(systems))
+    if all_systems:
+        prune_srcpkgcaches(install_medium, [ srcpkgcache_file(os.path.join(install_medium, 'system_info', systems[0], 'etc', 'apt')) for systems in groups ])
     
     if success:
         # Note that apt-get returns an exit code of 0 on download failures.
         # TODO: Try to find a better way to handle this.
         print('\nPackage list updating complete\nCheck the above output for any download warnings/errors')
+        return 0
     else:
         print('\nOne or more package list update actions failed')
+        return -1
+
+def prompt_plan(question, plan, missing=None):
+    # Ask question until answered with y or n, showing the plan's details (s) or needed URIs (p) on request
+    while True:
+        print(question, end='')
+        sys.stdout.flush()
+        response = getch()
+        print(response)
+        response = response.lower()
+        if response == 'y' or response == 'n':
+            return response
+        elif response == 's':
+            print()
+            for line in plan.details:
+                print(line)
+            print()
+        elif response == 'p' and missing is not None:
+            print()
+            for package in missing:
+                print(uri_line(package))
+            print()
+        else:
+            print('Invalid selection.')
 
 def upgrade_action(args, isDistUpgrade):
     target = args.target
@@ -350,6 +880,9 @@ def upgrade_action(args, isDistUpgrade):
     
     # Prepare configuration file to redirect location of /etc/apt in apt-get
     env = setup_config_redirect(os.environ, target_apt_dir)
+    resolve_cache = medium_data_file(install_medium, 'resolve-cache')
+    # Only the lists the target's sources use have a bearing on its resolutions
+    lists = target_lists(install_medium, target)
     
     parms = ['apt-get']
     
@@ -374,206 +907,220 @@ def upgrade_action(args, isDistUpgrade):
     else:
         parms.append('--assume-yes')
     
-    # Check if all needed downloads are present
+    # Resolve the upgrade once, every prompt and queue update below works from the resulting plan
     try:
-        check_parms = list(parms)
-        check_parms.append('--print-uris')
-        check_parms.append('-qq')
-        uris = subprocess.check_output(check_parms, env=env).decode('utf-8').splitlines()
+        plan = resolve(resolve_cache, install_medium, target, parms, env, lists)
     except subprocess.CalledProcessError as _:
         print('apt-get failed while checking for needed packages')
         return -1
     
-    total_size = 0
-    num_missing = 0
-    for item in uris:
-        item = item.split()
-        if item == []: continue
-        if len(item) != 4: continue
-        if not item[0].startswith("'http"): continue
-        total_size += int(item[2])
-        num_missing += 1
-
-    if num_missing > 0:
-        print('Need to download ' + str(num_missing) + ' packages totaling ' + '{:,}'.format(total_size) + ' bytes')
-        while True:
-            print('Add to download queue? Yes (y), No(n), or Show Details (s) or Print URIs (p):', end='')
-            sys.stdout.flush()
-            response = getch()
-            print(response)
-            response = response.lower()
-            if response == 'y' or response == 'n':
-                break
-            elif response == 's':
-                print()
-                detail_parms = list(parms)
-                detail_parms.append('--simulate')
-                detail_output = subprocess.check_output(detail_parms, env=env).decode('utf-8').splitlines()
-                for line in detail_output:
-                    if re.search('Reading package lists', line) or re.search('Building dependency tree', line) or re.search('Reading state information', line):
-                        continue
-                    print(line)
-                    if re.search(r'[0-9]* newly installed', line):
-                        break
-                print()
-            elif response == 'p':
-                print()
-                for item in uris:
-                    print(item)
-                print()
-            else:
-                print('Invalid selection.')
+    # Queue the packages being upgraded (or newly pulled in) as a standard install
+    packages = plan.installs()
+    
+    missing = plan.missing(os.path.join(install_medium, 'archives'))
+    if missing:
+        print('Need to download ' + str(len(missing)) + ' packages totaling ' + '{:,}'.format(sum(p.size for p in missing)) + ' bytes')
+        response = prompt_plan('Add to download queue? Yes (y), No(n), or Show Details (s) or Print URIs (p):', plan, missing)
         if response == 'y':
-            state = load_medium_state()
-            
-            # Parse packages to be upgraded from details and queue as a standard download for installation
-            detail_parms = list(parms)
-            detail_parms.append('--simulate')
-            detail_output = subprocess.check_output(detail_parms, env=env).decode('utf-8').splitlines()
-            
-            get_pkgs = False
-            packages = []
-            for line in detail_output:
-                if re.search('NEW packages will be installed', line) or re.search('packages will be upgraded', line):
-                    get_pkgs = True
-                    continue
-                if re.search('packages will be REMOVED', line) or re.search('have been kept back', line):
-                    get_pkgs = False
-                    continue
-                if re.search(r'[0-9]* newly installed', line):
-                    break
-                if get_pkgs:
-                    for pkg in line.split():
-                        packages.append(pkg)
-            
-            for package in packages:
-                if package not in state['download_queue'][target]:
-                    state['download_queue'][target].append(package)
-                    print('Queued ' + package + ' for download')
-                else:
-                    print(package + ' already queued for download')
-            save_medium_state(state)
+            queue_packages('download_queue', target, packages, 'download', plan.packages)
         else: # response == 'n'
             pass
     else:
-        detail_parms = list(parms)
-        detail_parms.append('--simulate')
-        detail_output = subprocess.check_output(detail_parms, env=env).decode('utf-8').splitlines()
-        at_sim_details = False
-        nothing_to_do = True
-        get_pkgs = False
-        packages = []
-        for line in detail_output:
-            if not at_sim_details:
-                if re.search('NEW packages will be installed', line) or re.search('packages will be upgraded', line):
-                    get_pkgs = True
-                    continue
-                if re.search('packages will be REMOVED', line) or re.search('have been kept back', line):
-                    get_pkgs = False
-                    continue
-                if re.search('is already the newest version', line):
-                    print(line)
-                if re.search(r'[0-9]* newly installed', line):
-                    at_sim_details = True
-                    continue
-                if get_pkgs:
-                    for pkg in line.split():
-                        packages.append(pkg)
-            else:
-                nothing_to_do = False
-                break
-        if not nothing_to_do:
+        for line in plan.notices:
+            print(line)
+        if not plan.nothing_to_do():
             if not local_is_target:
                 print('Ready to upgrade ' + ", ".join(packages) + ' on ' + target)
-                while True:
-                    print('Add to install queue? Yes (y), No(n), or Show Details (s):', end='')
-                    sys.stdout.flush()
-                    response = getch()
-                    print(response)
-                    response = response.lower()
-                    if response == 'y' or response == 'n':
-                        break
-                    elif response == 's':
-                        print()
-                        for line in detail_output:
-                            if re.search('Reading package lists', line) or re.search('Building dependency tree', line) or re.search('Reading state information', line):
-                                continue
-                            print(line)
-                            if re.search(r'[0-9]* newly installed', line):
-                                break
-                        print()
-                    else:
-                        print('Invalid selection.')
+                response = prompt_plan('Add to install queue? Yes (y), No(n), or Show Details (s):', plan)
                 if response == 'y':
-                    state = load_medium_state()
-                    for package in packages:
-                        if package not in state['install_queue'][target]:
-                            state['install_queue'][target].append(package)
-                            print('Queued ' + package + ' for install')
-                        else:
-                            print(package + ' already queued for install')
-                    save_medium_state(state)
+                    queue_packages('install_queue', target, packages, 'install', plan.packages)
                 else: # response == 'n'
                     pass
             else:
                 print('Ready to upgrade ' + ", ".join(packages))
-                while True:
-                    print('Continue with upgrade? Yes (y), No(n), or Show Details (s):', end='')
-                    sys.stdout.flush()
-                    response = getch()
-                    print(response)
-                    response = response.lower()
-                    if response == 'y' or response == 'n':
-                        break
-                    elif response == 's':
-                        print()
-                        for line in detail_output:
-                            if re.search('Reading package lists', line) or re.search('Building dependency tree', line) or re.search('Reading state information', line):
-                                continue
-                            print(line)
-                            if re.search(r'[0-9]* newly installed', line):
-                                break
-                        print()
-                    else:
-                        print('Invalid selection.')
+                response = prompt_plan('Continue with upgrade? Yes (y), No(n), or Show Details (s):', plan)
                 if response == 'y':
                     # Override archives parameter with absolute path since apt-get refuses to install from a relative path
                     parms.append('--option')
                     parms.append('Dir::Cache::archives=' + os.path.join(install_medium, 'archives'))
-                    proc = subprocess.Popen(parms, env=env)
+                    proc = trace.Popen(parms, env=env)
                     
                     if proc.wait() != 0:
                         print('apt-get failed while installing packages')
                         return -1
                     
                     print ('Installation successful')
-                    state = load_medium_state()
-                    for package in packages:
-                        if package in state['install_queue'][target]:
-                            state['install_queue'][target].remove(package)
-                    save_medium_state(state)
+                    unqueue_packages('install_queue', target, packages)
                     
                     # Re-sync dpkg status info
                     init_action()
                 else: # response == 'n'
                     pass
         else:
-            state = load_medium_state()
-            for package in packages:
-                if package in state['install_queue'][target]:
-                    state['install_queue'][target].remove(package)
-            save_medium_state(state)
+            unqueue_packages('install_queue', target, packages)
             print('All packages already installed/up-to-date')
     
     return 0
     
+def apt_config(install_medium, target_apt_dir, env):
+    # The target's apt configuration as [(key, value), ...], None if apt-config can't dump it
+    parms = ['apt-config']
+    parms.append('--option')
+    parms.append('Dir=' + install_medium)
+    parms.append('--config-file')
+    parms.append(os.path.join(target_apt_dir, 'apt-medium.conf'))
+    parms.extend(['dump', '--format', '%f\t%v%n'])
+    try:
+        return parse_apt_config(trace.check_output(parms, env=env).decode('utf-8').splitlines())
+    except (subprocess.CalledProcessError, OSError) as _:
+        return None
+
+def run_hooks(commands, stdin_data=None):
+    # Runs apt hook commands the way apt-get does (through sh), returns False as soon as one fails
+    for command in commands:
+        proc = trace.Popen(['sh', '-c', command], stdin=subprocess.PIPE if stdin_data is not None else None)
+        if stdin_data is not None:
+            proc.communicate(stdin_data)
+        if proc.wait() != 0:
+            print('Hook failed: ' + command)
+            return False
+    return True
+
+def apply_queued_plan(install_medium, target, target_apt_dir, force=False):
+    # Installs the target's queue from the plan "download" prepared for it, without resolving anything again.
+    # dpkg is run with apt's DPkg::Options and between its DPkg::Pre-Invoke, Pre-Install-Pkgs (given the archives
+    # being installed, which is what debconf's preconfiguration reads) and Post-Invoke hooks, as apt-get would.
+    # Returns None if there is no plan that still fits this system, or apt-get has to do the install after all.
+    plans_dir = medium_data_file(install_medium, 'plans')
+    plan = load_plan(plans_dir, target)
+    if plan is None:
+        return None
+    packages = load_medium_state()['install_queue'][target]
+    if not packages:
+        return None
+    archives_dir = os.path.join(install_medium, 'archives')
+    manifest = load_pickle(medium_data_file(install_medium, 'archives-manifest'), {})
+    reason = stale_reason(plan, packages, '/var/lib/dpkg/status', archives_dir, load_pins('install_queue', target), manifest)
+    if reason:
+        print('Not using the prepared install plan, ' + reason)
+        remove_plan(plans_dir, target)
+        return None
+    
+    # dpkg has nothing like apt-get's --force-yes, so forced installs are left to apt-get
+    if force:
+        return None
+    env = setup_config_redirect(dict(os.environ), target_apt_dir)
+    config = apt_config(install_medium, target_apt_dir, env)
+    hooks = dpkg_hooks(config) if config is not None else None
+    if hooks is None:
+        print('Not using the prepared install plan, the apt configuration has hooks only apt-get can run')
+        return None
+    
+    print('Ready to install ' + ", ".join(packages))
+    response = prompt_plan('Continue with install? Yes (y), No(n), or Show Details (s):', plan)
+    if response == 'n':
+        return 0
+    
+    manual = set(apt_mark(install_medium, target_apt_dir, env, ['showmanual']))
+    
+    unpacked = [ os.path.join(archives_dir, step[4]) for step in plan.steps if step[0] == STEP_UNPACK ]
+    if not run_hooks(hooks['pre-invoke']) or \
+       not run_hooks(hooks['pre-install-pkgs'], ''.join(path + '\n' for path in unpacked).encode('utf-8')):
+        print('apt hooks failed, nothing was installed')
+        return -1
+    
+    success = True
+    for command in dpkg_commands(plan, archives_dir, hooks['options']):
+        proc = trace.Popen(command)
+        if proc.wait() != 0:
+            success = False
+            break
+    # apt-get runs these whether or not dpkg succeeded
+    run_hooks(hooks['post-invoke'])
+    if not success:
+        print('dpkg failed while installing packages')
+        return -1
+    
+    print ('Installation successful')
+    
+    # dpkg leaves everything it installed marked as manually installed, put the dependencies back to automatic
+    dependencies = sorted(set(step[1] for step in plan.steps if step[0] == STEP_UNPACK and step[1] not in packages and step[1] not in manual))
+    if dependencies:
+        apt_mark(install_medium, target_apt_dir, env, ['auto'] + dependencies)
+    unqueue_packages('install_queue', target, packages)
+    remove_plan(plans_dir, target)
+    
+    # Re-sync dpkg status info
+    init_action()
+    return 0
+
+def fetch_from_server(install_medium, server, missing):
+    # Fetches the missing archives from another medium's server, returns the ones that are still missing
+    archives_dir = os.path.join(install_medium, 'archives')
+    print('Fetching ' + str(len(missing)) + ' packages from ' + server)
+    failures = fetch_archives(server, missing, archives_dir)
+    for filename in sorted(failures):
+        print('Failed to fetch ' + filename + ' from ' + server + ': ' + failures[filename])
+    
+    # Fetched archives were checked against the checksums the resolution expects, no need to hash them again
+    manifest_file = medium_data_file(install_medium, 'archives-manifest')
+    manifest = load_pickle(manifest_file, {})
+    for p in missing:
+        if p.filename not in failures and p.checksum:
+            record_verified(manifest, archives_dir, p.filename, p.checksum)
+    save_pickle(manifest_file, manifest)
+    update_archive_index(install_medium)
+    
+    return [ p for p in missing if p.filename in failures ]
+
+def fetch_plan_from_server(install_medium, server, target):
+    # Takes the install plan the server's medium prepared for target when there isn't one here, along with the
+    # pinned archives it unpacks that this medium lacks. apply_queued_plan still checks it fits this system.
+    plans_dir = medium_data_file(install_medium, 'plans')
+    if load_plan(plans_dir, target) is not None:
+        return
+    try:
+        plan = fetch_plan(server, target)
+    except FetchError as e:
+        print('Failed to fetch the install plan from ' + server + ': ' + str(e))
+        return
+    if plan is None:
+        return
+    save_plan(plans_dir, target, plan)
+    
+    archives_dir = os.path.join(install_medium, 'archives')
+    unpacked = set(step[4] for step in plan.steps if step[0] == STEP_UNPACK)
+    missing = [ p for p in load_pins('install_queue', target) if p.filename in unpacked and not os.path.isfile(os.path.join(archives_dir, p.filename)) ]
+    if missing:
+        fetch_from_server(install_medium, server, missing)
+
+def serve_action(args):
+    try:
+        server = MediumServer(args.install_medium, (args.bind, args.port), quiet=args.quiet)
+    except (socket.error, OSError) as e:
+        print('Cannot listen on ' + args.bind + ':' + str(args.port) + ': ' + str(e))
+        return -1
+    
+    host = socket.gethostname() if args.bind in ('', '0.0.0.0', '::') else args.bind
+    print('Serving ' + args.install_medium + ' at http://' + host + ':' + str(server.server_address[1]) + '/ (Ctrl-C to stop)')
+    print('Install from it with: apt-medium install --server http://' + host + ':' + str(server.server_address[1]) + ' ...')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt as _:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
 def install_action(args):
     target = args.target
     install_medium = args.install_medium
     packages = args.packages
     force = args.force
     fix_broken = args.fix_broken
+    server = getattr(args, 'server', None)
     local_is_target = target == socket.gethostname()
+    pinned = []
     
     target_info_dir = os.path.join(install_medium, 'system_info', target)
     target_apt_dir = os.path.join(target_info_dir, 'etc', 'apt')
@@ -588,8 +1135,29 @@ def install_action(args):
     if local_is_target:
         init_action()
     
+    # Installing the queue on this system can skip dependency resolution if download left a plan for it
+    if local_is_target and not packages and not fix_broken:
+        if server:
+            fetch_plan_from_server(install_medium, server, target)
+        retCode = apply_queued_plan(install_medium, target, target_apt_dir, force)
+        if retCode is not None:
+            return retCode
+    
+    # Resolve against the same package lists as the server we'll take missing packages from
+    if server:
+        try:
+            failures = mirror_lists(server, os.path.join(install_medium, 'lists'))
+        except FetchError as e:
+            print(str(e))
+            return -1
+        for name in sorted(failures):
+            print('Failed to fetch package list ' + name + ' from ' + server + ': ' + failures[name])
+    
     # Prepare configuration file to redirect location of /etc/apt in apt-get
     env = setup_config_redirect(os.environ, target_apt_dir)
+    resolve_cache = medium_data_file(install_medium, 'resolve-cache')
+    # Only the lists the target's sources use have a bearing on its resolutions
+    lists = target_lists(install_medium, target)
     
     parms = ['apt-get']
     
@@ -615,7 +1183,13 @@ def install_action(args):
             state = load_medium_state()
             if len(state['install_queue'][target]) > 0:
                 packages = state['install_queue'][target]
-                parms.extend(packages)
+                # Apply the transaction resolved when the packages were queued rather than resolving it again
+                pinned = load_pins('install_queue', target)
+                pins_start = len(parms)
+                if pinned:
+                    parms.extend(pin_spec(p) for p in pinned)
+                else:
+                    parms.extend(packages)
             else:
                 print('Nothing to install')
                 return 0
@@ -625,169 +1199,286 @@ def install_action(args):
     else:
         parms.append('--assume-yes')
     
-    # Check if all needed downloads are present
+    # Resolve the install once, every prompt and queue update below works from the resulting plan
     try:
-        check_parms = list(parms)
-        check_parms.append('--print-uris')
-        check_parms.append('-qq')
-        uris = subprocess.check_output(check_parms, env=env).decode('utf-8').splitlines()
+        plan = resolve(resolve_cache, install_medium, target, parms, env, lists)
     except subprocess.CalledProcessError as _:
+        plan = None
+    
+    if plan is None and pinned:
+        # The lists on the medium no longer offer the pinned versions, fall back to the queued package names
+        print('Queued package versions are no longer available, resolving the install queue again')
+        parms[pins_start:pins_start + len(pinned)] = packages
+        pinned = []
+        try:
+            plan = resolve(resolve_cache, install_medium, target, parms, env, lists)
+        except subprocess.CalledProcessError as _:
+            pass
+    
+    if plan is None:
         print('apt-get failed while checking for needed packages')
         return -1
     
-    total_size = 0
-    num_missing = 0
-    for item in uris:
-        item = item.split()
-        if item == []: continue
-        total_size += int(item[2])
-        num_missing += 1
-    
-    if num_missing > 0:
-        print('Need to download ' + str(num_missing) + ' packages totaling ' + '{:,}'.format(total_size) + ' bytes')
-        while True:
-            print('Add to download queue? Yes (y), No(n), or Show Details (s) or Print URIs (p):', end='')
-            sys.stdout.flush()
-            response = getch()
-            print(response)
-            response = response.lower()
-            if response == 'y' or response == 'n':
-                break
-            elif response == 's':
-                print()
-                detail_parms = list(parms)
-                detail_parms.append('--simulate')
-                detail_output = subprocess.check_output(detail_parms, env=env).decode('utf-8').splitlines()
-                for line in detail_output:
-                    if re.search('Reading package lists', line) or re.search('Building dependency tree', line) or re.search('Reading state information', line):
-                        continue
-                    print(line)
-                    if re.search(r'[0-9]* newly installed', line):
-                        break
-                print()
-            elif response == 'p':
-                print()
-                for item in uris:
-                    print(item)
-                print()
-            else:
-                print('Invalid selection.')
+    missing = plan.missing(os.path.join(install_medium, 'archives'))
+    if missing and server:
+        missing = fetch_from_server(install_medium, server, missing)
+    if missing:
+        print('Need to download ' + str(len(missing)) + ' packages totaling ' + '{:,}'.format(sum(p.size for p in missing)) + ' bytes')
+        response = prompt_plan('Add to download queue? Yes (y), No(n), or Show Details (s) or Print URIs (p):', plan, missing)
         if response == 'y':
-            state = load_medium_state()
-            for package in packages:
-                if package not in state['download_queue'][target]:
-                    state['download_queue'][target].append(package)
-                    print('Queued ' + package + ' for download')
-                else:
-                    print(package + ' already queued for download')
-            save_medium_state(state)
+            queue_packages('download_queue', target, packages, 'download', plan.packages)
         else: # response == 'n'
             pass
     else:
-        detail_parms = list(parms)
-        detail_parms.append('--simulate')
-        detail_output = subprocess.check_output(detail_parms, env=env).decode('utf-8').splitlines()
-        at_sim_details = False
-        nothing_to_do = True
-        for line in detail_output:
-            if not at_sim_details:
-                if re.search('is already the newest version', line):
-                    print(line)
-                if re.search(r'[0-9]* newly installed', line):
-                    at_sim_details = True
-            else:
-                nothing_to_do = False
-                break
-        if not nothing_to_do:
+        for line in plan.notices:
+            print(line)
+        if not plan.nothing_to_do():
             if not local_is_target:
                 print('Ready to install ' + ", ".join(packages) + ' on ' + target)
-                while True:
-                    print('Add to install queue? Yes (y), No(n), or Show Details (s):', end='')
-                    sys.stdout.flush()
-                    response = getch()
-                    print(response)
-                    response = response.lower()
-                    if response == 'y' or response == 'n':
-                        break
-                    elif response == 's':
-                        print()
-                        for line in detail_output:
-                            if re.search('Reading package lists', line) or re.search('Building dependency tree', line) or re.search('Reading state information', line):
-                                continue
-                            print(line)
-                            if re.search(r'[0-9]* newly installed', line):
-                                break
-                        print()
-                    else:
-                        print('Invalid selection.')
+                response = prompt_plan('Add to install queue? Yes (y), No(n), or Show Details (s):', plan)
                 if response == 'y':
-                    state = load_medium_state()
-                    for package in packages:
-                        if package not in state['install_queue'][target]:
-                            state['install_queue'][target].append(package)
-                            print('Queued ' + package + ' for install')
-                        else:
-                            print(package + ' already queued for install')
-                    save_medium_state(state)
+                    queue_packages('install_queue', target, packages, 'install', plan.packages)
                 else: # response == 'n'
                     pass
             else:
                 print('Ready to install ' + ", ".join(packages))
-                while True:
-                    print('Continue with install? Yes (y), No(n), or Show Details (s):', end='')
-                    sys.stdout.flush()
-                    response = getch()
-                    print(response)
-                    response = response.lower()
-                    if response == 'y' or response == 'n':
-                        break
-                    elif response == 's':
-                        print()
-                        for line in detail_output:
-                            if re.search('Reading package lists', line) or re.search('Building dependency tree', line) or re.search('Reading state information', line):
-                                continue
-                            print(line)
-                            if re.search(r'[0-9]* newly installed', line):
-                                break
-                        print()
-                    else:
-                        print('Invalid selection.')
+                response = prompt_plan('Continue with install? Yes (y), No(n), or Show Details (s):', plan)
                 if response == 'y':
+                    if pinned:
+                        manual = set(apt_mark(install_medium, target_apt_dir, env, ['showmanual']))
+                    
                     # Override archives parameter with absolute path since apt-get refuses to install from a relative path
                     parms.append('--option')
                     parms.append('Dir::Cache::archives=' + os.path.join(install_medium, 'archives'))
-                    proc = subprocess.Popen(parms, env=env)
+                    proc = trace.Popen(parms, env=env)
                     
                     if proc.wait() != 0:
                         print('apt-get failed while installing packages')
                         return -1
                     
                     print ('Installation successful')
-                    state = load_medium_state()
-                    for package in packages:
-                        if package in state['install_queue'][target]:
-                            state['install_queue'][target].remove(package)
-                    save_medium_state(state)
+                    
+                    if pinned:
+                        # Naming every pinned package on the command line marked them all as manually installed,
+                        # put the ones that were only pulled in as dependencies back to automatic
+                        dependencies = sorted(set(p.name for p in pinned if p.name not in packages and p.name not in manual))
+                        if dependencies:
+                            apt_mark(install_medium, target_apt_dir, env, ['auto'] + dependencies)
+                    unqueue_packages('install_queue', target, packages)
                     
                     # Re-sync dpkg status info
                     init_action()
                 else: # response == 'n'
                     pass
         else:
-            state = load_medium_state()
-            for package in packages:
-                if package in state['install_queue'][target]:
-                    state['install_queue'][target].remove(package)
-            save_medium_state(state)
+            unqueue_packages('install_queue', target, packages)
             print('All packages already installed/up-to-date')
     
     return 0
 
+def dequeue_downloaded(target, addtnl_params):
+    with transaction('medium_state') as conn:
+        queue_move(conn, 'download_queue', 'install_queue', target, addtnl_params)
+
+def target_acquire_config(install_medium, target):
+    # How the target's apt reaches its mirrors (proxies and auth.conf, see fetch.acquire_config), None if only apt-get can tell
+    target_apt_dir = os.path.join(install_medium, 'system_info', target, 'etc', 'apt')
+    env = setup_config_redirect(dict(os.environ), target_apt_dir)
+    config = apt_config(install_medium, target_apt_dir, env)
+    if config is None:
+        return None
+    return acquire_config(config, target_apt_dir)
+
+def native_download(install_medium, actions_to_perform, target_files, downloads, jobs, allow_unauth, acquire):
+    archives_dir = os.path.join(install_medium, 'archives')
+    
+    # Without a checksum there is nothing tying the file back to the signed package lists
+    if not allow_unauth:
+        unverifiable = [ d[1] for d in downloads if not d[3] ]
+        if unverifiable:
+            print('\nNo checksum available for: ' + ", ".join(sorted(unverifiable)))
+            print('Use --allow-unauthenticated to download these packages anyway')
+            return False
+    
+    def progress(uri, filename, size, error):
+        if error:
+            print('Err ' + uri + '\n  ' + error)
+        else:
+            print('Get ' + uri + ' [' + '{:,}'.format(size) + ' B]')
+        sys.stdout.flush()
+    
+    failures = fetch_all(downloads, archives_dir, jobs=jobs, progress=progress, acquire=acquire)
+    
+    # Everything fetched was hashed on the way in, so record it as verified rather than reading it again later
+    manifest_file = medium_data_file(install_medium, 'archives-manifest')
+    manifest = load_pickle(manifest_file, {})
+    for uri, filename, size, checksum in downloads:
+        if filename not in failures and checksum:
+            record_verified(manifest, archives_dir, filename, checksum)
+    save_pickle(manifest_file, manifest)
+    
+    # Targets are only moved to the install queue once every file they need has arrived
+    success = True
+    for target, action, addtnl_params in actions_to_perform:
+        failed = target_files[target].intersection(failures)
+        if failed:
+            print('\nFailed to download ' + ", ".join(sorted(failed)) + ' for target: ' + target + ' action: ' + action + ' addtnl_params: ' + " ".join(addtnl_params))
+            success = False
+        else:
+            dequeue_downloaded(target, addtnl_params)
+    
+    return success
+
+def apt_get_download(install_medium, actions_to_perform, target_pins, force, allow_unauth):
+    success = True
+    for target, action, addtnl_params in actions_to_perform:
+        target_info_dir = os.path.join(install_medium, 'system_info', target)
+        target_apt_dir = os.path.join(target_info_dir, 'etc', 'apt')
+        
+        # Prepare configuration file to redirect location of /etc/apt in apt-get
+        env = setup_config_redirect(os.environ, target_apt_dir)
+        
+        parms = ['apt-get']
+        
+        # Set RootDir to installation medium location
+        parms.append('--option')
+        parms.append('Dir=' + install_medium)
+        
+        # Load target's apt-medium.conf file
+        parms.append('--config-file')
+        parms.append(os.path.join(target_apt_dir, 'apt-medium.conf'))
+        
+        parms.append('--download-only')
+        
+        if force:
+            parms.append('--force-yes')
+        else:
+            parms.append('--assume-yes')
+        
+        if allow_unauth:
+            parms.append('--allow-unauthenticated')
+        
+        parms.append(action)
+        if target_pins[target]:
+            parms.extend(pin_spec(p) for p in target_pins[target])
+        elif addtnl_params:
+            parms.extend(addtnl_params)
+        
+        proc = trace.Popen(parms, env=env)
+        
+        if proc.wait() != 0:
+            print('\napt-get failed while downloading packages for target: ' +  target + ' action: ' + action + ' addtnl_params: ' + " ".join(addtnl_params))
+            success = False
+        else:
+            dequeue_downloaded(target, addtnl_params)
+    
+    return success
+
+def download_request(install_medium, target, packages):
+    # apt-get command and environment that work out what installing packages on target needs
+    target_info_dir = os.path.join(install_medium, 'system_info', target)
+    target_apt_dir = os.path.join(target_info_dir, 'etc', 'apt')
+    # Prepare configuration file to redirect location of /etc/apt in apt-get, in an environment
+    # of its own so requests for different targets can run side by side
+    env = setup_config_redirect(dict(os.environ), target_apt_dir)
+    
+    parms = ['apt-get']
+    
+    # Set RootDir to installation medium location
+    parms.append('--option')
+    parms.append('Dir=' + install_medium)
+    
+    # Load target's apt-medium.conf file
+    parms.append('--config-file')
+    parms.append(os.path.join(target_apt_dir, 'apt-medium.conf'))
+    
+    parms.append('install')
+    parms.extend(packages)
+    return (parms, env)
+
+def resolve_download_group(install_medium, resolve_cache, target, packages, lists):
+    # Resolves one target's queue, None if apt-get failed
+    parms, env = download_request(install_medium, target, packages)
+    try:
+        return resolve(resolve_cache, install_medium, target, parms, env, lists).packages
+    except subprocess.CalledProcessError as _:
+        return None
+
+def resolve_download_queues(install_medium, resolve_cache, queues, jobs=1):
+    # Resolves download queues that were filled in without pins and pins the results for the later installs.
+    # Targets with the same installed packages, apt configuration, lists and queue (e.g. cloned machines)
+    # get the same answer, so each such group is resolved once and the result shared by all of its members.
+    # Up to jobs groups are resolved at once.
+    # queues: {hostname: [package, ...]}. Returns {hostname: [PlannedPackage, ...]}, None if apt-get failed
+    groups = collections.OrderedDict() # resolution key -> [hostname, ...]
+    target_list_files = {}
+    for target in sorted(queues):
+        target_list_files[target] = target_lists(install_medium, target)
+        parms, _ = download_request(install_medium, target, queues[target])
+        groups.setdefault(resolve_key(install_medium, target, parms, target_list_files[target]), []).append(target)
+    groups = list(groups.values())
+    
+    def resolve_group(members):
+        target = members[0]
+        return resolve_download_group(install_medium, resolve_cache, target, queues[target], target_list_files[target])
+    
+    if jobs == 1 or len(groups) == 1:
+        results = [ resolve_group(members) for members in groups ]
+    else:
+        pool = ThreadPool(min(jobs, len(groups)))
+        try:
+            results = pool.map(resolve_group, groups)
+        finally:
+            pool.close()
+            pool.join()
+    
+    # Merge in a fixed order so the outcome doesn't depend on which run finished first
+    resolved = {}
+    for members, packages in zip(groups, results):
+        if packages is None:
+            print('apt-get failed while checking for needed packages for target(s): ' + ", ".join(members))
+            return None
+        for member in members:
+            resolved[member] = packages
+    
+    with transaction('medium_state') as conn:
+        for target in sorted(resolved):
+            pins_add(conn, 'download_queue', target, resolved[target])
+    return resolved
+
+def write_apply_plan(install_medium, target):
+    # Works out the exact order the target's install queue will be carried out in while we are on a
+    # (fast) connected system, so "install" on the target can apply it without resolving it again
+    plans_dir = medium_data_file(install_medium, 'plans')
+    remove_plan(plans_dir, target)
+    state = load_medium_state()
+    packages = state['install_queue'][target]
+    pins = load_pins('install_queue', target)
+    if state['download_queue'][target] or not packages or not pins:
+        return False
+    
+    parms, env = download_request(install_medium, target, [ pin_spec(p) for p in pins ])
+    parms.append('--simulate')
+    try:
+        lines = trace.check_output(parms, env=env).decode('utf-8').splitlines()
+    except subprocess.CalledProcessError as _:
+        return False
+    plan = make_plan(packages, os.path.join(install_medium, 'system_info', target, 'dpkg-status'), lines, pins)
+    if plan is None:
+        return False
+    save_plan(plans_dir, target, plan)
+    return True
+
 def download_action(args):
     install_medium = args.install_medium
     target = args.target
     force = args.force
     allow_unauth = args.allow_unauthenticated
+    jobs = max(1, args.jobs)
+    reserve = parse_size(args.reserve)
+    if reserve is None:
+        print('Invalid size: ' + args.reserve)
+        return -1
     
     state = load_medium_state()
     if target:
@@ -798,8 +1489,12 @@ def download_action(args):
     else:
         all_systems = True
     
+    resolve_cache = medium_data_file(install_medium, 'resolve-cache')
     actions_to_perform = [] # [(hostname, action, additional params.), ...]
     uris_to_download = set()
+    target_files = {} # hostname -> set of archive filenames needed by that target
+    target_pins = {} # hostname -> [PlannedPackage, ...] resolved for that target's queue
+    unpinned = {} # hostname -> queued packages that still need resolving
     for system in (state['download_queue'] if all_systems else [target]):
         if len(state['download_queue'][system]) > 0:
             if not actions_to_perform:
@@ -810,53 +1505,50 @@ def download_action(args):
             print('\t\t' + action + ' ' + ", ".join(addtnl_parms))
             actions_to_perform.append((system, action, addtnl_parms))
             
-            target_info_dir = os.path.join(install_medium, 'system_info', system)
-            target_apt_dir = os.path.join(target_info_dir, 'etc', 'apt')
-            # Check packages to be downloaded to calculate download size
-            # Prepare configuration file to redirect location of /etc/apt in apt-get
-            env = setup_config_redirect(os.environ, target_apt_dir)
-            
-            parms = ['apt-get']
-            
-            # Set RootDir to installation medium location
-            parms.append('--option')
-            parms.append('Dir=' + install_medium)
-            
-            # Load target's apt-medium.conf file
-            parms.append('--config-file')
-            parms.append(os.path.join(target_apt_dir, 'apt-medium.conf'))
-            
-            parms.append('install')
-            if addtnl_parms:
-                parms.extend(addtnl_parms)
-            
-            try:
-                check_parms = list(parms)
-                check_parms.append('--print-uris')
-                check_parms.append('-qq')
-                uris = subprocess.check_output(check_parms, env=env).decode('utf-8')
-            except subprocess.CalledProcessError as _:
-                print('apt-get failed while checking for needed packages')
-                return -1
-            
-            missing_packages = uris.splitlines()
-            missing_packages = [ s.split() for s in missing_packages ]
-            missing_packages = map(tuple, missing_packages)
-            uris_to_download.update(missing_packages)
+            # Queues resolved when they were filled in only need their pinned archives fetched
+            pins = load_pins('download_queue', system)
+            if pins:
+                target_pins[system] = pins
+            else:
+                unpinned[system] = addtnl_parms
     
     if not actions_to_perform:
         print('No pending download actions')
         return 0
     
-    # Remove any empty lines from uri set
-    try:
-        uris_to_download.remove(())
-    except KeyError as _:
-        pass
+    if unpinned:
+        resolved = resolve_download_queues(install_medium, resolve_cache, unpinned, jobs)
+        if resolved is None:
+            return -1
+        target_pins.update(resolved)
+    
+    for system in sorted(target_pins):
+        missing = [ (p.uri, p.filename, p.size, p.checksum) for p in missing_packages(target_pins[system], os.path.join(install_medium, 'archives')) ]
+        uris_to_download.update(missing)
+        target_files[system] = set(item[1] for item in missing)
+    
+    # Make sure everything about to be fetched fits on the medium, deferring whole targets when it doesn't
+    # so that no download is left to fail part way through
+    archives_dir = os.path.join(install_medium, 'archives')
+    file_sizes = dict((item[1], space_needed(archives_dir, item[1], item[2])) for item in uris_to_download)
+    available = max(0, free_space(archives_dir) - reserve)
+    if sum(file_sizes.values()) > available:
+        chosen, deferred = choose_targets(target_files, file_sizes, available, args.priority)
+        print('Not enough free space on the installation medium for all pending downloads (' + '{:,}'.format(available) + ' bytes available)')
+        for system in deferred:
+            print('Deferring downloads for ' + system + ' (' + '{:,}'.format(sum(file_sizes[f] for f in target_files[system])) + ' bytes)')
+        if not chosen:
+            print('Free up space (e.g. with "apt-medium gc") and try again')
+            return -1
+        actions_to_perform = [ a for a in actions_to_perform if a[0] in chosen ]
+        chosen_files = set()
+        for system in chosen:
+            chosen_files.update(target_files[system])
+        uris_to_download = set(item for item in uris_to_download if item[1] in chosen_files)
     
     total_size = 0
     for item in uris_to_download:
-        total_size += int(item[2])
+        total_size += item[2]
     print('About to download ' + str(len(uris_to_download)) + ' packages totaling ' + '{:,}'.format(total_size) + ' bytes')
     
     while True:
@@ -872,49 +1564,22 @@ def download_action(args):
     if response == 'n':
         return 0
     
-    success = True
-    for target, action, addtnl_params in actions_to_perform:
-        target_info_dir = os.path.join(install_medium, 'system_info', target)
-        target_apt_dir = os.path.join(target_info_dir, 'etc', 'apt')
-        
-        # Prepare configuration file to redirect location of /etc/apt in apt-get
-        env = setup_config_redirect(os.environ, target_apt_dir)
-        
-        parms = ['apt-get']
-        
-        # Set RootDir to installation medium location
-        parms.append('--option')
-        parms.append('Dir=' + install_medium)
-        
-        # Load target's apt-medium.conf file
-        parms.append('--config-file')
-        parms.append(os.path.join(target_apt_dir, 'apt-medium.conf'))
-        
-        parms.append('--download-only')
-        
-        if force:
-            parms.append('--force-yes')
-        else:
-            parms.append('--assume-yes')
-        
-        if allow_unauth:
-            parms.append('--allow-unauthenticated')
-        
-        parms.append(action)
-        if addtnl_params:
-            parms.extend(addtnl_params)
-        
-        proc = subprocess.Popen(parms, env=env)
-        
-        if proc.wait() != 0:
-            print('\napt-get failed while downloading packages for target: ' +  target + ' action: ' + action + ' addtnl_params: ' + " ".join(addtnl_params))
-            success = False
-        else:
-            state = load_medium_state()
-            for package in addtnl_params:
-                state['download_queue'][target].remove(package)
-                state['install_queue'][target].append(package)
-            save_medium_state(state)
+    downloads = sorted(uris_to_download)
+    # Downloads are shared between targets, so they can only be fetched natively when every target reaches
+    # its mirrors through the same proxies and with the same credentials
+    acquire = [ target_acquire_config(install_medium, system) for system in sorted(set(a[0] for a in actions_to_perform)) ]
+    if all(is_fetchable(d[0]) for d in downloads) and acquire[0] is not None and all(a == acquire[0] for a in acquire):
+        success = native_download(install_medium, actions_to_perform, target_files, downloads, jobs, allow_unauth, acquire[0])
+    else:
+        # Leave anything that isn't plain http(s) (cdrom, file, tor+http, ...) or a proxy setup only apt can
+        # handle to apt-get's own methods
+        success = apt_get_download(install_medium, actions_to_perform, target_pins, force, allow_unauth)
+    
+    update_archive_index(install_medium)
+    
+    planned = [ system for system in sorted(set(a[0] for a in actions_to_perform)) if write_apply_plan(install_medium, system) ]
+    if planned:
+        print('\nPrepared install plans for: ' + ", ".join(planned))
     
     if success:
         print('\nDownload completed successfully')
@@ -923,5 +1588,350 @@ def download_action(args):
         print('\nOne or more download actions failed')
         return -1
 
+def verify_action(args):
+    install_medium = args.install_medium
+    archives_dir = os.path.join(install_medium, 'archives')
+    
+    if not os.path.isdir(archives_dir):
+        print('No archives directory found on the installation medium (' + install_medium + ')')
+        return -1
+    
+    def lookup_checksums(filenames):
+        # Each archive's name gives the exact package version, so the index only has to be searched for those
+        checksums = {}
+        with load_package_index(install_medium) as index:
+            for filename in filenames:
+                name, version, arch = split_archive_filename(filename)
+                checksum = index.checksum(filename, name, version, arch or None) if version else None
+                if checksum:
+                    checksums[filename] = checksum
+        return checksums
+    
+    manifest_file = medium_data_file(install_medium, 'archives-manifest')
+    manifest = load_pickle(manifest_file, {})
+    try:
+        results, cached = verify_archives(archives_dir, manifest, lookup_checksums, args.jobs)
+    finally:
+        save_pickle(manifest_file, manifest)
+    
+    corrupt = sorted(f for f in results if results[f] == CORRUPT)
+    unknown = sorted(f for f in results if results[f] == UNKNOWN)
+    
+    for filename in unknown:
+        print('No checksum known for ' + filename)
+    for filename in corrupt:
+        print('Checksum mismatch: ' + filename)
+        if args.remove:
+            os.unlink(os.path.join(archives_dir, filename))
+            print('Removed ' + filename)
+    if corrupt and args.remove:
+        update_archive_index(install_medium)
+    
+    print('Checked ' + str(len(results)) + ' packages (' + str(cached) + ' unchanged since last verified), ' +
+          str(len(corrupt)) + ' failed, ' + str(len(unknown)) + ' could not be checked')
+    
+    return -1 if corrupt else 0
+
+def gc_action(args):
+    install_medium = args.install_medium
+    archives_dir = os.path.join(install_medium, 'archives')
+    
+    budget = None
+    if args.max_size:
+        budget = parse_size(args.max_size)
+        if budget is None:
+            print('Invalid size: ' + args.max_size)
+            return -1
+    
+    state = load_medium_state()
+    
+    # Count the targets still referencing each archive: the versions they have installed and the transactions queued for them
+    resolve_cache = medium_data_file(install_medium, 'resolve-cache')
+    refcounts = {}
+    queued = set() # (name, arch, version) of packages queued without pins, any archive they could pick is kept
+    for target in state['install_queue']:
+        referenced = set()
+        status_file = os.path.join(install_medium, 'system_info', target, 'dpkg-status')
+        if os.path.isfile(status_file):
+            referenced.update(installed_archives(status_file))
+        for queue in ('install_queue', 'download_queue'):
+            pins = load_pins(queue, target)
+            if not pins and state[queue][target]:
+                # A queue without pins needs its dependencies as much as the packages it names, so work out the
+                # whole transaction (the cached resolution if there is one, as download would)
+                pins = resolve_download_group(install_medium, resolve_cache, target, state[queue][target], target_lists(install_medium, target))
+                if pins is None:
+                    print('Cannot work out which packages the ' + queue.replace('_', ' ') + ' of ' + target + ' needs, not removing anything')
+                    return -1
+                queued.update(parse_queue_entry(entry) for entry in state[queue][target])
+            referenced.update(p.filename for p in pins)
+        for filename in referenced:
+            refcounts[filename] = refcounts.get(filename, 0) + 1
+    
+    def is_referenced(filename):
+        if refcounts.get(filename, 0) > 0:
+            return True
+        name, version, arch = split_archive_filename(filename)
+        return any(queue_entry_matches(entry, name, version, arch) for entry in queued)
+    
+    manifest_file = medium_data_file(install_medium, 'archives-manifest')
+    manifest = load_pickle(manifest_file, {})
+    
+    removed, freed, used = collect_garbage(archives_dir, is_referenced, budget, args.dry_run)
+    
+    for filename in removed:
+        print(('Would remove ' if args.dry_run else 'Removed ') + filename)
+        manifest.pop(filename, None)
+    if not args.dry_run:
+        save_pickle(manifest_file, manifest)
+        update_archive_index(install_medium)
+    
+    print(('Would free ' if args.dry_run else 'Freed ') + '{:,}'.format(freed) + ' bytes, archives ' +
+          ('would use ' if args.dry_run else 'now use ') + '{:,}'.format(used) + ' bytes')
+    if budget is not None and used > budget:
+        print('Packages still referenced by targets exceed the size limit of ' + '{:,}'.format(budget) + ' bytes')
+    
+    return 0
+
+
+def sync_action(args):
+    install_medium = args.install_medium
+    other_medium = os.path.abspath(args.other_medium)
+    
+    if not os.path.isdir(other_medium):
+        print('The other installation medium (' + other_medium + ') does not exist')
+        return -1
+    if os.path.samefile(install_medium, other_medium):
+        print('Cannot sync an installation medium with itself')
+        return -1
+    
+    batch_size = parse_size(args.batch_size)
+    if not batch_size:
+        print('Invalid size: ' + args.batch_size)
+        return -1
+    
+    # Hash both media (only files that changed since the last sync, or archives already verified, are read)
+    media = (install_medium, other_medium)
+    cache_files = [ medium_data_file(medium, 'sync-manifest') for medium in media ]
+    checksum_files = [ medium_data_file(medium, 'archives-manifest') for medium in media ]
+    manifests = [ scan_medium(medium, load_pickle(cache_file, {}), load_pickle(checksum_file, {}))
+                  for medium, cache_file, checksum_file in zip(media, cache_files, checksum_files) ]
+    for cache_file, manifest in zip(cache_files, manifests):
+        save_pickle(cache_file, manifest)
+    
+    transfers = compare_manifests(manifests[0], manifests[1])
+    directions = ((0, 1, transfers[0]), (1, 0, transfers[1]))
+    for src, dst, relpaths in directions:
+        size = sum(manifests[src][relpath][0] for relpath in relpaths)
+        print(('Would copy ' if args.dry_run else 'Copying ') + str(len(relpaths)) + ' files (' + '{:,}'.format(size) + ' bytes) to ' + media[dst])
+        if args.dry_run:
+            for relpath in relpaths:
+                print('  ' + relpath)
+    conflicts = transfers[2]
+    for relpath in conflicts:
+        print('Not copying ' + relpath + ', the copies differ but were modified at the same time. Remove the wrong one and sync again')
+    if args.dry_run:
+        return -1 if conflicts else 0
+    
+    for src, dst, relpaths in directions:
+        copy_files(media[src], media[dst], relpaths, manifests[src], batch_size)
+        
+        # The copies are known to match the hashes just taken, so neither sync nor verify needs to read them again
+        cache = load_pickle(cache_files[dst], {})
+        checksums = load_pickle(checksum_files[dst], {})
+        for relpath in relpaths:
+            cache[relpath] = manifests[src][relpath]
+            if os.path.dirname(relpath) == 'archives':
+                record_verified(checksums, os.path.join(media[dst], 'archives'), os.path.basename(relpath), 'SHA256:' + manifests[src][relpath][2])
+        save_pickle(cache_files[dst], cache)
+        save_pickle(checksum_files[dst], checksums)
+    
+    # Each medium ends up with every target and queued package either of them had
+    state_files = [ os.path.join(medium, 'medium_state') for medium in media ]
+    queues = []
+    for state_file in state_files:
+        conn = connect(state_file)
+        try:
+            queues.append(dump_queues(conn))
+        finally:
+            conn.close()
+    for state_file, other_queues in zip(state_files, reversed(queues)):
+        with transaction(state_file) as conn:
+            merge_queues(conn, other_queues)
+    print('Merged the install and download queues of ' + str(len(set(queues[0]) | set(queues[1]))) + ' targets')
+    
+    for medium in media:
+        update_archive_index(medium)
+    
+    if conflicts:
+        print(str(len(conflicts)) + ' files were left out, see above')
+        return -1
+    return 0
+
+def export_action(args):
+    install_medium = args.install_medium
+    target = args.target
+    
+    # The bundle itself may be going to standard output, so everything else goes to standard error
+    def report(message):
+        print(message, file=sys.stderr)
+    
+    conn = connect('medium_state')
+    try:
+        queues = dict((hostname, target_queues) for hostname, target_queues in dump_queues(conn).items() if hostname == target)
+    finally:
+        conn.close()
+    target_info_dir = os.path.join('system_info', target)
+    if target not in queues or not os.path.isdir(target_info_dir):
+        report('Cannot find target (' + target + ') on medium (' + install_medium + ') check that your spelling is correct and that the target has been initialized on the medium')
+        return -1
+    
+    # The target's system info and apt configuration, as init left it (apt's lock files and caches are recreated as needed)
+    relpaths = []
+    for dirpath, dirnames, filenames in os.walk(target_info_dir):
+        dirnames.sort()
+        relpaths.extend(os.path.join(dirpath, f) for f in sorted(filenames)
+                        if f not in ('lock', 'lock-frontend') and not f.endswith('.bin') and os.path.isfile(os.path.join(dirpath, f)))
+    
+    # The install plan made for it by download, if any
+    plan = os.path.relpath(plan_file(medium_data_file(install_medium, 'plans'), target), install_medium)
+    if os.path.isfile(plan):
+        relpaths.append(plan)
+    
+    # The package lists its sources use
+    lists = target_lists(install_medium, target)
+    if lists is None:
+        report('Cannot tell which package lists ' + target + ' uses, exporting all of them')
+        lists = [ f for f in os.listdir('lists') if f != 'lock' and os.path.isfile(os.path.join('lists', f)) ]
+    relpaths.extend(os.path.join('lists', f) for f in sorted(lists))
+    
+    # Every archive the resolved transactions in its queues call for that is on the medium
+    unresolved = []
+    missing = []
+    archives = set()
+    for queue in ('install_queue', 'download_queue'):
+        packages, pins = queues[target][queue]
+        if packages and not pins:
+            unresolved.extend(packages)
+        for pin in pins:
+            filename = PlannedPackage(*pin).filename
+            if os.path.isfile(os.path.join('archives', filename)):
+                archives.add(filename)
+            else:
+                missing.append(filename)
+    relpaths.extend(os.path.join('archives', filename) for filename in sorted(archives))
+    
+    compression = args.compression or guess_compression(args.output)
+    try:
+        if args.output == '-':
+            out = getattr(sys.stdout, 'buffer', sys.stdout)
+            written = write_bundle(out, install_medium, relpaths, queues, compression)
+            out.flush()
+        else:
+            with open(args.output, 'wb') as out:
+                written = write_bundle(out, install_medium, relpaths, queues, compression)
+    except (IOError, OSError, tarfile.TarError) as e:
+        report('Failed to write bundle: ' + str(e))
+        return -1
+    
+    report('Exported ' + str(len(archives)) + ' packages, ' + str(len(lists)) + ' package lists and the system info of ' + target +
+           ' (' + '{:,}'.format(written) + ' bytes)')
+    if missing:
+        report(str(len(sorted(set(missing)))) + ' packages ' + target + ' needs have not been downloaded yet')
+    if unresolved:
+        report('Queued packages without a resolved transaction (run "install" for them again to include their dependencies): ' + ', '.join(unresolved))
+    
+    return 0
+
+def import_action(args):
+    install_medium = args.install_medium
+    
+    def progress(relpath, size):
+        print('Imported ' + relpath)
+    
+    try:
+        if args.bundle == '-':
+            infile = getattr(sys.stdin, 'buffer', sys.stdin)
+            queues, verified, rejected = read_bundle(infile, install_medium, progress=progress)
+        else:
+            with open(args.bundle, 'rb') as infile:
+                queues, verified, rejected = read_bundle(infile, install_medium, progress=progress)
+    except (BundleError, IOError, OSError, tarfile.TarError, ValueError) as e:
+        print('Failed to import bundle: ' + str(e))
+        return -1
+    
+    for filename in rejected:
+        print('Checksum mismatch, not imported: ' + filename)
+    
+    # Archives were hashed on the way in, so record them as verified rather than reading them again later
+    archives_dir = os.path.join(install_medium, 'archives')
+    if not os.path.isdir(os.path.join(archives_dir, 'partial')):
+        os.makedirs(os.path.join(archives_dir, 'partial'))
+    manifest_file = medium_data_file(install_medium, 'archives-manifest')
+    manifest = load_pickle(manifest_file, {})
+    for filename in sorted(verified):
+        record_verified(manifest, archives_dir, filename, verified[filename])
+    save_pickle(manifest_file, manifest)
+    update_archive_index(install_medium)
+    
+    with transaction('medium_state') as conn:
+        merge_queues(conn, queues)
+    print('Imported the queues of ' + ', '.join(sorted(queues)))
+    
+    return -1 if rejected else 0
+
+def prune_lists_action(args):
+    install_medium = args.install_medium
+    lists_dir = os.path.join(install_medium, 'lists')
+    
+    state = load_medium_state()
+    
+    # Work out which lists each target's sources use, if that's unknown for any target nothing can be pruned safely
+    referenced = set()
+    for target in state['install_queue']:
+        if not os.path.isdir(os.path.join(install_medium, 'system_info', target, 'etc', 'apt')):
+            continue
+        lists = target_lists(install_medium, target)
+        if lists is None:
+            print('Could not determine the package lists used by ' + target)
+            return -1
+        referenced.update(lists)
+    
+    # Drop cached references for apt configurations no target has any more
+    keys = set(etc_fingerprint(os.path.join(install_medium, 'system_info', target, 'etc', 'apt'), target) for target in state['install_queue'])
+    cache_file = medium_data_file(install_medium, 'list-references')
+    cache = load_pickle(cache_file, {})
+    if set(cache) - keys:
+        save_pickle(cache_file, dict((key, names) for key, names in cache.items() if key in keys))
+    
+    unreferenced = sorted(f for f in os.listdir(lists_dir)
+                          if f != 'lock' and f not in referenced and os.path.isfile(os.path.join(lists_dir, f)))
+    
+    archive_dir = medium_data_file(install_medium, 'lists-archive')
+    if unreferenced and not args.dry_run and not args.delete and not os.path.isdir(archive_dir):
+        os.mkdir(archive_dir)
+    
+    size = 0
+    for f in unreferenced:
+        path = os.path.join(lists_dir, f)
+        size += os.path.getsize(path)
+        if args.dry_run:
+            print('Would remove ' + f)
+        elif args.delete:
+            os.unlink(path)
+            print('Removed ' + f)
+        else:
+            os.rename(path, os.path.join(archive_dir, f))
+            print('Archived ' + f)
+    
+    if not args.dry_run:
+        # Keep the package index in step with the lists left behind
+        update_index(lists_dir, medium_data_file(install_medium, 'pkgindex'))
+    
+    print(str(len(unreferenced)) + ' unused lists (' + '{:,}'.format(size) + ' bytes), ' + str(len(referenced)) + ' lists in use')
+    
+    return 0
+
+
 if __name__ == '__main__':
     main()
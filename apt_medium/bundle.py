@@ -0,0 +1,171 @@
+"""
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+    Copyright (c) 2018 Riley Baxter
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import hashlib
+import io
+import json
+import os
+import stat
+import tarfile
+import time
+
+from . import trace
+
+# A bundle is a tar stream holding one target's share of a medium, laid out as on the medium, plus its queues
+# (as from state.dump_queues) in QUEUES_MEMBER, which always comes first so imports can check archives as they arrive
+QUEUES_MEMBER = 'apt-medium-queues.json'
+
+# Directories a bundle may write to on import
+BUNDLE_DIRS = ('archives', 'lists', 'system_info', os.path.join('var', 'lib', 'apt-medium', 'plans'))
+
+COMPRESSIONS = ('none', 'gz', 'bz2', 'xz')
+COMPRESSION_EXTS = {'.gz': 'gz', '.tgz': 'gz', '.bz2': 'bz2', '.tbz2': 'bz2', '.xz': 'xz', '.txz': 'xz'}
+
+CHUNK_SIZE = 1024 * 1024
+
+class BundleError(Exception):
+    pass
+
+def guess_compression(path):
+    # Compression implied by a bundle's file name, 'none' for anything else (including stdout)
+    return COMPRESSION_EXTS.get(os.path.splitext(path)[1].lower(), 'none')
+
+def encode_queues(queues):
+    return json.dumps(dict((hostname, dict((queue, {'packages': packages, 'pins': [ list(pin) for pin in pins ]})
+                                           for queue, (packages, pins) in target_queues.items()))
+                           for hostname, target_queues in queues.items()), sort_keys=True).encode('utf-8')
+
+def decode_queues(data):
+    return dict((hostname, dict((queue, (entry['packages'], [ tuple(pin) for pin in entry['pins'] ]))
+                                for queue, entry in target_queues.items()))
+                for hostname, target_queues in json.loads(data.decode('utf-8')).items())
+
+def write_bundle(out, medium, relpaths, queues, compression='none'):
+    # Streams relpaths (relative to medium) and queues as a tar to the file object out, reading each file
+    # straight from the medium. Returns the number of bytes of file data written.
+    written = 0
+    with tarfile.open(fileobj=out, mode='w|' + ('' if compression == 'none' else compression)) as tar:
+        data = encode_queues(queues)
+        info = tarfile.TarInfo(QUEUES_MEMBER)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        tar.addfile(info, io.BytesIO(data))
+        for relpath in relpaths:
+            path = os.path.join(medium, relpath)
+            with trace.span('bundle ' + os.path.basename(relpath), 'sync', path=path) as s:
+                info = tar.gettarinfo(path, relpath)
+                info.uid = info.gid = 0
+                info.uname = info.gname = 'root'
+                with open(path, 'rb') as f:
+                    tar.addfile(info, f)
+                s.set(bytes=info.size)
+            written += info.size
+    return written
+
+def member_path(name):
+    # Where a bundle member goes on the medium (relative), None if it has no business being written there
+    parts = [ part for part in name.split('/') if part not in ('', '.') ]
+    if not parts or '..' in parts or name.startswith('/'):
+        return None
+    relpath = os.path.join(*parts)
+    for top in BUNDLE_DIRS:
+        if relpath.startswith(top + os.sep):
+            return relpath
+    return None
+
+def extract_member(tar, member, dst, hasher=None):
+    # Writes a member to dst via a temporary file, keeping its mtime and permissions
+    tmp_dst = os.path.join(os.path.dirname(dst), '.' + os.path.basename(dst) + '.tmp')
+    src = tar.extractfile(member)
+    try:
+        with open(tmp_dst, 'wb') as f:
+            while True:
+                chunk = src.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+                if hasher:
+                    hasher.update(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_dst, stat.S_IMODE(member.mode) | stat.S_IRUSR | stat.S_IWUSR)
+        os.utime(tmp_dst, (member.mtime, member.mtime))
+    except BaseException as _:
+        if os.path.exists(tmp_dst):
+            os.unlink(tmp_dst)
+        raise
+    return tmp_dst
+
+def read_bundle(infile, medium, compression='*', progress=None):
+    # Unpacks a bundle from the file object infile into medium, leaving files the medium already has alone.
+    # Archives pinned in the bundle's queues are checked against their SHA256 on the way in and left out
+    # if they don't match.
+    # Returns (queues, {archive filename: checksum} of the verified archives, [rejected filenames]).
+    queues = None
+    checksums = {}
+    verified = {}
+    rejected = []
+    try:
+        tar = tarfile.open(fileobj=infile, mode='r|' + compression)
+    except tarfile.TarError as e:
+        raise BundleError('Not an apt-medium bundle: ' + str(e))
+    with tar:
+        for member in tar:
+            if member.name == QUEUES_MEMBER:
+                queues = decode_queues(tar.extractfile(member).read())
+                for target_queues in queues.values():
+                    for packages, pins in target_queues.values():
+                        for pin in pins:
+                            checksums[pin[4]] = pin[6]
+                continue
+            if queues is None:
+                raise BundleError('Not an apt-medium bundle: ' + QUEUES_MEMBER + ' missing')
+            relpath = member_path(member.name)
+            if relpath is None or not (member.isfile() or member.isdir()):
+                raise BundleError('Refusing to unpack ' + member.name)
+            dst = os.path.join(medium, relpath)
+            if member.isdir():
+                if not os.path.isdir(dst):
+                    os.makedirs(dst)
+                continue
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            if os.path.isfile(dst) and os.path.getmtime(dst) >= member.mtime:
+                # Already there (or a newer copy is), don't write it again
+                continue
+
+            filename = os.path.basename(relpath)
+            checksum = checksums.get(filename, '') if os.path.dirname(relpath) == 'archives' else ''
+            hasher = hashlib.sha256() if checksum.upper().startswith('SHA256:') else None
+            with trace.span('unbundle ' + filename, 'sync', path=dst, bytes=member.size):
+                tmp_dst = extract_member(tar, member, dst, hasher)
+            if hasher and hasher.hexdigest() != checksum.split(':', 1)[1].lower():
+                os.unlink(tmp_dst)
+                rejected.append(filename)
+                continue
+            os.rename(tmp_dst, dst)
+            if hasher:
+                verified[filename] = checksum
+            if progress:
+                progress(relpath, member.size)
+    if queues is None:
+        raise BundleError('Not an apt-medium bundle: ' + QUEUES_MEMBER + ' missing')
+    return (queues, verified, rejected)
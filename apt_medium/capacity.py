@@ -0,0 +1,69 @@
+"""
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+    Copyright (c) 2018 Riley Baxter
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+
+def free_space(path):
+    # Bytes an unprivileged user can still write on the filesystem holding path
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+def space_needed(archives_dir, filename, size):
+    # Bytes a download still has to write, less whatever a resumable partial file already holds
+    partial = os.path.join(archives_dir, 'partial', filename)
+    if os.path.isfile(partial):
+        return max(0, size - os.path.getsize(partial))
+    return size
+
+def choose_targets(target_files, file_sizes, available, priority=()):
+    # Picks the targets whose downloads can all be completed within available bytes.
+    # Targets in priority are considered first, in that order. The rest are taken cheapest first,
+    # counting files shared with targets already chosen as free, so as many targets as possible
+    # get everything they need. Returns (chosen targets, deferred targets)
+    chosen = []
+    planned = set()
+    used = 0
+
+    def cost(target):
+        return sum(file_sizes[f] for f in target_files[target] - planned)
+
+    remaining = set(target_files)
+    for target in priority:
+        if target not in remaining:
+            continue
+        remaining.remove(target)
+        target_cost = cost(target)
+        if used + target_cost <= available:
+            chosen.append(target)
+            planned.update(target_files[target])
+            used += target_cost
+    deferred = [ t for t in priority if t in target_files and t not in chosen ]
+
+    while remaining:
+        target_cost, target = min((cost(t), t) for t in remaining)
+        if used + target_cost > available:
+            break
+        remaining.remove(target)
+        chosen.append(target)
+        planned.update(target_files[target])
+        used += target_cost
+    deferred.extend(sorted(remaining))
+
+    return (chosen, deferred)
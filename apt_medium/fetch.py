@@ -0,0 +1,413 @@
+"""
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+    Copyright (c) 2018 Riley Baxter
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import base64
+import collections
+import glob
+import hashlib
+import os
+import re
+import threading
+
+from . import trace
+
+try:
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+except ImportError as _:
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+
+try:
+    from urllib.parse import unquote, urljoin, urlsplit
+    from urllib.request import getproxies, proxy_bypass
+except ImportError as _:
+    from urlparse import urljoin, urlsplit
+    from urllib import getproxies, proxy_bypass, unquote
+
+try:
+    import queue
+except ImportError as _:
+    import Queue as queue
+
+CHUNK_SIZE = 1024 * 1024
+MAX_REDIRECTS = 5
+USER_AGENT = 'apt-medium'
+
+# Hash names as printed by apt-get --print-uris mapped to hashlib names
+HASH_TYPES = {'md5sum': 'md5', 'sha1': 'sha1', 'sha256': 'sha256', 'sha512': 'sha512'}
+
+class FetchError(Exception):
+    pass
+
+def parse_uri_item(item):
+    # Turn a split line of apt-get --print-uris output into (uri, filename, size, checksum)
+    uri = item[0].strip("'")
+    checksum = item[3] if len(item) > 3 else ''
+    return (uri, item[1], int(item[2]), checksum)
+
+def is_fetchable(uri):
+    return urlsplit(uri).scheme in ('http', 'https')
+
+def new_hasher(checksum):
+    # Returns a hash object matching the checksum reported by apt-get (or None if there isn't one)
+    if ':' not in checksum:
+        return None
+    hash_type = checksum.split(':', 1)[0].lower()
+    if hash_type not in HASH_TYPES:
+        return None
+    return hashlib.new(HASH_TYPES[hash_type])
+
+def checksum_matches(hasher, checksum):
+    return hasher.hexdigest().lower() == checksum.split(':', 1)[1].lower()
+
+# How a target's apt reaches its mirrors, as read from its configuration by acquire_config:
+#   proxies:     {scheme: proxy URI, (scheme, host): proxy URI or 'DIRECT'} from Acquire::http(s)::Proxy(::host)
+#   credentials: [(machine, login, password), ...] from auth.conf and auth.conf.d, in the order apt reads them
+AcquireConfig = collections.namedtuple('AcquireConfig', 'proxies credentials')
+
+PROXY_KEY_RE = re.compile(r'^acquire::(https?)::proxy(?:::(.+))?$')
+
+def parse_auth_conf(text):
+    # auth.conf (netrc format) -> [(machine, login, password), ...]
+    tokens = []
+    for line in text.splitlines():
+        if not line.lstrip().startswith('#'):
+            tokens.extend(line.split())
+    entries = []
+    entry = None
+    while tokens:
+        token = tokens.pop(0)
+        if token == 'machine' and tokens:
+            entry = {'machine': tokens.pop(0)}
+            entries.append(entry)
+        elif token in ('login', 'password') and tokens and entry is not None:
+            entry[token] = tokens.pop(0)
+    return [ (e['machine'], e.get('login', ''), e.get('password', '')) for e in entries ]
+
+def acquire_config(config, etc_dir):
+    # AcquireConfig for a target, given its apt configuration (as from plans.parse_apt_config) and the directory
+    # its Dir::Etc points at. None if apt reaches mirrors in a way only apt-get itself can (proxy auto-detection
+    # or a proxy that isn't plain http).
+    values = dict(config)
+    proxies = {}
+    for key, value in config:
+        if 'proxy-auto-detect' in key and value:
+            return None
+        match = PROXY_KEY_RE.match(key)
+        if not match or not value:
+            continue
+        if value != 'DIRECT' and urlsplit(value).scheme != 'http':
+            return None
+        proxies[match.group(1) if match.group(2) is None else (match.group(1), match.group(2))] = value
+
+    paths = []
+    netrc = values.get('dir::etc::netrc', 'auth.conf')
+    if netrc:
+        paths.append(os.path.join(etc_dir, netrc))
+    parts = values.get('dir::etc::netrcparts', 'auth.conf.d')
+    if parts:
+        paths.extend(sorted(glob.glob(os.path.join(etc_dir, parts, '*.conf'))))
+    credentials = []
+    for path in paths:
+        try:
+            with open(path) as f:
+                credentials.extend(parse_auth_conf(f.read()))
+        except (IOError, OSError) as _:
+            pass
+    return AcquireConfig(proxies, credentials)
+
+def basic_auth(login, password):
+    return 'Basic ' + base64.b64encode((login + ':' + password).encode('utf-8')).decode('ascii')
+
+def split_userinfo(netloc):
+    # netloc -> (host[:port], login or None, password)
+    if '@' not in netloc:
+        return (netloc, None, '')
+    userinfo, host = netloc.rsplit('@', 1)
+    login, _, password = userinfo.partition(':')
+    return (host, unquote(login), unquote(password))
+
+def machine_matches(machine, parts):
+    # Whether an auth.conf machine ("host", "host:port", "host/path" or "scheme://host...") covers the URI parts.
+    # As in apt, entries that don't name a scheme are never sent over plain http.
+    if '://' in machine:
+        scheme, machine = machine.split('://', 1)
+        if scheme != parts.scheme:
+            return False
+    elif parts.scheme == 'http':
+        return False
+    host, _, path = machine.partition('/')
+    if ':' in host:
+        if host != (parts.hostname or '') + ':' + str(parts.port):
+            return False
+    elif host != parts.hostname:
+        return False
+    return (parts.path or '/').startswith('/' + path)
+
+def authorization(credentials, parts):
+    # Authorization header value for a request, from the URI's own user:password or else auth.conf, None for neither
+    host, login, password = split_userinfo(parts.netloc)
+    if login is not None:
+        return basic_auth(login, password)
+    for machine, login, password in credentials:
+        if machine_matches(machine, parts):
+            return basic_auth(login, password)
+    return None
+
+class ConnectionCache(object):
+    # One set of persistent connections per worker thread, keyed on scheme and host.
+    # acquire (an AcquireConfig) has the target's own proxies and credentials, without it only the
+    # proxies in the environment are used.
+    def __init__(self, acquire=None):
+        self.connections = {}
+        self.proxies = getproxies()
+        self.acquire = acquire or AcquireConfig({}, [])
+
+    def proxy_for(self, scheme, host):
+        # Proxy URI for a host, None to connect directly. apt's own settings come before the environment's.
+        hostname = host.split(':')[0]
+        proxy = self.acquire.proxies.get((scheme, hostname.lower()), self.acquire.proxies.get(scheme))
+        if proxy is None:
+            proxy = self.proxies.get(scheme)
+            if proxy and proxy_bypass(hostname):
+                proxy = None
+        return None if proxy == 'DIRECT' else proxy
+
+    def get(self, scheme, netloc):
+        key = (scheme, netloc)
+        if key not in self.connections:
+            self.connections[key] = self.connect(scheme, netloc)
+        return self.connections[key]
+
+    def connect(self, scheme, netloc):
+        # Returns (connection, whether requests go to a proxy with the absolute URI, proxy Authorization or None)
+        host = split_userinfo(netloc)[0]
+        proxy = self.proxy_for(scheme, host)
+        if proxy:
+            proxy_netloc, login, password = split_userinfo(urlsplit(proxy).netloc)
+            proxy_auth = basic_auth(login, password) if login is not None else None
+            if scheme == 'https':
+                conn = HTTPSConnection(proxy_netloc, timeout=60)
+                conn.set_tunnel(host, headers={'Proxy-Authorization': proxy_auth} if proxy_auth else None)
+                return (conn, False, None)
+            return (HTTPConnection(proxy_netloc, timeout=60), True, proxy_auth)
+        if scheme == 'https':
+            return (HTTPSConnection(host, timeout=60), False, None)
+        return (HTTPConnection(host, timeout=60), False, None)
+
+    def drop(self, scheme, netloc):
+        key = (scheme, netloc)
+        if key in self.connections:
+            self.connections.pop(key)[0].close()
+
+    def close(self):
+        for conn, _, _ in self.connections.values():
+            conn.close()
+        self.connections = {}
+
+def open_uri(connections, uri, headers=None):
+    # Issues a GET for uri (following redirects) and returns the response, reusing connections where possible
+    request_headers = {'User-Agent': USER_AGENT}
+    if headers:
+        request_headers.update(headers)
+
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urlsplit(uri)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        # Proxies are sent the absolute URI, without any credentials in it
+        absolute_uri = parts.scheme + '://' + split_userinfo(parts.netloc)[0] + path
+        # Credentials only go to the host they were given for, not to wherever it redirects
+        send_headers = dict(request_headers)
+        auth = authorization(connections.acquire.credentials, parts)
+        if auth:
+            send_headers['Authorization'] = auth
+
+        # A kept-alive connection may have been closed by the server while idle, so retry once on a fresh one
+        for attempt in range(2):
+            conn, absolute, proxy_auth = connections.get(parts.scheme, parts.netloc)
+            if proxy_auth:
+                send_headers['Proxy-Authorization'] = proxy_auth
+            try:
+                conn.request('GET', absolute_uri if absolute else path, headers=send_headers)
+                response = conn.getresponse()
+                break
+            except (HTTPException, IOError, OSError) as e:
+                connections.drop(parts.scheme, parts.netloc)
+                if attempt == 1:
+                    raise FetchError('Could not connect to ' + split_userinfo(parts.netloc)[0] + ': ' + str(e))
+
+        if response.status in (301, 302, 303, 307, 308):
+            location = response.getheader('Location')
+            response.read()
+            if not location:
+                raise FetchError('Redirect without location for ' + uri)
+            uri = urljoin(uri, location)
+            continue
+
+        return response
+
+    raise FetchError('Too many redirects for ' + uri)
+
+def hash_partial(partial_file, hasher):
+    # Feed what is already on disk into the hash so a resumed download is still verified end to end
+    with open(partial_file, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+
+def resume_offset(response, offset):
+    # Returns the offset the server is actually sending from, or None if it can't be appended to what we have
+    if response.status == 200:
+        return 0
+    if response.status == 206:
+        content_range = response.getheader('Content-Range') or ''
+        match = re.match(r'bytes\s+(\d+)-', content_range)
+        if match and int(match.group(1)) == offset:
+            return offset
+    return None
+
+def download_to_partial(connections, uri, partial_file, size, checksum):
+    # Downloads uri into partial_file, continuing from any data already there
+    # Returns the hash object for the complete file (or None if apt-get didn't report a checksum)
+    hasher = new_hasher(checksum)
+
+    offset = os.path.getsize(partial_file) if os.path.isfile(partial_file) else 0
+    if offset > size:
+        os.unlink(partial_file)
+        offset = 0
+
+    if offset > 0 and hasher:
+        hash_partial(partial_file, hasher)
+
+    if offset == size:
+        return hasher
+
+    response = open_uri(connections, uri, {'Range': 'bytes=' + str(offset) + '-'} if offset else None)
+    if response.status == 416 and offset:
+        # The server's copy doesn't extend past what we have, so the partial file can't belong to it
+        response.read()
+        os.unlink(partial_file)
+        return download_to_partial(connections, uri, partial_file, size, checksum)
+    if response.status not in (200, 206):
+        response.read()
+        raise FetchError(str(response.status) + ' ' + response.reason)
+
+    start = resume_offset(response, offset)
+    if start is None:
+        response.read()
+        raise FetchError('Unexpected range in response (' + str(response.getheader('Content-Range')) + ')')
+    if start == 0 and offset > 0:
+        # Server ignored the range request, start over
+        hasher = new_hasher(checksum)
+    received = start
+
+    with open(partial_file, 'ab' if start else 'wb') as f:
+        while True:
+            chunk = response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            f.write(chunk)
+            if hasher:
+                hasher.update(chunk)
+            received += len(chunk)
+            if received > size:
+                break
+
+    if received < size:
+        # Keep what we got so the next attempt can pick up from here
+        raise FetchError('Transfer interrupted (got ' + str(received) + ' of ' + str(size) + ' bytes)')
+
+    return hasher
+
+def fetch_file(connections, uri, filename, size, checksum, archives_dir):
+    partial_file = os.path.join(archives_dir, 'partial', filename)
+    final_file = os.path.join(archives_dir, filename)
+
+    # A partial file that fails verification may just be stale or corrupt, so discard it and fetch once more from scratch
+    resumed = os.path.isfile(partial_file)
+    for attempt in range(2 if resumed else 1):
+        with trace.span('fetch ' + filename, 'network', uri=uri, bytes=size, resumed=resumed and attempt == 0):
+            hasher = download_to_partial(connections, uri, partial_file, size, checksum)
+
+        if os.path.getsize(partial_file) != size:
+            error = 'Size mismatch (expected ' + str(size) + ' bytes, got ' + str(os.path.getsize(partial_file)) + ')'
+        elif hasher and not checksum_matches(hasher, checksum):
+            error = 'Hash sum mismatch'
+        else:
+            # Only complete, verified files ever appear in archives
+            os.rename(partial_file, final_file)
+            return
+
+        os.unlink(partial_file)
+
+    raise FetchError(error)
+
+def fetch_all(downloads, archives_dir, jobs=4, progress=None, acquire=None):
+    # Fetches a list of (uri, filename, size, checksum) into archives_dir using up to jobs concurrent connections,
+    # through the proxies and with the credentials in acquire (an AcquireConfig) if given
+    # Returns a dict of filename -> error message for every download that failed
+    # Targets using different mirrors can ask for the same file, only fetch it once
+    unique = {}
+    for download in sorted(downloads):
+        unique.setdefault(download[1], download)
+
+    work = queue.Queue()
+    # Keep each host's files together so a worker tends to stay on a connection it already has open
+    for download in sorted(unique.values(), key=lambda d: (urlsplit(d[0]).netloc, d[1])):
+        work.put(download)
+
+    failures = {}
+    lock = threading.Lock()
+
+    def worker():
+        connections = ConnectionCache(acquire)
+        try:
+            while True:
+                try:
+                    uri, filename, size, checksum = work.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    fetch_file(connections, uri, filename, size, checksum, archives_dir)
+                    error = None
+                except (FetchError, HTTPException, IOError, OSError) as e:
+                    error = str(e) or e.__class__.__name__
+                    # Don't reuse a connection that may be left in an unknown state
+                    connections.drop(urlsplit(uri).scheme, urlsplit(uri).netloc)
+                with lock:
+                    if error:
+                        failures[filename] = error
+                    if progress:
+                        progress(uri, filename, size, error)
+        finally:
+            connections.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, min(jobs, len(unique))))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+    return failures
@@ -0,0 +1,93 @@
+"""
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+    Copyright (c) 2018 Riley Baxter
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import re
+
+from .packages import archive_filename, iter_stanzas
+
+SIZE_RE = re.compile(r'^([0-9]+)([KMGT]?)B?$')
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+# Package arguments as queued, e.g. "foo", "foo:amd64", "foo=1.0", "foo:i386=1:2.0-1", "foo/bookworm-backports"
+QUEUE_ENTRY_RE = re.compile(r'^([^:=/]+)(?::([^=/]+))?(?:=(.+)|/.+)?$')
+
+def parse_size(text):
+    # '64G', '500M', '1024' -> bytes (binary units), None if text isn't a size
+    match = SIZE_RE.match(text.strip().upper())
+    if not match:
+        return None
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+def parse_queue_entry(entry):
+    # Queue entry -> (name, arch, version), arch and version None where the entry leaves them to apt-get
+    match = QUEUE_ENTRY_RE.match(entry)
+    if not match:
+        return (entry, None, None)
+    return match.groups()
+
+def queue_entry_matches(entry, name, version, arch):
+    # Whether an archive of name/version/arch is one apt-get could pick for a queue entry (as from parse_queue_entry)
+    entry_name, entry_arch, entry_version = entry
+    return entry_name == name and (entry_arch in (None, arch) or arch == 'all') and entry_version in (None, version)
+
+def installed_archives(status_path):
+    # Archive filenames of the package versions a dpkg status file lists as installed
+    filenames = set()
+    for stanza in iter_stanzas(status_path):
+        if stanza.get('Status', '').split()[-1:] != ['installed'] or 'Version' not in stanza:
+            continue
+        filenames.add(archive_filename(stanza['Package'], stanza['Version'], stanza.get('Architecture', 'all')))
+    return filenames
+
+def collect_garbage(archives_dir, is_referenced, budget=None, dry_run=False):
+    # Removes archives is_referenced(filename) says no target needs, oldest first, until what's left
+    # fits in budget bytes (every unreferenced archive when there is no budget).
+    # Hardlinked archives only count once and only free space once their last name is removed.
+    # Returns (removed filenames, bytes freed, bytes still used)
+    files = []
+    inodes = {} # (device, inode) -> [size, names left]
+    for filename in os.listdir(archives_dir):
+        path = os.path.join(archives_dir, filename)
+        if not filename.endswith('.deb') or not os.path.isfile(path):
+            continue
+        st = os.stat(path)
+        key = (st.st_dev, st.st_ino)
+        files.append((st.st_mtime, filename, key))
+        inode = inodes.setdefault(key, [st.st_size, 0])
+        inode[1] += 1
+
+    used = sum(size for size, _ in inodes.values())
+    removed = []
+    freed = 0
+    for _, filename, key in sorted(files):
+        if budget is not None and used <= budget:
+            break
+        if is_referenced(filename):
+            continue
+        if not dry_run:
+            os.unlink(os.path.join(archives_dir, filename))
+        removed.append(filename)
+        inode = inodes[key]
+        inode[1] -= 1
+        if inode[1] == 0:
+            used -= inode[0]
+            freed += inode[0]
+    return (removed, freed, used)
@@ -0,0 +1,157 @@
+"""
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+    Copyright (c) 2018 Riley Baxter
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import mmap
+import os
+
+from .packages import archive_filename, is_packages_list, iter_stanzas, stanza_checksum
+from .utils import load_pickle, save_pickle
+
+# Bump whenever the layout of the .idx files changes so old indexes get rebuilt
+INDEX_FORMAT = 1
+
+PackageRecord = collections.namedtuple('PackageRecord', ['name', 'version', 'arch', 'filename', 'size', 'checksum', 'path'])
+
+def index_file(index_dir, list_name):
+    return os.path.join(index_dir, list_name + '.idx')
+
+def build_list_index(list_path, idx_path):
+    # Write one tab separated line per package, sorted by package name so lookups can bisect the file
+    lines = []
+    for stanza in iter_stanzas(list_path):
+        if 'Package' not in stanza or 'Version' not in stanza or 'Filename' not in stanza:
+            continue
+        arch = stanza.get('Architecture', 'all')
+        ext = stanza['Filename'].rsplit('.', 1)[-1]
+        fields = [stanza['Package'], stanza['Version'], arch,
+                  archive_filename(stanza['Package'], stanza['Version'], arch, ext),
+                  stanza.get('Size', '0'), stanza_checksum(stanza), stanza['Filename']]
+        lines.append(('\t'.join(fields) + '\n').encode('utf-8'))
+    lines.sort()
+
+    tmp_path = idx_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.writelines(lines)
+    os.rename(tmp_path, idx_path)
+
+def update_index(lists_dir, index_dir):
+    # Brings the index up to date with lists_dir, only re-reading lists that changed since the last run
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    manifest_file = os.path.join(index_dir, 'manifest')
+    manifest = load_pickle(manifest_file, {})
+    if manifest.get('format') != INDEX_FORMAT:
+        manifest = {'format': INDEX_FORMAT, 'lists': {}}
+
+    indexed = manifest['lists']
+    changed = False
+    current = set()
+    for name in os.listdir(lists_dir):
+        if not is_packages_list(name):
+            continue
+        current.add(name)
+        st = os.stat(os.path.join(lists_dir, name))
+        if indexed.get(name) == (st.st_size, st.st_mtime) and os.path.exists(index_file(index_dir, name)):
+            continue
+        build_list_index(os.path.join(lists_dir, name), index_file(index_dir, name))
+        indexed[name] = (st.st_size, st.st_mtime)
+        changed = True
+
+    for name in list(indexed):
+        if name not in current:
+            del indexed[name]
+            if os.path.exists(index_file(index_dir, name)):
+                os.unlink(index_file(index_dir, name))
+            changed = True
+
+    if changed:
+        save_pickle(manifest_file, manifest)
+    return changed
+
+def parse_record(line):
+    fields = line.decode('utf-8').rstrip('\n').split('\t')
+    return PackageRecord(fields[0], fields[1], fields[2], fields[3], int(fields[4]), fields[5], fields[6])
+
+class PackageIndex(object):
+    # Read-only view of the per-list index files, memory mapped so lookups only touch the pages they need
+    def __init__(self, index_dir):
+        self.maps = []
+        manifest = load_pickle(os.path.join(index_dir, 'manifest'), {})
+        for name in sorted(manifest.get('lists', {})):
+            path = index_file(index_dir, name)
+            if not os.path.isfile(path) or os.path.getsize(path) == 0:
+                continue
+            with open(path, 'rb') as f:
+                self.maps.append((name, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)))
+
+    def close(self):
+        for _, mm in self.maps:
+            mm.close()
+        self.maps = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @staticmethod
+    def first_line_at_or_after(mm, key):
+        # Binary search over the sorted lines of mm for the first one whose name is >= key
+        lo, hi = 0, len(mm)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = mm.rfind(b'\n', 0, mid) + 1
+            end = mm.find(b'\n', start)
+            if mm[start:mm.find(b'\t', start)] < key:
+                lo = end + 1
+            else:
+                hi = start
+        return lo
+
+    def lookup(self, name, version=None, arch=None):
+        # All records for package name (optionally narrowed to one version and architecture)
+        key = name.encode('utf-8')
+        records = []
+        for _, mm in self.maps:
+            pos = self.first_line_at_or_after(mm, key)
+            while pos < len(mm):
+                end = mm.find(b'\n', pos)
+                line = mm[pos:end + 1]
+                if line.split(b'\t', 1)[0] != key:
+                    break
+                record = parse_record(line)
+                if (version is None or record.version == version) and (arch is None or record.arch in (arch, 'all')):
+                    records.append(record)
+                pos = end + 1
+        return records
+
+    def find(self, name, version, arch):
+        # The record for one exact package version, or None if no list on the medium has it
+        records = self.lookup(name, version, arch)
+        return records[0] if records else None
+
+    def checksum(self, filename, name, version, arch):
+        # Expected checksum of an archive on the medium (named filename, holding that package version), None if unknown
+        for record in self.lookup(name, version, arch):
+            if record.filename == filename:
+                return record.checksum
+        return None
@@ -0,0 +1,149 @@
+"""
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+    Copyright (c) 2018 Riley Baxter
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import gzip
+import hashlib
+import io
+import os
+import subprocess
+import tarfile
+import time
+
+from . import trace
+from .utils import file_digest, load_pickle, save_pickle
+from .verify import is_verified
+
+# The archives directory doubles as a flat repository ("deb [trusted=yes] file:/path/to/medium/archives ./")
+# holding just the packages that have been downloaded, so targets can resolve against it instead of every upstream list
+PACKAGES_FILE = 'Packages'
+RELEASE_FILE = 'Release'
+
+AR_MAGIC = b'!<arch>\n'
+AR_HEADER_SIZE = 60
+
+def read_ar_member(f, prefix):
+    # Contents of the first member of an ar archive (like a .deb) whose name starts with prefix, and its name
+    if f.read(len(AR_MAGIC)) != AR_MAGIC:
+        return (None, None)
+    while True:
+        header = f.read(AR_HEADER_SIZE)
+        if len(header) < AR_HEADER_SIZE:
+            return (None, None)
+        name = header[:16].decode('ascii', 'replace').strip().rstrip('/')
+        size = int(header[48:58].decode('ascii').strip())
+        if name.startswith(prefix):
+            return (name, f.read(size))
+        f.seek(size + size % 2, io.SEEK_CUR)
+
+def read_control(deb_path):
+    # The control stanza of a .deb, as text. Python reads gzip and xz compressed control members itself,
+    # anything else (e.g. zstd) is left to dpkg-deb.
+    with open(deb_path, 'rb') as f:
+        name, data = read_ar_member(f, 'control.tar')
+    if name is not None and not name.endswith('.zst'):
+        try:
+            with tarfile.open(fileobj=io.BytesIO(data), mode='r:*') as tar:
+                for member in tar.getmembers():
+                    if member.name in ('./control', 'control'):
+                        return tar.extractfile(member).read().decode('utf-8', 'replace').strip('\n')
+        except (tarfile.TarError, IOError, EOFError) as _:
+            pass
+    return trace.check_output(['dpkg-deb', '--field', deb_path]).decode('utf-8', 'replace').strip('\n')
+
+def package_stanza(archives_dir, filename, checksums):
+    # Packages entry for one archive: its control fields followed by where to find it and how to check it
+    path = os.path.join(archives_dir, filename)
+    st = os.stat(path)
+    sha256 = None
+    if is_verified(checksums, filename, st) and checksums[filename][2].upper().startswith('SHA256:'):
+        sha256 = checksums[filename][2].split(':', 1)[1].lower()
+    if sha256 is None:
+        sha256 = file_digest(path)
+    control = read_control(path)
+    return (control + '\nFilename: ./' + filename + '\nSize: ' + str(st.st_size) + '\nSHA256: ' + sha256 + '\n')
+
+def write_file_atomic(path, data):
+    tmp_path = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+def release_text(files):
+    # Release file listing files (name -> contents), enough for apt to use the repository with [trusted=yes]
+    lines = ['Origin: apt-medium',
+             'Label: apt-medium',
+             'Date: ' + time.strftime('%a, %d %b %Y %H:%M:%S UTC', time.gmtime()),
+             'MD5Sum:']
+    for name in sorted(files):
+        lines.append(' ' + hashlib.md5(files[name]).hexdigest() + ' ' + str(len(files[name])) + ' ' + name)
+    lines.append('SHA256:')
+    for name in sorted(files):
+        lines.append(' ' + hashlib.sha256(files[name]).hexdigest() + ' ' + str(len(files[name])) + ' ' + name)
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+def update_local_repo(archives_dir, manifest_file, checksums):
+    # Brings archives/Packages(.gz) and archives/Release in line with the .debs in archives_dir.
+    # Only archives added or changed since the last run are opened, the stanzas of the rest come from
+    # manifest_file. checksums is the verification manifest, so verified archives aren't hashed again.
+    # Returns whether the index changed.
+    manifest = load_pickle(manifest_file, {})
+    changed = False
+    current = set()
+    for filename in os.listdir(archives_dir):
+        path = os.path.join(archives_dir, filename)
+        if not filename.endswith('.deb') or not os.path.isfile(path):
+            continue
+        current.add(filename)
+        st = os.stat(path)
+        entry = manifest.get(filename)
+        if entry is not None and entry[:2] == (st.st_size, st.st_mtime):
+            continue
+        try:
+            stanza = package_stanza(archives_dir, filename, checksums)
+        except (subprocess.CalledProcessError, IOError, OSError, ValueError) as _:
+            # Not a readable package (yet), leave it out
+            if manifest.pop(filename, None) is not None:
+                changed = True
+            continue
+        manifest[filename] = (st.st_size, st.st_mtime, stanza)
+        changed = True
+
+    for filename in list(manifest):
+        if filename not in current:
+            del manifest[filename]
+            changed = True
+
+    packages_path = os.path.join(archives_dir, PACKAGES_FILE)
+    if not changed and os.path.isfile(packages_path):
+        return False
+
+    packages = '\n'.join(manifest[filename][2] for filename in sorted(manifest)).encode('utf-8')
+    packages_gz = io.BytesIO()
+    gz = gzip.GzipFile(filename='', mode='wb', fileobj=packages_gz, mtime=0)
+    gz.write(packages)
+    gz.close()
+    files = {PACKAGES_FILE: packages, PACKAGES_FILE + '.gz': packages_gz.getvalue()}
+    for name in sorted(files):
+        write_file_atomic(os.path.join(archives_dir, name), files[name])
+    write_file_atomic(os.path.join(archives_dir, RELEASE_FILE), release_text(files))
+    save_pickle(manifest_file, manifest)
+    return True
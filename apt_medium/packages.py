@@ -0,0 +1,138 @@
+"""
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+    Copyright (c) 2018 Riley Baxter
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import bz2
+import contextlib
+import gzip
+import os
+import re
+import subprocess
+
+try:
+    import lzma
+except ImportError as _:
+    lzma = None
+
+from . import trace
+
+# Checksum fields of a Packages stanza in order of preference, with the names apt-get --print-uris uses for them
+CHECKSUM_FIELDS = [('SHA256', 'SHA256'), ('SHA512', 'SHA512'), ('SHA1', 'SHA1'), ('MD5sum', 'MD5Sum')]
+
+def quote_string(s, bad):
+    # Same escaping apt applies when naming files in its archives directory (QuoteString)
+    out = []
+    for c in s:
+        if c in bad or c == '%' or ord(c) <= 0x20 or ord(c) >= 0x7F:
+            out.append('%%%02x' % ord(c))
+        else:
+            out.append(c)
+    return ''.join(out)
+
+def archive_filename(package, version, arch, ext='deb'):
+    # Name apt gives a downloaded package in Dir::Cache::archives
+    return quote_string(package, '_:') + '_' + quote_string(version, '_:') + '_' + quote_string(arch, '_:.') + '.' + ext
+
+# Extensions apt may store a list with (Acquire::GzipIndexes)
+LIST_COMPRESSION_EXTS = ('.gz', '.xz', '.bz2', '.lzma', '.lz4', '.zst')
+# Lists worth compressing on the medium, Release files are left as apt-get expects them
+COMPRESSIBLE_LIST_RE = re.compile(r'_(Packages|Sources|Translation-[^._]+)$')
+RELEASE_FILE_RE = re.compile(r'(In)?Release(\.gpg)?$')
+
+def split_list_name(name):
+    # 'x_Packages.gz' -> ('x_Packages', '.gz'), 'x_Packages' -> ('x_Packages', '')
+    base, ext = os.path.splitext(name)
+    if ext in LIST_COMPRESSION_EXTS:
+        return (base, ext)
+    return (name, '')
+
+def referenced_lists(index_names, list_files):
+    # The files among list_files belonging to index_names (as from apt-get indextargets, whatever
+    # their compression), along with the Release files of the repositories those come from
+    bases = set(split_list_name(name)[0] for name in index_names)
+    referenced = set(f for f in list_files if split_list_name(f)[0] in bases)
+    for f in list_files:
+        match = RELEASE_FILE_RE.search(f)
+        if match:
+            prefix = f[:match.start()]
+            if any(base.startswith(prefix) for base in bases):
+                referenced.add(f)
+    return referenced
+
+def is_packages_list(name):
+    return split_list_name(name)[0].endswith('_Packages')
+
+def is_compressible_list(name):
+    return COMPRESSIBLE_LIST_RE.search(name) is not None
+
+@contextlib.contextmanager
+def open_list(path):
+    # Opens a list for reading in binary mode whether or not (and however) apt compressed it
+    ext = split_list_name(path)[1]
+    if ext == '':
+        f = open(path, 'rb')
+    elif ext == '.gz':
+        f = gzip.GzipFile(path, 'rb')
+    elif ext == '.bz2':
+        f = bz2.BZ2File(path, 'rb')
+    elif ext in ('.xz', '.lzma') and lzma is not None:
+        f = lzma.open(path, 'rb')
+    else:
+        # Let apt decompress formats Python can't read itself
+        proc = trace.Popen(['/usr/lib/apt/apt-helper', 'cat-file', path], stdout=subprocess.PIPE)
+        try:
+            yield proc.stdout
+        except BaseException as _:
+            proc.stdout.close()
+            proc.wait()
+            raise
+        proc.stdout.close()
+        if proc.wait() != 0:
+            raise IOError('Could not decompress ' + path)
+        return
+    try:
+        yield f
+    finally:
+        f.close()
+
+def iter_stanzas(path):
+    # Yields each stanza of a Packages (or dpkg status) file as a dict of its single line fields
+    stanza = {}
+    with open_list(path) as f:
+        for line in f:
+            line = line.decode('utf-8', 'replace').rstrip('\n')
+            if not line.strip():
+                if stanza:
+                    yield stanza
+                    stanza = {}
+                continue
+            if line[0] in ' \t':
+                # Continuation of a multi-line field (e.g. Description), not needed
+                continue
+            field, sep, value = line.partition(':')
+            if sep:
+                stanza[field] = value.strip()
+    if stanza:
+        yield stanza
+
+def stanza_checksum(stanza):
+    for field, name in CHECKSUM_FIELDS:
+        if field in stanza:
+            return name + ':' + stanza[field]
+    return ''
@@ -0,0 +1,184 @@
+"""
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+    Copyright (c) 2018 Riley Baxter
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import json
+import os
+import re
+
+from .fetch import new_hasher
+from .resolve import parse_plan
+from .utils import file_digest, load_pickle, save_pickle
+from .verify import hash_file, is_verified
+
+# An install worked out in full on a connected system, so a slow offline target can apply it with dpkg
+# instead of resolving it again:
+#   packages: the install queue the plan was made for
+#   status:   hash of the target's dpkg status the plan was made against
+#   steps:    [(action, name, arch, version, filename), ...] in the order apt-get would carry them out,
+#             action is one of STEP_UNPACK, STEP_CONFIGURE, STEP_REMOVE, STEP_PURGE (filename only for unpacks)
+#   details:  apt-get's description of the transaction, as shown by "Show Details"
+ApplyPlan = collections.namedtuple('ApplyPlan', 'packages status steps details')
+
+STEP_UNPACK = 'unpack'
+STEP_CONFIGURE = 'configure'
+STEP_REMOVE = 'remove'
+STEP_PURGE = 'purge'
+
+# apt-get --simulate lines, e.g. "Inst foo [1.0] (2.0 Debian:12/stable [amd64])", "Conf foo (2.0 ...)", "Remv bar [1.0]"
+SIMULATION_RE = re.compile(r'^(Inst|Conf|Remv|Purg) (\S+)(?: \[([^\]]*)\])?(?: \((\S+) .*\[([^\]\[]+)\]\))?')
+SIMULATION_STEPS = {'Inst': STEP_UNPACK, 'Conf': STEP_CONFIGURE, 'Remv': STEP_REMOVE, 'Purg': STEP_PURGE}
+
+# dpkg options for each step
+DPKG_OPTIONS = {STEP_UNPACK: '--unpack', STEP_CONFIGURE: '--configure', STEP_REMOVE: '--remove', STEP_PURGE: '--purge'}
+
+def parse_simulation(lines, pins):
+    # Turns apt-get --simulate output into plan steps, taking each unpacked archive from pins.
+    # None if the simulation unpacks something that isn't pinned (the plan couldn't be applied offline).
+    # Multi-arch packages can be installed for several architectures at the same version, so archives are
+    # told apart by architecture as well.
+    archives = dict(((p.name, p.arch, p.version), p) for p in pins)
+    steps = []
+    for line in lines:
+        match = SIMULATION_RE.match(line)
+        if not match:
+            continue
+        kind, name, old_version, version, arch = match.groups()
+        if ':' in name:
+            # "name:arch", the architecture the step is for even where apt-get doesn't print it again (Remv, Purg)
+            name, qualifier = name.split(':', 1)
+            arch = arch or qualifier
+        step = SIMULATION_STEPS[kind]
+        filename = None
+        if step == STEP_UNPACK:
+            package = archives.get((name, arch, version))
+            if package is None:
+                return None
+            filename = package.filename
+        steps.append((step, name, arch, version or old_version, filename))
+    return steps
+
+def make_plan(packages, status_path, lines, pins):
+    # ApplyPlan for installing packages on top of the dpkg status at status_path, None if it can't be made
+    steps = parse_simulation(lines, pins)
+    if steps is None:
+        return None
+    return ApplyPlan(list(packages), file_digest(status_path), steps, parse_plan(lines).details)
+
+def plan_file(plans_dir, target):
+    return os.path.join(plans_dir, target)
+
+def save_plan(plans_dir, target, plan):
+    if not os.path.isdir(plans_dir):
+        os.makedirs(plans_dir)
+    save_pickle(plan_file(plans_dir, target), plan)
+
+def load_plan(plans_dir, target):
+    return load_pickle(plan_file(plans_dir, target))
+
+def remove_plan(plans_dir, target):
+    path = plan_file(plans_dir, target)
+    if os.path.isfile(path):
+        os.unlink(path)
+
+def plan_to_json(plan):
+    # Plans are pickled on the medium, but other systems (see serve) get them as JSON, which can't run code when read
+    return json.dumps(plan._asdict(), sort_keys=True).encode('utf-8')
+
+def plan_from_json(data):
+    fields = json.loads(data.decode('utf-8'))
+    return ApplyPlan(fields['packages'], fields['status'], [ tuple(step) for step in fields['steps'] ], fields['details'])
+
+def stale_reason(plan, packages, status_path, archives_dir, pins, manifest):
+    # Why plan can't be applied to a system with the dpkg status at status_path, None if it can.
+    # Like apt-get, every archive is checked against the size and checksum it is pinned to (pins, as
+    # PlannedPackage) before dpkg sees any of them; archives the verification manifest already vouches
+    # for as they are now aren't hashed again.
+    if list(plan.packages) != list(packages):
+        return 'the install queue changed since it was made'
+    if file_digest(status_path) != plan.status:
+        return 'the installed packages changed since it was made'
+    pinned = dict((p.filename, p) for p in pins)
+    for step, name, arch, version, filename in plan.steps:
+        if step != STEP_UNPACK:
+            continue
+        path = os.path.join(archives_dir, filename)
+        if not os.path.isfile(path):
+            return filename + ' is missing from the installation medium'
+        pin = pinned.get(filename)
+        if pin is None or new_hasher(pin.checksum) is None:
+            return filename + ' has no checksum to check it against'
+        st = os.stat(path)
+        if st.st_size != pin.size:
+            return filename + ' is not the size it should be'
+        if is_verified(manifest, filename, st) and manifest[filename][2] == pin.checksum:
+            continue
+        if not hash_file((path, pin.checksum))[1]:
+            return filename + ' does not match its checksum'
+    return None
+
+def package_spec(name, arch):
+    return name if arch in (None, 'all') else name + ':' + arch
+
+def dpkg_commands(plan, archives_dir, options=()):
+    # dpkg invocations that carry out the plan, consecutive steps of the same kind are done in one run.
+    # options (apt's DPkg::Options) go in front of every action, as apt-get passes them.
+    commands = []
+    for step, name, arch, version, filename in plan.steps:
+        if step == STEP_UNPACK:
+            arg = os.path.join(archives_dir, filename)
+        else:
+            arg = package_spec(name, arch)
+        if commands and commands[-1][1 + len(options)] == DPKG_OPTIONS[step]:
+            commands[-1].append(arg)
+        else:
+            commands.append(['dpkg'] + list(options) + [DPKG_OPTIONS[step], arg])
+    return commands
+
+def parse_apt_config(lines):
+    # [(key, value), ...] from "apt-config dump --format '%f\t%v%n'", list items have keys ending in "::"
+    config = []
+    for line in lines:
+        if '\t' in line:
+            key, value = line.split('\t', 1)
+            config.append((key.lower(), value))
+    return config
+
+def config_list(config, key):
+    key = key.lower() + '::'
+    return [ value for k, value in config if k == key and value ]
+
+def dpkg_hooks(config):
+    # The hooks apt-get would run around dpkg, from the apt configuration (as parsed by parse_apt_config):
+    # {'pre-invoke': [command, ...], 'pre-install-pkgs': [...], 'post-invoke': [...], 'options': [dpkg option, ...]}.
+    # None if a hook expects more from apt than the list of archives being installed (Pre-Install-Pkgs version 2 or
+    # later, e.g. apt-listchanges), which only apt-get can give it.
+    values = dict(config)
+    hooks = {'pre-invoke': config_list(config, 'DPkg::Pre-Invoke'),
+             'pre-install-pkgs': config_list(config, 'DPkg::Pre-Install-Pkgs'),
+             'post-invoke': config_list(config, 'DPkg::Post-Invoke'),
+             'options': config_list(config, 'DPkg::Options')}
+    for command in hooks['pre-install-pkgs']:
+        program = command.split()[0].lower() if command.split() else ''
+        version = values.get('dpkg::tools::options::' + program + '::version', '1')
+        if version.strip() not in ('', '0', '1'):
+            return None
+    return hooks
+
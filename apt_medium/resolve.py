@@ -0,0 +1,266 @@
+"""
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+    Copyright (c) 2018 Riley Baxter
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+
+from . import trace
+from .fetch import parse_uri_item
+from .utils import load_pickle, make_dirs, save_pickle
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+# Resolutions kept on the medium, oldest are dropped first
+MAX_CACHE_ENTRIES = 256
+
+# Stands in for a target's name when working out whether targets are clones of each other
+TARGET_PLACEHOLDER = b'<target>'
+
+SECTION_NEW = 'new'
+SECTION_UPGRADE = 'upgrade'
+SECTION_REMOVE = 'remove'
+SECTION_DOWNGRADE = 'downgrade'
+SECTION_KEPT = 'kept'
+SECTION_OTHER = 'other'
+
+SECTION_PATTERNS = [
+    (re.compile(r'NEW packages will be installed'), SECTION_NEW),
+    (re.compile(r'packages will be upgraded'), SECTION_UPGRADE),
+    (re.compile(r'packages will be REMOVED'), SECTION_REMOVE),
+    (re.compile(r'packages will be DOWNGRADED'), SECTION_DOWNGRADE),
+    (re.compile(r'have been kept back'), SECTION_KEPT),
+]
+PROGRESS_RE = re.compile(r'^(Reading package lists|Building dependency tree|Reading state information)')
+SUMMARY_RE = re.compile(r'^[0-9]+ upgraded, [0-9]+ newly installed')
+COUNT_RE = re.compile(r'([0-9]+) ([a-z ]+?)(?:,| and |\.|$)')
+NEWEST_RE = re.compile(r'is already the newest version')
+QUOTED_CHAR_RE = re.compile(r'%([0-9a-fA-F]{2})')
+
+PlannedPackage = collections.namedtuple('PlannedPackage', ['name', 'version', 'arch', 'uri', 'filename', 'size', 'checksum'])
+
+def anonymize_target(target):
+    # Returns a function that replaces the target's own location on the medium (as written into its
+    # apt-medium.conf and apt-get's command line) in a byte string, so cloned targets hash the same
+    pattern = re.compile(re.escape(('system_info/' + target).encode('utf-8')) + b'(?=[/"]|$)')
+    return lambda data: pattern.sub(b'system_info/' + TARGET_PLACEHOLDER, data)
+
+def hash_tree(digest, root, transform=None):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            digest.update(os.path.relpath(path, root).encode('utf-8') + b'\0')
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    data = f.read()
+                digest.update(transform(data) if transform else data)
+            digest.update(b'\0')
+
+def lists_fingerprint(digest, lists_dir, lists=None):
+    # apt-get gives downloaded lists the server's timestamp, so name, size and mtime identify a list's contents
+    # lists narrows this down to the lists a target actually uses
+    for name in sorted(os.listdir(lists_dir)):
+        path = os.path.join(lists_dir, name)
+        if name == 'lock' or (lists is not None and name not in lists) or not os.path.isfile(path):
+            continue
+        st = os.stat(path)
+        digest.update(('%s\0%d\0%r\0' % (name, st.st_size, st.st_mtime)).encode('utf-8'))
+
+def resolution_key(install_medium, target, parms, lists=None):
+    # Everything apt-get's answer depends on: the target's installed packages, its apt configuration,
+    # the package lists and the request itself. Which target it is doesn't matter, targets cloned
+    # from one another share the same key (and so their resolutions).
+    digest = hashlib.sha256()
+    anonymize = anonymize_target(target)
+    target_info_dir = os.path.join(install_medium, 'system_info', target)
+    with open(os.path.join(target_info_dir, 'dpkg-status'), 'rb') as f:
+        digest.update(f.read())
+    digest.update(b'\0etc\0')
+    hash_tree(digest, os.path.join(target_info_dir, 'etc', 'apt'), anonymize)
+    digest.update(b'\0lists\0')
+    lists_fingerprint(digest, os.path.join(install_medium, 'lists'), lists)
+    # The medium may be mounted somewhere else on the next system, so leave its location out of the key
+    digest.update(b'\0request\0')
+    for parm in parms:
+        digest.update(anonymize(parm.replace(install_medium, '.').encode('utf-8')) + b'\0')
+    return digest.hexdigest()
+
+def prune_cache(cache_dir):
+    # Other resolutions may be writing to or pruning the cache at the same time, skip their
+    # files in progress and anything that disappears under us
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.tmp'):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            entries.append((os.path.getmtime(path), path))
+        except OSError as _:
+            pass
+    if len(entries) <= MAX_CACHE_ENTRIES:
+        return
+    entries.sort()
+    for _, path in entries[:len(entries) - MAX_CACHE_ENTRIES]:
+        try:
+            os.unlink(path)
+        except OSError as _:
+            pass
+
+def cached_apt_output(cache_dir, install_medium, target, parms, env, run_parms=None, lists=None):
+    # Output lines of an apt-get invocation, reused from an earlier identical resolution when possible
+    # run_parms can add options that don't change the answer (and so aren't part of the key)
+    key = resolution_key(install_medium, target, parms, lists)
+    cache_file = os.path.join(cache_dir, key)
+    lines = load_pickle(cache_file)
+    if lines is not None:
+        # Refresh the timestamp so pruning drops the least recently used entries
+        os.utime(cache_file, None)
+        return lines
+
+    lines = trace.check_output(run_parms or parms, env=env).decode('utf-8').splitlines()
+
+    make_dirs(cache_dir)
+    save_pickle(cache_file, lines)
+    prune_cache(cache_dir)
+    return lines
+
+def present_in_archives(archives_dir, filename, size):
+    path = os.path.join(archives_dir, filename)
+    return os.path.isfile(path) and os.path.getsize(path) == size
+
+def missing_packages(packages, archives_dir):
+    return [ p for p in packages if not present_in_archives(archives_dir, p.filename, p.size) ]
+
+def unquote_string(s):
+    # Reverse of packages.quote_string
+    return QUOTED_CHAR_RE.sub(lambda m: unichr(int(m.group(1), 16)), s)
+
+def split_archive_filename(filename):
+    # name_version_arch.deb -> (name, version, arch), '_' and ':' are always escaped inside the fields
+    fields = filename.rsplit('.', 1)[0].split('_')
+    if len(fields) != 3:
+        return (unquote_string(fields[0]), '', '')
+    return tuple(unquote_string(field) for field in fields)
+
+class Plan(object):
+    # Structured result of resolving one apt-get request
+    def __init__(self):
+        self.details = []    # apt-get's own description of the transaction, as shown by "Show Details"
+        self.notices = []    # "... is already the newest version" lines
+        self.sections = []   # [(section kind, [package name, ...]), ...] in the order apt-get listed them
+        self.counts = {}     # summary line counts, e.g. {'upgraded': 0, 'newly installed': 2, ...}
+        self.packages = []   # PlannedPackage for every archive the transaction needs
+
+    def names(self, *kinds):
+        names = []
+        for kind, section_names in self.sections:
+            if kind not in kinds:
+                continue
+            for name in section_names:
+                if name not in names:
+                    names.append(name)
+        return names
+
+    def installs(self):
+        # Packages that end up newly installed or at a new version
+        return self.names(SECTION_NEW, SECTION_UPGRADE)
+
+    def nothing_to_do(self):
+        return sum(count for name, count in self.counts.items() if name != 'not upgraded') == 0
+
+    def missing(self, archives_dir):
+        return missing_packages(self.packages, archives_dir)
+
+def pin_spec(package):
+    # apt-get argument selecting exactly this version (and architecture) of the package
+    if package.arch and package.arch != 'all':
+        return package.name + ':' + package.arch + '=' + package.version
+    return package.name + '=' + package.version
+
+def uri_line(package):
+    # Same format as apt-get --print-uris -qq
+    return "'" + package.uri + "' " + package.filename + ' ' + str(package.size) + ' ' + package.checksum
+
+def parse_plan(lines):
+    plan = Plan()
+    in_details = True
+    section = None
+    for line in lines:
+        if line.startswith("'"):
+            item = line.split()
+            if len(item) >= 3 and item[2].isdigit():
+                uri, filename, size, checksum = parse_uri_item(item)
+                name, version, arch = split_archive_filename(filename)
+                plan.packages.append(PlannedPackage(name, version, arch, uri, filename, size, checksum))
+            continue
+        if not in_details:
+            continue
+        if PROGRESS_RE.match(line):
+            continue
+        plan.details.append(line)
+
+        match = SUMMARY_RE.match(line)
+        if match:
+            for count, name in COUNT_RE.findall(line):
+                plan.counts[name] = int(count)
+            in_details = False
+            continue
+
+        if line.startswith(' ') and section is not None:
+            section[1].extend(line.split())
+            continue
+
+        section = None
+        if NEWEST_RE.search(line):
+            plan.notices.append(line)
+        elif line.endswith(':'):
+            kind = SECTION_OTHER
+            for pattern, section_kind in SECTION_PATTERNS:
+                if pattern.search(line):
+                    kind = section_kind
+                    break
+            section = (kind, [])
+            plan.sections.append(section)
+    return plan
+
+def resolve_key(install_medium, target, parms, lists=None):
+    # Key resolve() caches the result of a request under, equal for targets that get the same answer
+    return resolution_key(install_medium, target, list(parms) + ['--print-uris'], lists)
+
+def resolve(cache_dir, install_medium, target, parms, env, lists=None):
+    # Resolves an apt-get request with a single (cached) invocation and returns its Plan.
+    # --print-uris without -qq gives both apt-get's summary of the transaction and a line per archive
+    # with exact version, size and hash. apt-get is pointed at an empty archives directory so that
+    # every archive is listed, independent of what has been downloaded already.
+    check_parms = list(parms) + ['--print-uris']
+    empty_archives = tempfile.mkdtemp()
+    try:
+        run_parms = check_parms + ['--option', 'Dir::Cache::archives=' + empty_archives]
+        lines = cached_apt_output(cache_dir, install_medium, target, check_parms, env, run_parms, lists)
+    finally:
+        shutil.rmtree(empty_archives)
+    return parse_plan(lines)
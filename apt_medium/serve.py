@@ -0,0 +1,301 @@
+"""
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+    Copyright (c) 2018 Riley Baxter
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import email.utils
+import os
+import re
+import socket
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError as _:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+try:
+    from urllib.parse import quote, unquote
+except ImportError as _:
+    from urllib import quote, unquote
+
+from . import trace
+from .fetch import ConnectionCache, FetchError, fetch_all, open_uri
+from .packages import LIST_COMPRESSION_EXTS, quote_string, split_list_name
+from .plans import load_plan, plan_from_json, plan_to_json
+from .utils import file_digest, load_pickle
+
+# URL path -> directory on the medium served under it. Only plain files directly inside these are served.
+# archives/ also holds the flat repository index, so hosts can use "deb [trusted=yes] http://host:port/archives ./" too.
+# The install plans "download" prepares for each target are sent as JSON (see plans.plan_to_json).
+PLANS_DIR = os.path.join('var', 'lib', 'apt-medium', 'plans')
+SERVED_DIRS = {'archives': 'archives', 'lists': 'lists', 'plans': PLANS_DIR}
+
+# The verification manifest, whose SHA256s are listed for archives rather than hashing them on request
+ARCHIVES_MANIFEST = os.path.join('var', 'lib', 'apt-medium', 'archives-manifest')
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+SEND_CHUNK = 1024 * 1024
+
+def parse_range(header, size):
+    # (start, end) of a single "bytes=" range (end inclusive), None if header asks for the whole file.
+    # Raises ValueError if the range can't be satisfied.
+    if not header:
+        return None
+    match = RANGE_RE.match(header.strip())
+    if not match or (not match.group(1) and not match.group(2)):
+        # Multiple ranges or a unit we don't know, send the whole file as HTTP allows
+        return None
+    if not match.group(1):
+        # Suffix range, the last n bytes
+        length = int(match.group(2))
+        if length == 0:
+            raise ValueError(header)
+        return (max(0, size - length), size - 1)
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) else size - 1
+    if start >= size or end < start:
+        raise ValueError(header)
+    return (start, min(end, size - 1))
+
+def send_file(sock, f, offset, count):
+    # Sends count bytes of f from offset straight from the page cache to the socket where the platform allows
+    if hasattr(os, 'sendfile'):
+        while count > 0:
+            sent = os.sendfile(sock.fileno(), f.fileno(), offset, min(count, SEND_CHUNK))
+            if sent == 0:
+                raise IOError('Connection closed')
+            offset += sent
+            count -= sent
+        return
+    f.seek(offset)
+    while count > 0:
+        data = f.read(min(count, SEND_CHUNK))
+        if not data:
+            raise IOError('File truncated')
+        sock.sendall(data)
+        count -= len(data)
+
+class MediumRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'apt-medium'
+
+    def resolve_path(self):
+        # Local file for the request path, None (after sending an error) if there isn't one to serve
+        # Decoded before anything is checked, so an encoded "/" or ".." can't get past the checks
+        parts = [ unquote(part) for part in self.path.split('?', 1)[0].strip('/').split('/') ]
+        if len(parts) == 1 and parts[0] in SERVED_DIRS:
+            return os.path.join(self.server.install_medium, SERVED_DIRS[parts[0]])
+        if len(parts) != 2 or parts[0] not in SERVED_DIRS or parts[1] in ('', '.', '..') or parts[1].startswith('.') or \
+           '/' in parts[1] or '\0' in parts[1]:
+            self.send_error(404)
+            return None
+        directory = os.path.join(self.server.install_medium, SERVED_DIRS[parts[0]])
+        # apt names archives with the epoch's ':' escaped (foo_1%3a2.0_all.deb), while clients asking for that file
+        # send the ':' either as is or percent-encoded, so both the name as asked for and apt's form of it are tried
+        for name in (parts[1], quote_string(parts[1], ':')):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                return path
+        self.send_error(404)
+        return None
+
+    def send_listing(self, directory, head):
+        # One line per file: name, size, mtime and SHA256, so clients can tell what they need to fetch.
+        # Archives are listed with the SHA256 they were verified against, or none if they haven't been
+        # (hashing a whole archive directory on every request would take far too long).
+        archives = directory == os.path.join(self.server.install_medium, 'archives')
+        checksums = load_pickle(os.path.join(self.server.install_medium, ARCHIVES_MANIFEST), {}) if archives else {}
+        lines = []
+        if os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                path = os.path.join(directory, name)
+                if name.startswith('.') or name == 'lock' or not os.path.isfile(path):
+                    continue
+                st = os.stat(path)
+                if archives:
+                    entry = checksums.get(name)
+                    verified = entry is not None and entry[:2] == (st.st_size, st.st_mtime) and entry[2].upper().startswith('SHA256:')
+                    sha256 = entry[2].split(':', 1)[1].lower() if verified else ''
+                else:
+                    sha256 = self.server.digest(path, st)
+                lines.append(name + '\t' + str(st.st_size) + '\t' + repr(st.st_mtime) + '\t' + sha256 + '\n')
+        self.send_body(''.join(lines).encode('utf-8'), 'text/plain; charset=utf-8', head)
+
+    def send_body(self, body, content_type, head):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def send_plan(self, path, head):
+        plan = load_plan(os.path.dirname(path), os.path.basename(path))
+        if plan is None:
+            self.send_error(404)
+            return
+        self.send_body(plan_to_json(plan), 'application/json', head)
+
+    def send_path(self, path, head):
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            try:
+                byte_range = parse_range(self.headers.get('Range'), st.st_size)
+            except ValueError as _:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */' + str(st.st_size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if byte_range is None:
+                start, end = 0, st.st_size - 1
+                self.send_response(200)
+            else:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, st.st_size))
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Last-Modified', email.utils.formatdate(st.st_mtime, usegmt=True))
+            self.end_headers()
+            if not head and end >= start:
+                self.wfile.flush()
+                with trace.span('serve ' + os.path.basename(path), 'network', bytes=end - start + 1, client=self.client_address[0]):
+                    send_file(self.connection, f, start, end - start + 1)
+
+    def handle_request(self, head):
+        path = self.resolve_path()
+        if path is None:
+            return
+        if os.path.isdir(path):
+            self.send_listing(path, head)
+        elif os.path.dirname(path) == os.path.join(self.server.install_medium, PLANS_DIR):
+            self.send_plan(path, head)
+        else:
+            self.send_path(path, head)
+
+    def do_GET(self):
+        self.handle_request(False)
+
+    def do_HEAD(self):
+        self.handle_request(True)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class MediumServer(ThreadingMixIn, HTTPServer):
+    # Serves a medium's archives, lists and install plans, one thread per client connection
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, install_medium, address, quiet=False):
+        HTTPServer.__init__(self, address, MediumRequestHandler)
+        self.install_medium = install_medium
+        self.quiet = quiet
+        self.digests = {} # path -> (size, mtime, sha256)
+        self.digests_lock = threading.Lock()
+
+    def digest(self, path, st):
+        # SHA256 of a served file, only hashed again when it changed
+        with self.digests_lock:
+            entry = self.digests.get(path)
+        if entry is not None and entry[:2] == (st.st_size, st.st_mtime):
+            return entry[2]
+        sha256 = file_digest(path)
+        with self.digests_lock:
+            self.digests[path] = (st.st_size, st.st_mtime, sha256)
+        return sha256
+
+def server_uri(server, *parts):
+    return server.rstrip('/') + '/' + '/'.join(quote(part, safe='') for part in parts)
+
+def fetch_listing(server, directory):
+    # {name: (size, mtime, sha256)} of the files a server offers in one of its directories
+    connections = ConnectionCache()
+    try:
+        response = open_uri(connections, server_uri(server, directory) + '/')
+        body = response.read()
+        if response.status != 200:
+            raise FetchError(str(response.status) + ' ' + response.reason)
+    except (socket.error, IOError) as e:
+        raise FetchError('Could not reach ' + server + ': ' + str(e))
+    finally:
+        connections.close()
+    listing = {}
+    for line in body.decode('utf-8').splitlines():
+        name, size, mtime, sha256 = line.split('\t')
+        listing[name] = (int(size), float(mtime), sha256)
+    return listing
+
+def mirror_lists(server, lists_dir, jobs=4):
+    # Brings lists_dir up to date with the server's package lists, keeping the server's timestamps
+    # (which is what apt-medium and apt-get go by). Returns {name: error} for lists that failed.
+    listing = fetch_listing(server, 'lists')
+    downloads = []
+    for name, (size, mtime, sha256) in listing.items():
+        path = os.path.join(lists_dir, name)
+        if os.path.isfile(path):
+            st = os.stat(path)
+            if (st.st_size, st.st_mtime) == (size, mtime):
+                continue
+        # The old copy stays until the new one has arrived complete and verified, fetch_all renames it into place
+        downloads.append((server_uri(server, 'lists', name), name, size, 'SHA256:' + sha256 if sha256 else ''))
+    if not os.path.isdir(os.path.join(lists_dir, 'partial')):
+        os.makedirs(os.path.join(lists_dir, 'partial'))
+    failures = fetch_all(downloads, lists_dir, jobs=jobs)
+    for uri, name, size, checksum in downloads:
+        if name in failures:
+            continue
+        os.utime(os.path.join(lists_dir, name), (listing[name][1], listing[name][1]))
+        # A copy of the same list with another compression would now be out of date
+        base = split_list_name(name)[0]
+        for ext in ('',) + LIST_COMPRESSION_EXTS:
+            other = os.path.join(lists_dir, base + ext)
+            if base + ext != name and base + ext not in listing and os.path.isfile(other):
+                os.unlink(other)
+    return failures
+
+def fetch_archives(server, packages, archives_dir, jobs=4, progress=None):
+    # Fetches the archives of packages (PlannedPackage) from the server, checked against the checksums
+    # the local resolution expects. Returns {filename: error} for the ones that failed.
+    downloads = [ (server_uri(server, 'archives', p.filename), p.filename, p.size, p.checksum) for p in packages ]
+    return fetch_all(downloads, archives_dir, jobs=jobs, progress=progress)
+
+def fetch_plan(server, target):
+    # The install plan the server's medium holds for target, None if it has none
+    connections = ConnectionCache()
+    try:
+        response = open_uri(connections, server_uri(server, 'plans', target))
+        body = response.read()
+    except (socket.error, IOError) as e:
+        raise FetchError('Could not reach ' + server + ': ' + str(e))
+    finally:
+        connections.close()
+    if response.status == 404:
+        return None
+    if response.status != 200:
+        raise FetchError(str(response.status) + ' ' + response.reason)
+    try:
+        return plan_from_json(body)
+    except (ValueError, KeyError, TypeError) as _:
+        raise FetchError('Invalid install plan from ' + server)
@@ -0,0 +1,223 @@
+"""
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+    Copyright (c) 2018 Riley Baxter
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import contextlib
+import fcntl
+import os
+import shutil
+import sqlite3
+
+from . import trace
+
+try:
+    import cPickle as pickle
+except ImportError as _:
+    import pickle
+
+STATE_FILE = 'medium_state'
+QUEUES = ('install_queue', 'download_queue')
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS targets (hostname TEXT PRIMARY KEY)',
+    # position keeps each queue in the order packages were added
+    'CREATE TABLE IF NOT EXISTS queue_entries (hostname TEXT NOT NULL, queue TEXT NOT NULL, '
+    'position INTEGER NOT NULL, package TEXT NOT NULL, PRIMARY KEY (hostname, queue, package))',
+    # The resolved transaction behind each queue: exact version and archive of every package it installs
+    'CREATE TABLE IF NOT EXISTS queue_pins (hostname TEXT NOT NULL, queue TEXT NOT NULL, name TEXT NOT NULL, '
+    'version TEXT NOT NULL, arch TEXT NOT NULL, uri TEXT NOT NULL, filename TEXT NOT NULL, size INTEGER NOT NULL, '
+    'checksum TEXT NOT NULL, PRIMARY KEY (hostname, queue, name, arch))',
+]
+
+# Columns of queue_pins in the order pins are passed in and returned (same order as resolve.PlannedPackage)
+PIN_FIELDS = ('name', 'version', 'arch', 'uri', 'filename', 'size', 'checksum')
+
+def is_sqlite(path):
+    with open(path, 'rb') as f:
+        return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+@contextlib.contextmanager
+def migration_lock(path):
+    with open(path + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def migrate_pickle(path):
+    # Convert a medium_state file from the old pickled dict format, leaving a copy of the original behind
+    with migration_lock(path):
+        if is_sqlite(path):
+            # Another process got here first
+            return
+        with open(path, 'rb') as f:
+            old_state = pickle.load(f)
+
+        new_path = path + '.new'
+        if os.path.exists(new_path):
+            os.unlink(new_path)
+        conn = sqlite3.connect(new_path, isolation_level=None)
+        try:
+            for statement in SCHEMA:
+                conn.execute(statement)
+            conn.execute('BEGIN')
+            hostnames = set()
+            for queue in QUEUES:
+                hostnames.update(old_state.get(queue, {}))
+            for hostname in hostnames:
+                conn.execute('INSERT INTO targets (hostname) VALUES (?)', (hostname,))
+            for queue in QUEUES:
+                for hostname, packages in old_state.get(queue, {}).items():
+                    for position, package in enumerate(packages):
+                        conn.execute('INSERT OR IGNORE INTO queue_entries (hostname, queue, position, package) VALUES (?, ?, ?, ?)',
+                                     (hostname, queue, position, package))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+        shutil.copy(path, path + '.pickle-backup')
+        os.rename(new_path, path)
+
+def connect(path=STATE_FILE):
+    if os.path.exists(path) and os.path.getsize(path) > 0 and not is_sqlite(path):
+        migrate_pickle(path)
+
+    # Transactions are managed explicitly, see transaction()
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+    # WAL keeps readers and a writer from blocking each other and makes commits crash safe
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=FULL')
+    for statement in SCHEMA:
+        conn.execute(statement)
+    return conn
+
+@contextlib.contextmanager
+def transaction(path=STATE_FILE):
+    # Yields a connection inside a write transaction which is committed as a whole (or not at all)
+    with trace.span('state transaction', 'state', path=path):
+        conn = connect(path)
+        try:
+            # Take the write lock up front so two apt-medium processes can't interleave read-modify-write cycles
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException as _:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+def read_state(path=STATE_FILE):
+    # Snapshot of the whole state in the old dict layout: {queue: {hostname: [package, ...]}}
+    with trace.span('read state', 'state', path=path):
+        conn = connect(path)
+        try:
+            state = dict((queue, {}) for queue in QUEUES)
+            for (hostname,) in conn.execute('SELECT hostname FROM targets ORDER BY hostname'):
+                for queue in QUEUES:
+                    state[queue][hostname] = []
+            for hostname, queue, package in conn.execute('SELECT hostname, queue, package FROM queue_entries ORDER BY position'):
+                state[queue][hostname].append(package)
+            return state
+        finally:
+            conn.close()
+
+def has_target(path, hostname):
+    # Checked without taking the write lock, so initializing a known target doesn't write to the medium
+    if not os.path.isfile(path):
+        return False
+    conn = connect(path)
+    try:
+        return conn.execute('SELECT 1 FROM targets WHERE hostname = ?', (hostname,)).fetchone() is not None
+    finally:
+        conn.close()
+
+def add_target(conn, hostname):
+    conn.execute('INSERT OR IGNORE INTO targets (hostname) VALUES (?)', (hostname,))
+
+def queue_contents(conn, queue, hostname):
+    return [ row[0] for row in conn.execute('SELECT package FROM queue_entries WHERE hostname = ? AND queue = ? ORDER BY position',
+                                            (hostname, queue)) ]
+
+def queue_add(conn, queue, hostname, packages):
+    # Appends packages to a target's queue, returns the ones that weren't already queued
+    queued = set(queue_contents(conn, queue, hostname))
+    position = conn.execute('SELECT COALESCE(MAX(position) + 1, 0) FROM queue_entries WHERE hostname = ? AND queue = ?',
+                            (hostname, queue)).fetchone()[0]
+    added = []
+    for package in packages:
+        if package in queued:
+            continue
+        conn.execute('INSERT INTO queue_entries (hostname, queue, position, package) VALUES (?, ?, ?, ?)',
+                     (hostname, queue, position, package))
+        queued.add(package)
+        added.append(package)
+        position += 1
+    return added
+
+def queue_remove(conn, queue, hostname, packages):
+    before = len(queue_contents(conn, queue, hostname))
+    conn.executemany('DELETE FROM queue_entries WHERE hostname = ? AND queue = ? AND package = ?',
+                     [ (hostname, queue, package) for package in packages ])
+    # Pins describe the queue's transaction as a whole, dependencies included, so they no longer hold once anything
+    # is taken out of it. Without them the rest of the queue is resolved again when it is next downloaded or installed.
+    if len(queue_contents(conn, queue, hostname)) != before:
+        conn.execute('DELETE FROM queue_pins WHERE hostname = ? AND queue = ?', (hostname, queue))
+
+def queue_move(conn, from_queue, to_queue, hostname, packages):
+    # The pins only go along when the whole transaction they were resolved for does
+    if set(queue_contents(conn, from_queue, hostname)) <= set(packages):
+        pins_add(conn, to_queue, hostname, queue_pins(conn, from_queue, hostname))
+    queue_remove(conn, from_queue, hostname, packages)
+    queue_add(conn, to_queue, hostname, packages)
+
+def queue_pins(conn, queue, hostname):
+    return conn.execute('SELECT ' + ', '.join(PIN_FIELDS) + ' FROM queue_pins WHERE hostname = ? AND queue = ? ORDER BY name, arch',
+                        (hostname, queue)).fetchall()
+
+def pins_add(conn, queue, hostname, pins):
+    # Records the exact version of packages in a queue's transaction, replacing older pins of the same package
+    conn.executemany('INSERT OR REPLACE INTO queue_pins (hostname, queue, ' + ', '.join(PIN_FIELDS) + ') VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     [ (hostname, queue) + tuple(pin) for pin in pins ])
+
+def dump_queues(conn):
+    # Every target with its queues and their pins: {hostname: {queue: ([package, ...], [pin, ...])}}
+    queues = {}
+    for (hostname,) in conn.execute('SELECT hostname FROM targets ORDER BY hostname'):
+        queues[hostname] = dict((queue, (queue_contents(conn, queue, hostname), queue_pins(conn, queue, hostname))) for queue in QUEUES)
+    return queues
+
+def merge_queues(conn, queues):
+    # Adds the targets and queue entries of another medium (as from dump_queues) to this one without dropping
+    # any of its own. Where both have pinned the same package, this medium's pin is kept.
+    for hostname in sorted(queues):
+        add_target(conn, hostname)
+        for queue in QUEUES:
+            packages, pins = queues[hostname][queue]
+            queue_add(conn, queue, hostname, packages)
+            conn.executemany('INSERT OR IGNORE INTO queue_pins (hostname, queue, ' + ', '.join(PIN_FIELDS) + ') VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             [ (hostname, queue) + tuple(pin) for pin in pins ])
+        # A package one medium still has to download but the other has already downloaded only needs installing now
+        installing = set(queue_contents(conn, 'install_queue', hostname))
+        downloaded = [ package for package in queue_contents(conn, 'download_queue', hostname) if package in installing ]
+        if downloaded:
+            queue_remove(conn, 'download_queue', hostname, downloaded)
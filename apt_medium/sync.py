@@ -0,0 +1,147 @@
+"""
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+    Copyright (c) 2018 Riley Baxter
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import stat
+
+from . import trace
+from .localrepo import PACKAGES_FILE, RELEASE_FILE
+from .utils import copy_file_data, file_digest
+
+# Parts of a medium kept in step between copies of it. The queues in medium_state are merged separately,
+# apt-medium's caches under var/lib/apt-medium are rebuilt by each medium as needed.
+SYNC_DIRS = ('archives', 'lists', 'system_info')
+
+# Generated from the rest of archives/, so each medium writes its own
+SKIPPED_FILES = (os.path.join('archives', PACKAGES_FILE), os.path.join('archives', PACKAGES_FILE + '.gz'),
+                 os.path.join('archives', RELEASE_FILE))
+
+DEFAULT_BATCH_SIZE = 256 * 1024 * 1024
+
+def is_synced(relpath):
+    name = os.path.basename(relpath)
+    return not (name.startswith('.') or name == 'lock' or name.endswith('.tmp') or relpath in SKIPPED_FILES)
+
+def scan_medium(root, cache, checksums):
+    # {relative path: (size, mtime, sha256)} of every synced file on a medium. Files are only hashed when their
+    # size or mtime differ from cache (the same layout, from the last sync) or, for archives, when they haven't
+    # been verified against a SHA256 already (checksums is the medium's verification manifest).
+    manifest = {}
+    with trace.span('scan ' + root, 'sync') as s:
+        hashed = 0
+        for top in SYNC_DIRS:
+            for dirpath, dirnames, filenames in os.walk(os.path.join(root, top)):
+                # Incomplete downloads stay where they are
+                dirnames[:] = sorted(d for d in dirnames if d != 'partial')
+                for filename in sorted(filenames):
+                    path = os.path.join(dirpath, filename)
+                    relpath = os.path.relpath(path, root)
+                    st = os.lstat(path)
+                    if not is_synced(relpath) or not stat.S_ISREG(st.st_mode):
+                        continue
+                    entry = cache.get(relpath)
+                    if entry is None or entry[:2] != (st.st_size, st.st_mtime):
+                        entry = checksums.get(filename) if top == 'archives' and dirpath == os.path.join(root, top) else None
+                        if entry is None or entry[:2] != (st.st_size, st.st_mtime) or not entry[2].upper().startswith('SHA256:'):
+                            entry = (st.st_size, st.st_mtime, file_digest(path))
+                            hashed += 1
+                        else:
+                            entry = (st.st_size, st.st_mtime, entry[2].split(':', 1)[1].lower())
+                    manifest[relpath] = entry
+        s.set(files=len(manifest), hashed=hashed)
+    return manifest
+
+def compare_manifests(manifest_a, manifest_b):
+    # (paths to copy from a to b, paths to copy from b to a, conflicting paths): everything one side lacks, and
+    # where both have a file that differs, the more recently modified copy wins. Differing copies modified at
+    # the same time can't be told apart that way, so they are conflicts for the user to sort out.
+    a_to_b = []
+    b_to_a = []
+    conflicts = []
+    for relpath in sorted(set(manifest_a) | set(manifest_b)):
+        a = manifest_a.get(relpath)
+        b = manifest_b.get(relpath)
+        if b is None:
+            a_to_b.append(relpath)
+        elif a is None:
+            b_to_a.append(relpath)
+        elif a[2] == b[2]:
+            continue
+        elif a[1] > b[1]:
+            a_to_b.append(relpath)
+        elif b[1] > a[1]:
+            b_to_a.append(relpath)
+        else:
+            conflicts.append(relpath)
+    return (a_to_b, b_to_a, conflicts)
+
+def make_batches(relpaths, manifest, batch_size):
+    # Groups relpaths (already in path order, so related files are written next to each other) into runs of
+    # about batch_size bytes
+    batches = [[]]
+    size = 0
+    for relpath in relpaths:
+        if batches[-1] and size + manifest[relpath][0] > batch_size:
+            batches.append([])
+            size = 0
+        batches[-1].append(relpath)
+        size += manifest[relpath][0]
+    return [ batch for batch in batches if batch ]
+
+def copy_batch(src_root, dst_root, relpaths):
+    # Copies a batch of files one after the other into temporary files, then flushes them all to disk together
+    # and renames them into place. One flush per batch rather than per file keeps flash media writing in long
+    # sequential runs, and nothing appears under its real name until it is complete.
+    copied = [] # (temporary file, destination, stat of source)
+    try:
+        for relpath in relpaths:
+            src = os.path.join(src_root, relpath)
+            dst = os.path.join(dst_root, relpath)
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            tmp_dst = os.path.join(os.path.dirname(dst), '.' + os.path.basename(dst) + '.tmp')
+            st = os.stat(src)
+            copied.append((tmp_dst, dst, st))
+            with open(src, 'rb') as fsrc:
+                with open(tmp_dst, 'wb') as fdst:
+                    copy_file_data(fsrc, fdst, st.st_size)
+        for tmp_dst, dst, st in copied:
+            with open(tmp_dst, 'rb+') as f:
+                os.fsync(f.fileno())
+            os.chmod(tmp_dst, stat.S_IMODE(st.st_mode))
+            os.utime(tmp_dst, (st.st_atime, st.st_mtime))
+        for tmp_dst, dst, st in copied:
+            os.rename(tmp_dst, dst)
+    except BaseException as _:
+        for tmp_dst, dst, st in copied:
+            if os.path.exists(tmp_dst):
+                os.unlink(tmp_dst)
+        raise
+    return sum(st.st_size for tmp_dst, dst, st in copied)
+
+def copy_files(src_root, dst_root, relpaths, manifest, batch_size=DEFAULT_BATCH_SIZE):
+    # Copies relpaths from one medium to another in batches, returns the number of bytes copied
+    copied = 0
+    for batch in make_batches(relpaths, manifest, batch_size):
+        with trace.span('copy batch', 'sync', src=src_root, dst=dst_root, files=len(batch)) as s:
+            size = copy_batch(src_root, dst_root, batch)
+            s.set(bytes=size)
+        copied += size
+    return copied
@@ -0,0 +1,140 @@
+"""
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+    Copyright (c) 2018 Riley Baxter
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import os
+import subprocess
+import threading
+import time
+
+# Spans recorded so far while tracing, None when tracing is off (the default).
+# Written out in the Trace Event Format, which chrome://tracing, Perfetto and speedscope all load.
+events = None
+
+# Options of apt-get and friends that take the next argument as their value
+VALUE_OPTIONS = ('--option', '-o', '--config-file', '-c', '--format')
+
+class Span(object):
+    # Times a block of work, extra details (bytes, exit code, ...) can be added with set()
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.begin = time.time()
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        self.begin = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.args.setdefault('error', exc_type.__name__)
+        record(self.name, self.category, self.begin, time.time(), self.args)
+        return False
+
+class NullSpan(object):
+    # Stands in for Span when tracing is off so call sites don't need to check
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+NULL_SPAN = NullSpan()
+
+def enabled():
+    return events is not None
+
+def start():
+    global events
+    events = []
+
+def record(name, category, begin, end, args):
+    # list.append is atomic, so worker threads can record without a lock
+    events.append({'name': name, 'cat': category, 'ph': 'X', 'ts': int(begin * 1000000), 'dur': int((end - begin) * 1000000),
+                   'pid': os.getpid(), 'tid': threading.current_thread().ident, 'args': args})
+
+def span(name, category, **args):
+    if events is None:
+        return NULL_SPAN
+    return Span(name, category, args)
+
+def save(path):
+    # Writes the recorded spans to path and stops tracing
+    global events
+    recorded = events
+    events = None
+    if recorded is None:
+        return
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': recorded, 'displayTimeUnit': 'ms'}, f)
+
+def command_name(parms):
+    # Short name for a command line, e.g. "apt-get install" for apt-get --option Dir=... install pkg
+    name = os.path.basename(parms[0])
+    skip = False
+    for parm in parms[1:]:
+        if skip:
+            skip = False
+        elif parm in VALUE_OPTIONS:
+            skip = True
+        elif not parm.startswith('-'):
+            return name + ' ' + parm
+    return name
+
+def check_output(parms, **kwargs):
+    # subprocess.check_output, recorded as a span with its exit code and the size of its output
+    if events is None:
+        return subprocess.check_output(parms, **kwargs)
+    with Span(command_name(parms), 'subprocess', {'argv': list(parms)}) as s:
+        try:
+            output = subprocess.check_output(parms, **kwargs)
+        except subprocess.CalledProcessError as e:
+            s.set(exit_code=e.returncode, bytes=len(e.output or b''))
+            raise
+        s.set(exit_code=0, bytes=len(output))
+        return output
+
+class TracedPopen(subprocess.Popen):
+    # subprocess.Popen that records a span from launch until the process has been waited for
+    def __init__(self, parms, **kwargs):
+        self.trace_begin = time.time()
+        self.trace_recorded = False
+        subprocess.Popen.__init__(self, parms, **kwargs)
+        self.trace_parms = list(parms)
+
+    def wait(self, *args, **kwargs):
+        retCode = subprocess.Popen.wait(self, *args, **kwargs)
+        if not self.trace_recorded and events is not None:
+            self.trace_recorded = True
+            record(command_name(self.trace_parms), 'subprocess', self.trace_begin, time.time(),
+                   {'argv': self.trace_parms, 'exit_code': retCode})
+        return retCode
+
+def Popen(parms, **kwargs):
+    if events is None:
+        return subprocess.Popen(parms, **kwargs)
+    return TracedPopen(parms, **kwargs)
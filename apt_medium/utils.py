@@ -16,11 +16,25 @@
     Copyright (c) 2018 Riley Baxter
 """
 
+import errno
+import gzip
+import hashlib
+import os
+import shutil
+import stat
+
+from . import trace
+
+try:
+    import cPickle as pickle
+except ImportError as _:
+    import pickle
+
 def getch():
     import sys, tty, termios #@UnresolvedImport Suppress an incorrect PyDev error
     
-    # Don't modify stdin during tests, just read a character
-    if "pytest" in sys.modules:
+    # Don't modify stdin during tests or when answers are piped in, just read a character
+    if "pytest" in sys.modules or not sys.stdin.isatty():
         ch = sys.stdin.read(1)
         return ch
     
@@ -46,3 +60,107 @@ except NameError:
 
 def native_to_unicode(s):
     return unicode(s, "utf-8")
+
+def make_dirs(path):
+    # os.makedirs that doesn't mind another thread or process creating the directory first
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+def load_pickle(path, default=None):
+    # Loads a pickled cache file, treating a missing or unreadable file as empty
+    with trace.span('load ' + os.path.basename(path), 'state', path=path) as s:
+        try:
+            with open(path, 'rb') as f:
+                obj = pickle.load(f)
+                s.set(bytes=f.tell())
+                return obj
+        except (IOError, OSError, EOFError, pickle.UnpicklingError) as _:
+            return default
+
+def save_pickle(path, obj):
+    # Write to a temporary file next to the destination and rename it into place so readers
+    # never see a half written file, even if we are interrupted
+    tmp_path = path + '.tmp'
+    with trace.span('save ' + os.path.basename(path), 'state', path=path) as s:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(obj, f, protocol=2)
+            f.flush()
+            os.fsync(f.fileno())
+            s.set(bytes=f.tell())
+        os.rename(tmp_path, path)
+
+def copy_file_data(fsrc, fdst, size):
+    # Copy the contents of one open file to another inside the kernel where possible
+    # (copy_file_range, then sendfile) so the data never passes through Python buffers
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < size:
+                n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                if n == 0:
+                    break
+                copied += n
+            return
+        except OSError as e:
+            # Not supported between these filesystems, fall back while nothing has been written yet
+            if copied or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    if hasattr(os, 'sendfile'):
+        try:
+            while copied < size:
+                n = os.sendfile(fdst.fileno(), fsrc.fileno(), copied, size - copied)
+                if n == 0:
+                    break
+                copied += n
+            fdst.seek(copied)
+            return
+        except OSError as e:
+            if copied or e.errno not in (errno.ENOSYS, errno.EINVAL):
+                raise
+    shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+
+def copy_file(src, dst):
+    # Copies src to dst atomically (via a temporary file and rename), keeping src's mode and mtime
+    st = os.stat(src)
+    tmp_dst = os.path.join(os.path.dirname(dst), '.' + os.path.basename(dst) + '.tmp')
+    with trace.span('copy ' + os.path.basename(src), 'sync', src=src, dst=dst, bytes=st.st_size):
+        with open(src, 'rb') as fsrc:
+            with open(tmp_dst, 'wb') as fdst:
+                copy_file_data(fsrc, fdst, st.st_size)
+                fdst.flush()
+                os.fsync(fdst.fileno())
+    os.chmod(tmp_dst, stat.S_IMODE(st.st_mode))
+    os.utime(tmp_dst, (st.st_atime, st.st_mtime))
+    os.rename(tmp_dst, dst)
+
+def compress_file(src, dst):
+    # Writes a gzip compressed copy of src to dst atomically, keeping src's mode and mtime
+    st = os.stat(src)
+    tmp_dst = os.path.join(os.path.dirname(dst), '.' + os.path.basename(dst) + '.tmp')
+    with trace.span('compress ' + os.path.basename(src), 'sync', src=src, dst=dst, bytes=st.st_size) as s:
+        with open(src, 'rb') as fsrc:
+            with open(tmp_dst, 'wb') as fraw:
+                fdst = gzip.GzipFile(filename='', mode='wb', fileobj=fraw, mtime=int(st.st_mtime))
+                try:
+                    shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+                finally:
+                    fdst.close()
+                fraw.flush()
+                os.fsync(fraw.fileno())
+                s.set(bytes_written=fraw.tell())
+    os.chmod(tmp_dst, stat.S_IMODE(st.st_mode))
+    os.utime(tmp_dst, (st.st_atime, st.st_mtime))
+    os.rename(tmp_dst, dst)
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,111 @@
+"""
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+    Copyright (c) 2018 Riley Baxter
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import multiprocessing
+import os
+
+from .fetch import CHUNK_SIZE, checksum_matches, new_hasher
+
+# Result of checking one archive
+VERIFIED = 'verified'
+CORRUPT = 'corrupt'
+UNKNOWN = 'unknown'
+
+def hash_file(job):
+    # Runs in a worker process: job is (path, checksum), returns (path, matches)
+    path, checksum = job
+    hasher = new_hasher(checksum)
+    with open(path, 'rb') as f:
+        # The whole file is read front to back exactly once
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return (path, checksum_matches(hasher, checksum))
+
+def record_verified(manifest, archives_dir, filename, checksum):
+    # Remember that filename, as it is right now, matches checksum
+    st = os.stat(os.path.join(archives_dir, filename))
+    manifest[filename] = (st.st_size, st.st_mtime, checksum)
+
+def is_verified(manifest, filename, st):
+    entry = manifest.get(filename)
+    return entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime
+
+def verify_archives(archives_dir, manifest, lookup_checksums, jobs=None):
+    # Checks every package in archives_dir, only hashing files that aren't already in the manifest
+    # with the same size and mtime. lookup_checksums is called (at most once) with the files the manifest
+    # knows nothing about and returns {filename: expected checksum} for those it can find.
+    # Returns (dict of filename -> result, number of files answered from the manifest)
+    results = {}
+    to_hash = {}
+    unknown = []
+    cached = 0
+    present = set()
+    for filename in os.listdir(archives_dir):
+        path = os.path.join(archives_dir, filename)
+        if not filename.endswith('.deb') or not os.path.isfile(path):
+            continue
+        present.add(filename)
+        st = os.stat(path)
+        if is_verified(manifest, filename, st):
+            results[filename] = VERIFIED
+            cached += 1
+        elif filename in manifest and manifest[filename][2]:
+            to_hash[path] = manifest[filename][2]
+        else:
+            unknown.append(filename)
+
+    # Drop entries for files that are gone
+    for filename in list(manifest):
+        if filename not in present:
+            del manifest[filename]
+
+    if unknown:
+        checksums = lookup_checksums(unknown)
+        for filename in unknown:
+            checksum = checksums.get(filename)
+            if checksum and new_hasher(checksum):
+                to_hash[os.path.join(archives_dir, filename)] = checksum
+            else:
+                results[filename] = UNKNOWN
+
+    if to_hash:
+        # Biggest files first so one large package doesn't end up alone at the tail of the run
+        work = sorted(to_hash.items(), key=lambda job: -os.path.getsize(job[0]))
+        pool = multiprocessing.Pool(jobs or multiprocessing.cpu_count())
+        try:
+            for path, matches in pool.imap_unordered(hash_file, work):
+                filename = os.path.basename(path)
+                if matches:
+                    results[filename] = VERIFIED
+                    record_verified(manifest, archives_dir, filename, to_hash[path])
+                else:
+                    results[filename] = CORRUPT
+                    # Keep the expected checksum, but never treat the file as verified
+                    manifest[filename] = (None, None, to_hash[path])
+        finally:
+            pool.close()
+            pool.join()
+
+    return (results, cached)
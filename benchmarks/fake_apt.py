@@ -0,0 +1,131 @@
+"""
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+    Copyright (c) 2018 Riley Baxter
+"""
+
+# Scriptable stand-in for apt-get, apt-cache, apt-mark and dpkg used by the benchmarks.
+# Invoked as: python fake_apt.py <command> [args...]
+#
+# Behaviour is controlled through the environment:
+#   FAKE_APT_LOG        file to append one line per invocation to (to count subprocesses)
+#   FAKE_APT_LATENCY    seconds every invocation takes before answering (default 0)
+#   FAKE_APT_POOL       directory of synthetic archives, with an "index" file of "filename size sha256" lines
+#   FAKE_APT_URI_BASE   URI the pool is served from
+#   FAKE_APT_OUTPUT_LINES  extra "already the newest version" lines in every resolution (default 0)
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import sys
+import time
+
+def pool_index():
+    # [(filename, size, sha256), ...] of the synthetic archives, in pool order
+    index = []
+    with open(os.path.join(os.environ['FAKE_APT_POOL'], 'index')) as f:
+        for line in f:
+            filename, size, sha256 = line.split()
+            index.append((filename, int(size), sha256))
+    return index
+
+def option_value(args, name):
+    # Value of "--option name=value" (or "-o name=value") in args, None if not given
+    for i, arg in enumerate(args[:-1]):
+        if arg in ('--option', '-o') and args[i + 1].startswith(name + '='):
+            return args[i + 1][len(name) + 1:]
+    return None
+
+def print_plan(section, archives):
+    # Mimic apt-get's --print-uris output for a transaction fetching archives
+    names = [ filename.split('_')[0] for filename, _, _ in archives ]
+    print('Reading package lists...')
+    print('Building dependency tree...')
+    print('Reading state information...')
+    for i in range(int(os.environ.get('FAKE_APT_OUTPUT_LINES', '0'))):
+        print('bench-filler-' + str(i) + ' is already the newest version (1.0).')
+    if archives:
+        print('The following ' + section + ':')
+        for i in range(0, len(names), 8):
+            print('  ' + ' '.join(names[i:i + 8]))
+    upgraded = len(archives) if section == 'packages will be upgraded' else 0
+    print('%d upgraded, %d newly installed, 0 to remove and 0 not upgraded.' % (upgraded, len(archives) - upgraded))
+    if archives:
+        print('Need to get ' + str(sum(size for _, size, _ in archives)) + ' B of archives.')
+    uri_base = os.environ.get('FAKE_APT_URI_BASE', 'http://127.0.0.1/')
+    for filename, size, sha256 in archives:
+        print("'" + uri_base + filename + "' " + filename + ' ' + str(size) + ' SHA256:' + sha256)
+
+def print_simulation(archives):
+    # Mimic apt-get --simulate: unpack everything, then configure it
+    for action in ('Inst', 'Conf'):
+        for filename, _, _ in archives:
+            name, version, arch = filename[:-4].split('_')
+            print(action + ' ' + name + ' (' + version + ' bench [' + arch + '])')
+
+def apt_get(args):
+    command = [ a for a in args if not a.startswith('-') and '=' not in a and not a.endswith('.conf') ]
+    if not command:
+        return 100
+    if command[0] == 'indextargets':
+        # Every list on the medium belongs to every target
+        lists_dir = os.path.join(option_value(args, 'Dir') or '/', 'lists')
+        for name in sorted(os.listdir(lists_dir)):
+            if name.endswith('.gz'):
+                print(os.path.join(lists_dir, name[:-3]))
+        return 0
+    simulate = '--simulate' in args or '-s' in args
+    if '--print-uris' not in args and not simulate:
+        # update, and installs the benchmarks never really carry out
+        return 0
+    if command[0] in ('upgrade', 'dist-upgrade'):
+        archives = [ a for a in pool_index() if a[0].startswith('bench-upgrade-') ]
+        section = 'packages will be upgraded'
+    elif command[0] == 'install':
+        # Installing "name" pulls in every pool archive of "name" and its "name-<n>" dependencies
+        wanted = [ c.split('=')[0] for c in command[1:] ]
+        archives = [ a for a in pool_index() if any(a[0].split('_')[0] == w or a[0].startswith(w + '-') for w in wanted) ]
+        section = 'NEW packages will be installed'
+    else:
+        return 100
+    if simulate:
+        print_simulation(archives)
+    else:
+        print_plan(section, archives)
+    return 0
+
+def dpkg(args):
+    if '--print-architecture' in args:
+        print('amd64')
+    return 0
+
+def main():
+    name = sys.argv[1]
+    args = sys.argv[2:]
+    log = os.environ.get('FAKE_APT_LOG')
+    if log:
+        with open(log, 'a') as f:
+            f.write(name + ' ' + ' '.join(args) + '\n')
+    time.sleep(float(os.environ.get('FAKE_APT_LATENCY', '0')))
+
+    if name == 'apt-get':
+        return apt_get(args)
+    if name == 'dpkg':
+        return dpkg(args)
+    # apt-cache gencaches, apt-mark showmanual/auto
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
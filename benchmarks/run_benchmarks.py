@@ -0,0 +1,383 @@
+"""
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, write to the Free Software
+    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+    Copyright (c) 2018 Riley Baxter
+"""
+
+# Measures how apt-medium's actions scale on synthetic media, without root, a Debian host or network access.
+# apt-get, apt-cache, apt-mark and dpkg are replaced by fake_apt.py, archives are served from localhost.
+#
+#   python benchmarks/run_benchmarks.py --targets 50 --lists 20 --archives 500
+#
+# Every run is appended to a results file together with the commit it ran on and compared
+# with the previous run of the same configuration.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+ACTIONS = ['init', 'update', 'install', 'upgrade', 'download']
+METRICS = ['wall_time', 'subprocesses', 'bytes_read', 'bytes_written', 'peak_memory']
+
+# Debs each queued package set pulls in, and extra packages for the install and upgrade runs
+DEBS_PER_SET = 10
+EXTRA_DEBS = 10
+UPGRADE_DEBS = 20
+
+def parse_args(in_args):
+    parser = argparse.ArgumentParser(description='Benchmark apt-medium actions on a synthetic installation medium.')
+    parser.add_argument('--targets', type=int, default=10, help='number of targets on the medium (default 10)')
+    parser.add_argument('--sets', type=int, default=5, help='number of distinct package sets queued across the targets, targets sharing a set are clones (default 5)')
+    parser.add_argument('--lists', type=int, default=10, help='number of package lists on the medium (default 10)')
+    parser.add_argument('--list-packages', type=int, default=2000, help='packages in each list (default 2000)')
+    parser.add_argument('--archives', type=int, default=50, help='number of the queued archives already on the medium (default 50)')
+    parser.add_argument('--archive-size', type=int, default=64 * 1024, help='size of each synthetic archive in bytes (default 65536)')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds each fake apt-get/dpkg run takes (default 0.05)')
+    parser.add_argument('--output-lines', type=int, default=0, help='extra lines of output in each fake resolution (default 0)')
+    parser.add_argument('--repeat', type=int, default=1, help='run everything this many times on fresh media and keep the best time (default 1)')
+    parser.add_argument('--actions', default=','.join(ACTIONS), help='comma separated actions to run, in order (default ' + ','.join(ACTIONS) + ')')
+    parser.add_argument('--results', default=os.path.join(BENCH_DIR, 'results.jsonl'), help='file results are appended to and compared against (default benchmarks/results.jsonl)')
+    parser.add_argument('--fail-threshold', type=float, help='exit with an error if an action got this many percent slower than the previous run')
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic media for inspection')
+    return parser.parse_args(in_args)
+
+def write_archive(path, name, size):
+    # Synthetic .deb: deterministic content so reruns produce identical pools
+    block = hashlib.sha256(name.encode('utf-8')).digest() * 32
+    with open(path, 'wb') as f:
+        left = size
+        while left > 0:
+            f.write(block[:left])
+            left -= len(block)
+
+def make_pool(pool_dir, sets, archive_size):
+    # Archives the fake apt-get can resolve to, with an index of their sizes and checksums
+    os.mkdir(pool_dir)
+    names = []
+    for s in range(sets):
+        names.extend('bench-set-' + str(s) + '-' + str(i) for i in range(DEBS_PER_SET))
+    names.extend('bench-extra-' + str(i) for i in range(EXTRA_DEBS))
+    names.extend('bench-upgrade-' + str(i) for i in range(UPGRADE_DEBS))
+    with open(os.path.join(pool_dir, 'index'), 'w') as index:
+        for name in names:
+            filename = name + '_1.0_all.deb'
+            path = os.path.join(pool_dir, filename)
+            write_archive(path, name, archive_size)
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+            index.write(filename + ' ' + str(archive_size) + ' ' + digest.hexdigest() + '\n')
+
+def write_list(path, number, packages):
+    with gzip.open(path, 'wb') as f:
+        for i in range(packages):
+            name = 'bench-list' + str(number) + '-' + str(i)
+            f.write(('Package: ' + name + '\n'
+                     'Version: 1.0\n'
+                     'Architecture: all\n'
+                     'Filename: pool/main/b/' + name + '_1.0_all.deb\n'
+                     'Size: 1024\n'
+                     'SHA256: ' + hashlib.sha256(name.encode('utf-8')).hexdigest() + '\n'
+                     'Description: synthetic benchmark package\n\n').encode('utf-8'))
+
+def write_target(medium, target, installed):
+    # What "init" would have put on the medium for a target
+    system_dir = os.path.join('system_info', target)
+    apt_dir = os.path.join(medium, system_dir, 'etc', 'apt')
+    os.makedirs(os.path.join(apt_dir, 'apt.conf.d'))
+    with open(os.path.join(medium, system_dir, 'dpkg-status'), 'w') as f:
+        for i in range(installed):
+            f.write('Package: bench-installed-' + str(i) + '\nStatus: install ok installed\nArchitecture: all\nVersion: 1.0\n\n')
+    with open(os.path.join(apt_dir, 'sources.list'), 'w') as f:
+        f.write('deb http://127.0.0.1/bench stable main\n')
+    open(os.path.join(apt_dir, 'apt.conf'), 'w').close()
+    with open(os.path.join(apt_dir, 'apt-medium.conf'), 'w') as f:
+        f.write('APT\n    {\n    Architecture "amd64";\n    Get::List-Cleanup "false";\n    };\n'
+                'Dir\n    {\n    State "./' + system_dir + '";\n    State::status "dpkg-status";\n'
+                '    State::Lists "./lists";\n    Cache "./' + system_dir + '";\n'
+                '    Cache::archives "./archives";\n    Etc "./' + system_dir + '/etc/apt";\n    };\n')
+
+def make_medium(medium, pool_dir, args):
+    # Synthetic installation medium: targets with queued downloads, package lists and some archives already fetched
+    sys.path.insert(0, REPO_DIR)
+    from apt_medium.state import add_target, queue_add, transaction
+
+    for directory in ['lists/partial', 'archives/partial', 'var/log/apt', 'var/lib/apt-medium']:
+        os.makedirs(os.path.join(medium, directory))
+    for k in range(args.lists):
+        write_list(os.path.join(medium, 'lists', '127.0.0.1_bench_dists_stable-' + str(k) + '_main_binary-amd64_Packages.gz'), k, args.list_packages)
+
+    with open(os.path.join(pool_dir, 'index')) as f:
+        queued = [ line.split()[0] for line in f if line.startswith('bench-set-') ]
+    for filename in queued[:args.archives]:
+        shutil.copy(os.path.join(pool_dir, filename), os.path.join(medium, 'archives', filename))
+
+    with transaction(os.path.join(medium, 'medium_state')) as conn:
+        for t in range(args.targets):
+            target = 'bench-host-' + str(t)
+            write_target(medium, target, 200)
+            add_target(conn, target)
+            queue_add(conn, 'download_queue', target, ['bench-set-' + str(t % max(1, args.sets))])
+
+def read_proc_io():
+    # Bytes this process has had read from and sent to storage, None where /proc isn't available.
+    # Unlike rchar/wchar these leave out pipes, sockets and reads answered from the page cache.
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return (int(fields['read_bytes']), int(fields['write_bytes']) - int(fields['cancelled_write_bytes']))
+    except (IOError, OSError, KeyError) as _:
+        return None
+
+def evict_medium(medium):
+    # Flushes the medium and drops its files from the page cache, so the action's reads of it reach storage
+    # (and show up in read_bytes) rather than depending on what earlier actions left cached
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    os.sync()
+    for dirpath, dirnames, filenames in os.walk(medium):
+        for filename in filenames:
+            try:
+                fd = os.open(os.path.join(dirpath, filename), os.O_RDONLY)
+            except OSError as _:
+                continue
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+def child_main(result_file, apt_medium_args):
+    # Runs one apt-medium action in this (fresh) process and records what it cost
+    import resource
+    sys.path.insert(0, REPO_DIR)
+    from apt_medium.apt_medium import parse_args as am_parse_args, process_args
+
+    args = am_parse_args(apt_medium_args)
+    io_before = read_proc_io()
+    start = time.time()
+    retCode = process_args(args)
+    wall_time = time.time() - start
+    io_after = read_proc_io()
+
+    result = {'exit_code': retCode,
+              'wall_time': wall_time,
+              'peak_memory': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+    if io_before and io_after:
+        result['bytes_read'] = io_after[0] - io_before[0]
+        result['bytes_written'] = io_after[1] - io_before[1]
+    with open(result_file, 'w') as f:
+        json.dump(result, f)
+    return 0
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def serve_pool(pool_dir):
+    # Serves the pool on localhost from a background thread, returns (server, base URI)
+    class Handler(SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            return os.path.join(pool_dir, os.path.basename(path.split('?')[0]))
+        def log_message(self, *args):
+            pass
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return (server, 'http://127.0.0.1:' + str(server.server_address[1]) + '/')
+
+def make_fake_bin(bin_dir):
+    # apt-get, apt-cache, apt-mark and dpkg on PATH all run fake_apt.py
+    os.mkdir(bin_dir)
+    for name in ['apt-get', 'apt-cache', 'apt-mark', 'dpkg']:
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nexec "' + sys.executable + '" "' + os.path.join(BENCH_DIR, 'fake_apt.py') + '" ' + name + ' "$@"\n')
+        os.chmod(path, 0o755)
+
+def action_args(action, medium):
+    args = ['-m', medium, action]
+    if action == 'install':
+        args.extend(['-t', 'bench-host-0', 'bench-extra'])
+    elif action == 'upgrade':
+        args.extend(['-t', 'bench-host-0'])
+    elif action == 'download':
+        args.extend(['--reserve', '0'])
+    return args
+
+def run_action(action, medium, env, work_dir):
+    log = env['FAKE_APT_LOG']
+    open(log, 'w').close()
+    result_file = os.path.join(work_dir, 'result.json')
+    output_file = os.path.join(work_dir, action + '.log')
+    evict_medium(medium)
+    with open(output_file, 'w') as output:
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', result_file, '--'] + action_args(action, medium),
+                                env=env, stdin=subprocess.PIPE, stdout=output, stderr=subprocess.STDOUT)
+        # Answer yes to every prompt
+        proc.communicate(b'y' * 64)
+    if proc.returncode != 0 or not os.path.isfile(result_file):
+        with open(output_file) as f:
+            raise Exception('Benchmark of ' + action + ' failed:\n' + f.read()[-2000:])
+    with open(result_file) as f:
+        result = json.load(f)
+    os.unlink(result_file)
+    if result['exit_code'] != 0:
+        with open(output_file) as f:
+            raise Exception('apt-medium ' + action + ' returned ' + str(result['exit_code']) + ':\n' + f.read()[-2000:])
+    with open(log) as f:
+        result['subprocesses'] = len(f.readlines())
+    return result
+
+def run_once(args, actions):
+    work_dir = tempfile.mkdtemp(prefix='apt-medium-bench-')
+    server = None
+    try:
+        pool_dir = os.path.join(work_dir, 'pool')
+        medium = os.path.join(work_dir, 'medium')
+        bin_dir = os.path.join(work_dir, 'bin')
+        make_pool(pool_dir, args.sets, args.archive_size)
+        os.mkdir(medium)
+        make_medium(medium, pool_dir, args)
+        make_fake_bin(bin_dir)
+        server, uri_base = serve_pool(pool_dir)
+
+        env = dict(os.environ)
+        env['PATH'] = bin_dir + os.pathsep + env.get('PATH', '')
+        env['FAKE_APT_LOG'] = os.path.join(work_dir, 'apt-calls')
+        env['FAKE_APT_LATENCY'] = str(args.latency)
+        env['FAKE_APT_POOL'] = pool_dir
+        env['FAKE_APT_URI_BASE'] = uri_base
+        env['FAKE_APT_OUTPUT_LINES'] = str(args.output_lines)
+
+        return dict((action, run_action(action, medium, env, work_dir)) for action in actions)
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+        if args.keep:
+            print('Synthetic medium kept in ' + work_dir)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except (subprocess.CalledProcessError, OSError) as _:
+        return None
+
+def load_results(path):
+    results = []
+    if os.path.isfile(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    results.append(json.loads(line))
+    return results
+
+def format_metric(metric, value):
+    if value is None:
+        return '-'
+    if metric == 'wall_time':
+        return '%.3fs' % value
+    if metric == 'subprocesses':
+        return str(value)
+    return '{:,}'.format(value)
+
+def report(results, previous):
+    # Prints one row per action, with the change from the previous comparable run where there is one
+    print('%-10s' % 'action' + ''.join('%20s' % m for m in METRICS))
+    slowdowns = {}
+    for action in results:
+        row = '%-10s' % action
+        for metric in METRICS:
+            value = results[action].get(metric)
+            cell = format_metric(metric, value)
+            old = previous and previous['results'].get(action, {}).get(metric)
+            if old and value is not None:
+                change = (value - old) * 100.0 / old
+                cell += ' (%+.0f%%)' % change
+                if metric == 'wall_time':
+                    slowdowns[action] = change
+            row += '%20s' % cell
+        print(row)
+    return slowdowns
+
+def main(in_args):
+    if in_args[:1] == ['--child']:
+        return child_main(in_args[1], in_args[3:])
+
+    args = parse_args(in_args)
+    actions = [ a for a in args.actions.split(',') if a ]
+    unknown = [ a for a in actions if a not in ACTIONS ]
+    if unknown:
+        print('Unknown action(s): ' + ', '.join(unknown))
+        return 1
+
+    results = None
+    for _ in range(max(1, args.repeat)):
+        run = run_once(args, actions)
+        if results is None:
+            results = run
+            continue
+        for action in actions:
+            results[action]['wall_time'] = min(results[action]['wall_time'], run[action]['wall_time'])
+
+    config = dict((key, getattr(args, key)) for key in ['targets', 'sets', 'lists', 'list_packages', 'archives', 'archive_size', 'latency', 'output_lines'])
+    history = load_results(args.results)
+    previous = None
+    for entry in reversed(history):
+        if entry['config'] == config:
+            previous = entry
+            break
+
+    print('Configuration: ' + ', '.join(k + '=' + str(config[k]) for k in sorted(config)))
+    if previous:
+        print('Compared with commit ' + str(previous['commit']) + ' (' + previous['time'] + ')')
+    slowdowns = report(results, previous)
+
+    with open(args.results, 'a') as f:
+        f.write(json.dumps({'commit': git_commit(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': sys.version.split()[0],
+                            'config': config, 'results': results}, sort_keys=True) + '\n')
+
+    if args.fail_threshold is not None:
+        regressed = sorted(a for a, change in slowdowns.items() if change > args.fail_threshold)
+        if regressed:
+            print('Slower than the previous run by more than ' + str(args.fail_threshold) + '%: ' + ', '.join(regressed))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
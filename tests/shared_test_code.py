@@ -1,8 +1,17 @@
 from apt_medium.apt_medium import parse_args, process_args
 import os
 import pytest
+import re
 import shutil
 import tempfile
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
 
 def run(args):
     parsed_args = parse_args(args)
@@ -32,3 +41,64 @@ class init_non_cwd:
     def __exit__(self, exc_type, exc_val, exc_tb):
         shutil.rmtree(self.tempdir)
         shutil.rmtree(self.cwd)
+
+class http_server:
+    # Serves the files in a directory over HTTP/1.1 on localhost (with Range support),
+    # counting client connections and body bytes sent and recording (path, Authorization, Proxy-Authorization)
+    # for every request. Also answers proxy requests for the absolute URI of any host.
+    def __init__(self, root, support_ranges=True):
+        self.root = root
+        self.support_ranges = support_ranges
+        self.server = None
+        self.thread = None
+    def __enter__(self):
+        root = self.root
+        support_ranges = self.support_ranges
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def setup(self):
+                self.server.connections += 1
+                BaseHTTPRequestHandler.setup(self)
+            def do_GET(self):
+                self.server.requests.append((self.path, self.headers.get('Authorization'), self.headers.get('Proxy-Authorization')))
+                path = os.path.join(root, re.sub(r'^[a-z]+://[^/]*', '', self.path).split('?', 1)[0].lstrip('/'))
+                if not os.path.isfile(path):
+                    self.send_error(404)
+                    return
+                with open(path, 'rb') as f:
+                    data = f.read()
+                match = re.match(r'bytes=(\d+)-$', self.headers.get('Range') or '')
+                if match and support_ranges:
+                    start = int(match.group(1))
+                    if start >= len(data):
+                        self.send_response(416)
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(data) - 1, len(data)))
+                    data = data[start:]
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                # Counted before writing so the client can never finish reading ahead of the count
+                self.server.bytes_sent += len(data)
+                self.wfile.write(data)
+            def log_message(self, *args):
+                pass
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.connections = 0
+        self.server.bytes_sent = 0
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+    def url(self, path):
+        return 'http://127.0.0.1:%d/%s' % (self.server.server_address[1], path)
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.shutdown()
+        self.server.server_close()
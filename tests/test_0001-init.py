@@ -1,8 +1,11 @@
-from .shared_test_code import init_cwd, init_non_cwd
-from apt_medium.apt_medium import load_medium_state
+from .shared_test_code import init_cwd, init_non_cwd, run
+from apt_medium.apt_medium import load_medium_state, sync_local_lists, sync_tree
+import gzip
 import os
 import pytest
+import shutil
 import socket
+import tempfile
 
 def verify(initDir):
     os.chdir(initDir)
@@ -32,3 +35,89 @@ def test_init_non_cwd():
     with init_non_cwd() as (retCode, initDir):
         assert retCode == 0
         verify(initDir)
+
+def read_list(path):
+    with gzip.open(path, 'rb') as f:
+        return f.read().decode('utf-8')
+
+# Test that only new or changed lists are copied (compressed) to the medium
+def test_sync_local_lists():
+    local_lists = tempfile.mkdtemp()
+    try:
+        with init_cwd() as (retCode, initDir):
+            for name in ['a_Packages', 'b_Packages', 'a_InRelease']:
+                with open(os.path.join(local_lists, name), 'w') as f:
+                    f.write(name)
+            # A copy stored before lists were kept compressed is replaced
+            with open(os.path.join('lists', 'a_Packages'), 'w') as f:
+                f.write('old')
+            sync_local_lists(local_lists)
+            for name in ['a_Packages', 'b_Packages']:
+                assert read_list(os.path.join('lists', name + '.gz')) == name
+                assert os.path.getmtime(os.path.join('lists', name + '.gz')) == os.path.getmtime(os.path.join(local_lists, name))
+            assert not os.path.exists(os.path.join('lists', 'a_Packages'))
+            with open(os.path.join('lists', 'a_InRelease')) as f:
+                assert f.read() == 'a_InRelease'
+            inodes = dict((name, os.stat(os.path.join('lists', name + '.gz')).st_ino) for name in ['a_Packages', 'b_Packages'])
+
+            # Change one list's contents and only touch the other
+            with open(os.path.join(local_lists, 'a_Packages'), 'w') as f:
+                f.write('changed')
+            os.utime(os.path.join(local_lists, 'a_Packages'), (2000000000, 2000000000))
+            os.utime(os.path.join(local_lists, 'b_Packages'), (2000000000, 2000000000))
+            sync_local_lists(local_lists)
+            assert read_list(os.path.join('lists', 'a_Packages.gz')) == 'changed'
+            assert os.stat(os.path.join('lists', 'a_Packages.gz')).st_ino != inodes['a_Packages']
+            assert os.stat(os.path.join('lists', 'b_Packages.gz')).st_ino == inodes['b_Packages']
+            assert os.path.getmtime(os.path.join('lists', 'b_Packages.gz')) == 2000000000
+
+            # Lists on the medium that are newer than the local copy are left alone
+            with gzip.open(os.path.join('lists', 'b_Packages.gz'), 'wb') as f:
+                f.write(b'newer')
+            os.utime(os.path.join(local_lists, 'b_Packages'), (2000000001, 2000000001))
+            os.utime(os.path.join('lists', 'b_Packages.gz'), (2000000002, 2000000002))
+            sync_local_lists(local_lists)
+            assert read_list(os.path.join('lists', 'b_Packages.gz')) == 'newer'
+    finally:
+        shutil.rmtree(local_lists)
+
+# Test that initializing again leaves unchanged system information untouched
+def test_init_unchanged():
+    with init_cwd() as (retCode, initDir):
+        hostname = socket.gethostname()
+        paths = [ os.path.join('system_info', hostname, 'dpkg-status'),
+                  os.path.join('system_info', hostname, 'etc', 'apt', 'apt-medium.conf') ]
+        for dirpath, dirnames, filenames in os.walk(os.path.join('system_info', hostname, 'etc', 'apt')):
+            paths.extend(os.path.join(dirpath, name) for name in filenames)
+        inodes = dict((path, os.stat(path).st_ino) for path in paths)
+        assert run(['init']) == 0
+        assert dict((path, os.stat(path).st_ino) for path in paths) == inodes
+        verify(initDir)
+
+# Test mirroring a directory tree by only writing what changed
+def test_sync_tree():
+    src = tempfile.mkdtemp()
+    dst = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(src, 'sub', 'dir'))
+        for name in ['a', os.path.join('sub', 'dir', 'b')]:
+            with open(os.path.join(src, name), 'w') as f:
+                f.write(name)
+        manifest = {}
+        assert sync_tree(src, dst, manifest)
+        with open(os.path.join(dst, 'sub', 'dir', 'b')) as f:
+            assert f.read() == os.path.join('sub', 'dir', 'b')
+        assert not sync_tree(src, dst, manifest)
+
+        with open(os.path.join(src, 'a'), 'w') as f:
+            f.write('changed')
+        os.utime(os.path.join(src, 'a'), (2000000000, 2000000000))
+        shutil.rmtree(os.path.join(src, 'sub'))
+        assert sync_tree(src, dst, manifest)
+        with open(os.path.join(dst, 'a')) as f:
+            assert f.read() == 'changed'
+        assert os.listdir(dst) == ['a']
+        assert list(manifest) == ['a']
+    finally:
+        shutil.rmtree(src)
+        shutil.rmtree(dst)
@@ -0,0 +1,118 @@
+from .shared_test_code import init_cwd
+from apt_medium.apt_medium import compress_lists, prune_srcpkgcaches, sources_fingerprint, srcpkgcache_file, stage_lists, merge_staged_lists
+import gzip
+import os
+import pytest
+import shutil
+import tempfile
+import time
+
+from multiprocessing.pool import ThreadPool
+
+clonehostname = 'clonedsystem'
+
+# Test that identical source configurations are grouped together
+def test_fingerprint_clone(hostname):
+    with init_cwd() as (retCode, initDir):
+        shutil.copytree(os.path.join('system_info', hostname), os.path.join('system_info', clonehostname))
+        orig = sources_fingerprint(os.path.join('system_info', hostname, 'etc', 'apt'))
+        clone = sources_fingerprint(os.path.join('system_info', clonehostname, 'etc', 'apt'))
+        assert orig == clone
+
+# Test that changing sources or architectures splits targets into separate groups
+def test_fingerprint_changed(hostname):
+    with init_cwd() as (retCode, initDir):
+        shutil.copytree(os.path.join('system_info', hostname), os.path.join('system_info', clonehostname))
+        orig = sources_fingerprint(os.path.join('system_info', hostname, 'etc', 'apt'))
+        clone_apt_dir = os.path.join('system_info', clonehostname, 'etc', 'apt')
+
+        with open(os.path.join(clone_apt_dir, 'sources.list'), 'a') as f:
+            f.write('deb http://example.invalid/debian stable main\n')
+        changed_sources = sources_fingerprint(clone_apt_dir)
+        assert changed_sources != orig
+
+        with open(os.path.join(clone_apt_dir, 'apt-medium.conf'), 'a') as f:
+            f.write('    Architectures {"armhf";};\n')
+        assert sources_fingerprint(clone_apt_dir) not in [orig, changed_sources]
+
+# Test that targets share apt's source package cache exactly when they share their sources
+def test_shared_srcpkgcache(hostname):
+    with init_cwd() as (retCode, initDir):
+        shutil.copytree(os.path.join('system_info', hostname), os.path.join('system_info', clonehostname))
+        orig = srcpkgcache_file(os.path.join('system_info', hostname, 'etc', 'apt'))
+        clone_apt_dir = os.path.join('system_info', clonehostname, 'etc', 'apt')
+        assert srcpkgcache_file(clone_apt_dir) == orig
+        assert orig.startswith(os.path.join(initDir, 'var', 'lib', 'apt-medium', 'srcpkgcache'))
+
+        with open(os.path.join(clone_apt_dir, 'sources.list'), 'a') as f:
+            f.write('deb http://example.invalid/debian stable main\n')
+        changed = srcpkgcache_file(clone_apt_dir)
+        assert changed != orig
+
+        for path in [orig, changed]:
+            open(path, 'w').close()
+        prune_srcpkgcaches(initDir, [orig])
+        assert os.path.exists(orig)
+        assert not os.path.exists(changed)
+
+# Test that update's worker threads can all locate the shared cache on a fresh medium at once
+def test_srcpkgcache_concurrent(hostname, monkeypatch):
+    # Widen the window between checking for the directory and creating it
+    mkdir = os.mkdir
+    monkeypatch.setattr(os, 'mkdir', lambda *args: time.sleep(0.01) or mkdir(*args))
+    with init_cwd() as (retCode, initDir):
+        apt_dir = os.path.join('system_info', hostname, 'etc', 'apt')
+        cache_dir = os.path.join('var', 'lib', 'apt-medium', 'srcpkgcache')
+        for _ in range(20):
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            pool = ThreadPool(8)
+            try:
+                results = pool.map(lambda _: srcpkgcache_file(apt_dir), range(8))
+            finally:
+                pool.close()
+                pool.join()
+            assert len(set(results)) == 1
+            assert os.path.isdir(cache_dir)
+
+# Test that lists fetched into a staging directory replace the shared copies
+def test_staged_lists():
+    lists_dir = tempfile.mkdtemp()
+    staging_dir = tempfile.mkdtemp()
+    try:
+        for name in ['unchanged_Packages', 'changed_Packages', 'lock']:
+            with open(os.path.join(lists_dir, name), 'w') as f:
+                f.write('old')
+        stage_lists(lists_dir, staging_dir)
+        assert os.path.isdir(os.path.join(staging_dir, 'partial'))
+        assert not os.path.exists(os.path.join(staging_dir, 'lock'))
+
+        # Simulate apt-get replacing one list and fetching a new one
+        with open(os.path.join(staging_dir, 'changed_Packages.new'), 'w') as f:
+            f.write('new')
+        os.rename(os.path.join(staging_dir, 'changed_Packages.new'), os.path.join(staging_dir, 'changed_Packages'))
+        with open(os.path.join(staging_dir, 'added_Packages'), 'w') as f:
+            f.write('new')
+
+        merge_staged_lists(staging_dir, lists_dir)
+        for name, content in [('unchanged_Packages', 'old'), ('changed_Packages', 'new'), ('added_Packages', 'new')]:
+            with open(os.path.join(lists_dir, name)) as f:
+                assert f.read() == content
+    finally:
+        shutil.rmtree(lists_dir)
+        shutil.rmtree(staging_dir)
+
+# Test that lists left uncompressed are gzipped in place, keeping their timestamp
+def test_compress_lists():
+    lists_dir = tempfile.mkdtemp()
+    try:
+        for name in ['x_Packages', 'x_InRelease', 'x_Translation-en']:
+            with open(os.path.join(lists_dir, name), 'w') as f:
+                f.write(name)
+            os.utime(os.path.join(lists_dir, name), (1000000000, 1000000000))
+        compress_lists(lists_dir)
+        assert sorted(os.listdir(lists_dir)) == ['x_InRelease', 'x_Packages.gz', 'x_Translation-en.gz']
+        with gzip.open(os.path.join(lists_dir, 'x_Packages.gz'), 'rb') as f:
+            assert f.read() == b'x_Packages'
+        assert os.path.getmtime(os.path.join(lists_dir, 'x_Packages.gz')) == 1000000000
+    finally:
+        shutil.rmtree(lists_dir)
@@ -0,0 +1,154 @@
+from .shared_test_code import http_server
+from apt_medium.fetch import AcquireConfig, acquire_config, fetch_all, parse_auth_conf, parse_uri_item
+import base64
+import hashlib
+import os
+import pytest
+import shutil
+import tempfile
+
+@pytest.fixture
+def mirror():
+    root = tempfile.mkdtemp()
+    archives = tempfile.mkdtemp()
+    os.mkdir(os.path.join(archives, 'partial'))
+    packages = {}
+    for i in range(8):
+        name = 'pkg%d_1.0_all.deb' % i
+        data = os.urandom(1000 + i * 50000)
+        with open(os.path.join(root, name), 'wb') as f:
+            f.write(data)
+        packages[name] = data
+    with http_server(root) as server:
+        yield (server, root, archives, packages)
+    shutil.rmtree(root)
+    shutil.rmtree(archives)
+
+def uri_item(server, name, data, checksum=None):
+    if checksum is None:
+        checksum = 'SHA256:' + hashlib.sha256(data).hexdigest()
+    return ("'" + server.url(name) + "'", name, str(len(data)), checksum)
+
+# Test fetching a set of packages concurrently over reused connections
+def test_fetch_all(mirror):
+    server, root, archives, packages = mirror
+    downloads = [ parse_uri_item(uri_item(server, name, data)) for name, data in packages.items() ]
+    assert fetch_all(downloads, archives, jobs=3) == {}
+    for name, data in packages.items():
+        with open(os.path.join(archives, name), 'rb') as f:
+            assert f.read() == data
+    assert os.listdir(os.path.join(archives, 'partial')) == []
+    assert server.server.connections <= 3
+
+# Test that a corrupt download never makes it into archives
+def test_fetch_hash_mismatch(mirror):
+    server, root, archives, packages = mirror
+    name = sorted(packages)[0]
+    downloads = [ parse_uri_item(uri_item(server, name, packages[name], 'SHA256:' + '0' * 64)) ]
+    failures = fetch_all(downloads, archives)
+    assert list(failures) == [name]
+    assert not os.path.exists(os.path.join(archives, name))
+    assert os.listdir(os.path.join(archives, 'partial')) == []
+
+# Test that a missing file on the mirror is reported without affecting other downloads
+def test_fetch_missing(mirror):
+    server, root, archives, packages = mirror
+    name = sorted(packages)[0]
+    downloads = [ parse_uri_item(uri_item(server, name, packages[name])),
+                  parse_uri_item(uri_item(server, 'missing_1.0_all.deb', b'')) ]
+    failures = fetch_all(downloads, archives)
+    assert list(failures) == ['missing_1.0_all.deb']
+    assert os.path.exists(os.path.join(archives, name))
+
+# Test that an interrupted download is resumed rather than restarted
+def test_fetch_resume(mirror):
+    server, root, archives, packages = mirror
+    name = sorted(packages)[-1]
+    data = packages[name]
+    with open(os.path.join(archives, 'partial', name), 'wb') as f:
+        f.write(data[:len(data) // 2])
+    downloads = [ parse_uri_item(uri_item(server, name, data)) ]
+    assert fetch_all(downloads, archives) == {}
+    with open(os.path.join(archives, name), 'rb') as f:
+        assert f.read() == data
+    assert server.server.bytes_sent == len(data) - len(data) // 2
+
+# Test that a partial file which doesn't match the expected hash is discarded and refetched
+def test_fetch_resume_corrupt(mirror):
+    server, root, archives, packages = mirror
+    name = sorted(packages)[-1]
+    data = packages[name]
+    with open(os.path.join(archives, 'partial', name), 'wb') as f:
+        f.write(b'\0' * (len(data) // 2))
+    downloads = [ parse_uri_item(uri_item(server, name, data)) ]
+    assert fetch_all(downloads, archives) == {}
+    with open(os.path.join(archives, name), 'rb') as f:
+        assert f.read() == data
+    assert os.listdir(os.path.join(archives, 'partial')) == []
+
+# Test resuming against a server that ignores range requests
+def test_fetch_resume_unsupported():
+    root = tempfile.mkdtemp()
+    archives = tempfile.mkdtemp()
+    os.mkdir(os.path.join(archives, 'partial'))
+    try:
+        data = os.urandom(100000)
+        with open(os.path.join(root, 'pkg_1.0_all.deb'), 'wb') as f:
+            f.write(data)
+        with open(os.path.join(archives, 'partial', 'pkg_1.0_all.deb'), 'wb') as f:
+            f.write(data[:5000])
+        with http_server(root, support_ranges=False) as server:
+            downloads = [ parse_uri_item(uri_item(server, 'pkg_1.0_all.deb', data)) ]
+            assert fetch_all(downloads, archives) == {}
+        with open(os.path.join(archives, 'pkg_1.0_all.deb'), 'rb') as f:
+            assert f.read() == data
+    finally:
+        shutil.rmtree(root)
+        shutil.rmtree(archives)
+
+def basic(credentials):
+    return 'Basic ' + base64.b64encode(credentials).decode('ascii')
+
+# Test reading the proxies and credentials a target's apt uses from its configuration
+def test_acquire_config(tmpdir):
+    assert parse_auth_conf('# comment\nmachine example.org/debian login user password secret\nmachine\n  other:8080\nlogin u2\n') == \
+        [('example.org/debian', 'user', 'secret'), ('other:8080', 'u2', '')]
+
+    tmpdir.join('auth.conf').write('machine example.org login a password b\n')
+    tmpdir.mkdir('auth.conf.d').join('extra.conf').write('machine https://example.net login c password d\n')
+    config = [('dir::etc::netrc', 'auth.conf'), ('dir::etc::netrcparts', 'auth.conf.d'),
+              ('acquire::http::proxy', 'http://user:pw@proxy:3128/'), ('acquire::http::proxy::deb.local', 'DIRECT')]
+    assert acquire_config(config, str(tmpdir)) == AcquireConfig({'http': 'http://user:pw@proxy:3128/', ('http', 'deb.local'): 'DIRECT'},
+                                                                [('example.org', 'a', 'b'), ('https://example.net', 'c', 'd')])
+    # Proxies only apt-get knows how to use
+    assert acquire_config([('acquire::http::proxy-auto-detect', '/usr/bin/auto-apt-proxy')], str(tmpdir)) is None
+    assert acquire_config([('acquire::https::proxy', 'socks5h://localhost:9050')], str(tmpdir)) is None
+
+# Test that credentials from the URI or auth.conf are sent, and auth.conf entries without a scheme never go over http
+def test_fetch_auth(mirror):
+    server, root, archives, packages = mirror
+    names = sorted(packages)
+    port = str(server.server.server_address[1])
+    downloads = [ parse_uri_item(uri_item(server, names[0], packages[names[0]])),
+                  parse_uri_item(uri_item(server, names[1], packages[names[1]])),
+                  parse_uri_item(uri_item(server, names[2], packages[names[2]])) ]
+    downloads[0] = (downloads[0][0].replace('http://', 'http://us%40er:p%3Ass@'),) + downloads[0][1:]
+    acquire = AcquireConfig({}, [('127.0.0.1:' + port + '/' + names[1], 'plain', 'x'),
+                                 ('http://127.0.0.1:' + port + '/' + names[2], 'conf', 'pw')])
+    assert fetch_all(downloads, archives, jobs=1, acquire=acquire) == {}
+    sent = dict((path, auth) for path, auth, proxy_auth in server.server.requests)
+    assert sent['/' + names[0]] == basic(b'us@er:p:ss')
+    assert sent['/' + names[1]] is None
+    assert sent['/' + names[2]] == basic(b'conf:pw')
+
+# Test that the target's own proxy settings are used, with per-host exceptions
+def test_fetch_proxy(mirror):
+    server, root, archives, packages = mirror
+    names = sorted(packages)
+    proxy = server.url('').replace('http://', 'http://puser:ppw@')
+    downloads = [ ('http://mirror.invalid/' + names[0], names[0], len(packages[names[0]]), ''),
+                  (server.url(names[1]), names[1], len(packages[names[1]]), '') ]
+    acquire = AcquireConfig({'http': proxy, ('http', '127.0.0.1'): 'DIRECT'}, [])
+    assert fetch_all(downloads, archives, jobs=1, acquire=acquire) == {}
+    assert sorted(server.server.requests) == [('/' + names[1], None, None),
+                                              ('http://mirror.invalid/' + names[0], None, basic(b'puser:ppw'))]
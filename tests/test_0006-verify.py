@@ -0,0 +1,46 @@
+from .shared_test_code import run, init_cwd
+from apt_medium.packages import archive_filename
+import hashlib
+import os
+import pytest
+import re
+
+def add_package(name, version, data):
+    filename = archive_filename(name, version, 'all')
+    with open(os.path.join('archives', filename), 'wb') as f:
+        f.write(data)
+    with open(os.path.join('lists', 'example.invalid_debian_dists_stable_main_binary-all_Packages'), 'a') as f:
+        f.write('Package: %s\nVersion: %s\nArchitecture: all\nFilename: pool/main/%s_%s_all.deb\nSize: %d\nSHA256: %s\n\n'
+                % (name, version, name, version.split(':')[-1], len(data), hashlib.sha256(data).hexdigest()))
+    return filename
+
+# Test checking archives against the package lists, then against the cached manifest
+def test_verify(capsys):
+    with init_cwd() as (retCode, initDir):
+        add_package('alpha', '1.0', os.urandom(5000))
+        add_package('beta', '1:2.0', os.urandom(7000))
+        assert run(['verify']) == 0
+        output = capsys.readouterr().out.splitlines()
+        assert output[-1] == 'Checked 2 packages (0 unchanged since last verified), 0 failed, 0 could not be checked'
+
+        assert run(['verify']) == 0
+        output = capsys.readouterr().out.splitlines()
+        assert output[-1] == 'Checked 2 packages (2 unchanged since last verified), 0 failed, 0 could not be checked'
+
+# Test that modified and unknown archives are reported
+def test_verify_corrupt(capsys):
+    with init_cwd() as (retCode, initDir):
+        filename = add_package('alpha', '1.0', os.urandom(5000))
+        assert run(['verify']) == 0
+        capsys.readouterr()
+
+        with open(os.path.join('archives', filename), 'r+b') as f:
+            f.write(b'corrupt')
+        with open(os.path.join('archives', 'stray_1.0_all.deb'), 'wb') as f:
+            f.write(b'stray')
+        assert run(['verify', '--remove']) != 0
+        output = capsys.readouterr().out
+        assert re.search('No checksum known for stray_1.0_all.deb', output)
+        assert re.search('Checksum mismatch: ' + re.escape(filename), output)
+        assert not os.path.exists(os.path.join('archives', filename))
+        assert os.path.exists(os.path.join('archives', 'stray_1.0_all.deb'))
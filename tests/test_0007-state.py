@@ -0,0 +1,112 @@
+from apt_medium.apt_medium import load_medium_state
+from apt_medium.state import add_target, pins_add, queue_add, queue_move, queue_pins, queue_remove, transaction
+import multiprocessing
+import os
+import pickle
+import pytest
+import shutil
+import tempfile
+
+@pytest.fixture
+def medium():
+    cwd = tempfile.mkdtemp()
+    os.chdir(cwd)
+    yield cwd
+    shutil.rmtree(cwd)
+
+# Test that an existing pickled medium_state is converted in place
+def test_migrate_pickle(medium):
+    old_state = {'install_queue': {'a': ['pkg1'], 'b': []},
+                 'download_queue': {'a': ['pkg2', 'pkg3'], 'b': ['pkg4']}}
+    with open('medium_state', 'wb') as f:
+        pickle.dump(old_state, f, protocol=2)
+    assert load_medium_state() == old_state
+    assert os.path.isfile('medium_state.pickle-backup')
+    # Loading again uses the converted store
+    assert load_medium_state() == old_state
+
+# Test queue operations keep order and skip duplicates
+def test_queue_operations(medium):
+    with transaction() as conn:
+        add_target(conn, 'a')
+        assert queue_add(conn, 'download_queue', 'a', ['pkg1', 'pkg2']) == ['pkg1', 'pkg2']
+        assert queue_add(conn, 'download_queue', 'a', ['pkg2', 'pkg3']) == ['pkg3']
+    assert load_medium_state()['download_queue']['a'] == ['pkg1', 'pkg2', 'pkg3']
+
+    with transaction() as conn:
+        queue_move(conn, 'download_queue', 'install_queue', 'a', ['pkg2'])
+        queue_remove(conn, 'download_queue', 'a', ['pkg1'])
+    state = load_medium_state()
+    assert state['download_queue']['a'] == ['pkg3']
+    assert state['install_queue']['a'] == ['pkg2']
+
+# Test that pins follow their queue and are dropped once it is empty
+def test_queue_pins(medium):
+    pin_v1 = ('dep', '1.0', 'amd64', 'http://example.invalid/dep_1.0_amd64.deb', 'dep_1.0_amd64.deb', 10, 'SHA256:00')
+    pin_v2 = ('dep', '2.0', 'amd64', 'http://example.invalid/dep_2.0_amd64.deb', 'dep_2.0_amd64.deb', 20, 'SHA256:11')
+    pkg = ('pkg', '1.0', 'all', 'http://example.invalid/pkg_1.0_all.deb', 'pkg_1.0_all.deb', 30, 'SHA256:22')
+    with transaction() as conn:
+        add_target(conn, 'a')
+        queue_add(conn, 'download_queue', 'a', ['pkg'])
+        pins_add(conn, 'download_queue', 'a', [pin_v1, pkg])
+        # A later resolution replaces the earlier version of the same package
+        pins_add(conn, 'download_queue', 'a', [pin_v2])
+        assert queue_pins(conn, 'download_queue', 'a') == [pin_v2, pkg]
+
+        queue_move(conn, 'download_queue', 'install_queue', 'a', ['pkg'])
+        assert queue_pins(conn, 'download_queue', 'a') == []
+        assert queue_pins(conn, 'install_queue', 'a') == [pin_v2, pkg]
+
+        queue_remove(conn, 'install_queue', 'a', ['pkg'])
+        assert queue_pins(conn, 'install_queue', 'a') == []
+
+# Test that taking part of a queue out drops its pins, so what's left is resolved again rather than installing
+# the removed package and its dependencies at their pinned versions
+def test_queue_pins_partial(medium):
+    pkg1 = ('pkg1', '1.0', 'all', 'http://example.invalid/pkg1_1.0_all.deb', 'pkg1_1.0_all.deb', 10, 'SHA256:00')
+    dep1 = ('dep1', '1.0', 'all', 'http://example.invalid/dep1_1.0_all.deb', 'dep1_1.0_all.deb', 10, 'SHA256:11')
+    pkg2 = ('pkg2', '1.0', 'all', 'http://example.invalid/pkg2_1.0_all.deb', 'pkg2_1.0_all.deb', 10, 'SHA256:22')
+    with transaction() as conn:
+        add_target(conn, 'a')
+        queue_add(conn, 'install_queue', 'a', ['pkg1', 'pkg2'])
+        pins_add(conn, 'install_queue', 'a', [pkg1, dep1, pkg2])
+        # Removing something that isn't queued changes nothing
+        queue_remove(conn, 'install_queue', 'a', ['other'])
+        assert len(queue_pins(conn, 'install_queue', 'a')) == 3
+        queue_remove(conn, 'install_queue', 'a', ['pkg1'])
+        assert queue_pins(conn, 'install_queue', 'a') == []
+
+        queue_add(conn, 'download_queue', 'a', ['pkg1', 'pkg2'])
+        pins_add(conn, 'download_queue', 'a', [pkg1, dep1, pkg2])
+        queue_move(conn, 'download_queue', 'install_queue', 'a', ['pkg2'])
+        assert queue_pins(conn, 'download_queue', 'a') == []
+    assert load_medium_state()['install_queue']['a'] == ['pkg2']
+    with transaction() as conn:
+        assert queue_pins(conn, 'install_queue', 'a') == []
+
+# Test that a failed transaction leaves the state untouched
+def test_rollback(medium):
+    with transaction() as conn:
+        add_target(conn, 'a')
+    with pytest.raises(RuntimeError):
+        with transaction() as conn:
+            queue_add(conn, 'install_queue', 'a', ['pkg1'])
+            raise RuntimeError()
+    assert load_medium_state()['install_queue']['a'] == []
+
+def queue_many(prefix):
+    for i in range(20):
+        with transaction() as conn:
+            queue_add(conn, 'download_queue', 'a', ['%s-%d' % (prefix, i)])
+
+# Test that concurrent apt-medium processes don't lose each other's updates
+def test_concurrent_writers(medium):
+    with transaction() as conn:
+        add_target(conn, 'a')
+    procs = [ multiprocessing.Process(target=queue_many, args=(str(n),)) for n in range(4) ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+        assert p.exitcode == 0
+    assert len(load_medium_state()['download_queue']['a']) == 80
@@ -0,0 +1,81 @@
+from apt_medium.index import PackageIndex, update_index
+import gzip
+import os
+import pytest
+import shutil
+import tempfile
+
+def write_list(lists_dir, name, packages):
+    with open(os.path.join(lists_dir, name), 'w') as f:
+        for package, version, arch in packages:
+            f.write('Package: %s\nVersion: %s\nArchitecture: %s\nDescription: test\n multi-line\n'
+                    'Filename: pool/%s_%s_%s.deb\nSize: 100\nSHA256: %s\n\n'
+                    % (package, version, arch, package, version, arch, package * 2))
+
+@pytest.fixture
+def dirs():
+    lists_dir = tempfile.mkdtemp()
+    index_dir = tempfile.mkdtemp()
+    yield (lists_dir, index_dir)
+    shutil.rmtree(lists_dir)
+    shutil.rmtree(index_dir)
+
+main_list = 'example.invalid_debian_dists_stable_main_binary-amd64_Packages'
+updates_list = 'example.invalid_debian_dists_stable-updates_main_binary-amd64_Packages'
+
+# Test looking up packages by name, version and architecture
+def test_lookup(dirs):
+    lists_dir, index_dir = dirs
+    packages = [ ('pkg%03d' % i, '1.0', 'amd64') for i in range(200) ]
+    packages += [ ('pkg050', '1:2.0', 'all'), ('pkg050', '1.0', 'i386') ]
+    write_list(lists_dir, main_list, packages)
+    assert update_index(lists_dir, index_dir)
+
+    with PackageIndex(index_dir) as index:
+        assert sorted(r.version for r in index.lookup('pkg050')) == ['1.0', '1.0', '1:2.0']
+        assert [ r.version for r in index.lookup('pkg050', arch='amd64') ] == ['1.0', '1:2.0']
+        record = index.find('pkg050', '1:2.0', 'amd64')
+        assert record.filename == 'pkg050_1%3a2.0_all.deb'
+        assert record.size == 100
+        assert record.checksum == 'SHA256:pkg050pkg050'
+        assert index.find('pkg000', '1.0', 'amd64').name == 'pkg000'
+        assert index.find('pkg199', '1.0', 'amd64').name == 'pkg199'
+        assert index.lookup('pkg') == []
+        assert index.lookup('zzz') == []
+        assert index.checksum('pkg050_1%3a2.0_all.deb', 'pkg050', '1:2.0', 'all') == 'SHA256:pkg050pkg050'
+        assert index.checksum('pkg050_1.0_i386.deb', 'pkg050', '1.0', 'i386') == 'SHA256:pkg050pkg050'
+        assert index.checksum('pkg050_1.0_i386.deb', 'pkg050', '1.1', 'i386') is None
+
+# Test that only changed lists are re-indexed and removed lists are dropped
+def test_incremental(dirs):
+    lists_dir, index_dir = dirs
+    write_list(lists_dir, main_list, [('alpha', '1.0', 'amd64')])
+    write_list(lists_dir, updates_list, [('alpha', '1.1', 'amd64')])
+    assert update_index(lists_dir, index_dir)
+    assert not update_index(lists_dir, index_dir)
+
+    main_idx = os.path.join(index_dir, main_list + '.idx')
+    os.utime(main_idx, (1000000000, 1000000000))
+    write_list(lists_dir, updates_list, [('alpha', '1.2', 'amd64')])
+    os.utime(os.path.join(lists_dir, updates_list), (2000000000, 2000000000))
+    assert update_index(lists_dir, index_dir)
+    assert os.path.getmtime(main_idx) == 1000000000
+    with PackageIndex(index_dir) as index:
+        assert sorted(r.version for r in index.lookup('alpha')) == ['1.0', '1.2']
+
+    os.unlink(os.path.join(lists_dir, updates_list))
+    assert update_index(lists_dir, index_dir)
+    with PackageIndex(index_dir) as index:
+        assert [ r.version for r in index.lookup('alpha') ] == ['1.0']
+
+# Test that compressed lists are indexed like uncompressed ones
+def test_compressed_lists(dirs):
+    lists_dir, index_dir = dirs
+    write_list(lists_dir, main_list, [('alpha', '1.0', 'amd64')])
+    with open(os.path.join(lists_dir, main_list), 'rb') as fsrc:
+        with gzip.open(os.path.join(lists_dir, main_list + '.gz'), 'wb') as fdst:
+            fdst.write(fsrc.read())
+    os.unlink(os.path.join(lists_dir, main_list))
+    assert update_index(lists_dir, index_dir)
+    with PackageIndex(index_dir) as index:
+        assert index.find('alpha', '1.0', 'amd64').size == 100
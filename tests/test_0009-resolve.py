@@ -0,0 +1,169 @@
+from .shared_test_code import init_cwd
+from apt_medium.apt_medium import download_request, load_pins, resolve_download_queues
+from apt_medium.resolve import SECTION_REMOVE, cached_apt_output, parse_plan, pin_spec, resolve, resolve_key, uri_line
+import os
+import pytest
+import shutil
+
+# A stand-in for apt-get that records each time it is run
+def counting_command(medium):
+    return ['sh', '-c', 'echo run >> "%s"; echo "result"' % os.path.join(medium, 'runs')]
+
+def runs(medium):
+    with open(os.path.join(medium, 'runs')) as f:
+        return len(f.readlines())
+
+# Test that repeated resolutions are answered from the cache until an input changes
+def test_resolution_cache(hostname):
+    with init_cwd() as (retCode, medium):
+        cache_dir = os.path.join(medium, 'cache')
+        parms = counting_command(medium)
+        assert cached_apt_output(cache_dir, medium, hostname, parms, os.environ) == ['result']
+        assert cached_apt_output(cache_dir, medium, hostname, parms, os.environ) == ['result']
+        assert runs(medium) == 1
+
+        # A different request
+        assert cached_apt_output(cache_dir, medium, hostname, parms + ['extra'], os.environ) == ['result']
+        assert runs(medium) == 2
+
+        # Installed packages changed
+        with open(os.path.join('system_info', hostname, 'dpkg-status'), 'a') as f:
+            f.write('\n')
+        cached_apt_output(cache_dir, medium, hostname, parms, os.environ)
+        assert runs(medium) == 3
+
+        # Apt configuration changed
+        with open(os.path.join('system_info', hostname, 'etc', 'apt', 'apt.conf'), 'a') as f:
+            f.write('// changed\n')
+        cached_apt_output(cache_dir, medium, hostname, parms, os.environ)
+        assert runs(medium) == 4
+
+        # Package lists changed
+        with open(os.path.join('lists', 'example.invalid_Packages'), 'w') as f:
+            f.write('\n')
+        cached_apt_output(cache_dir, medium, hostname, parms, os.environ)
+        assert runs(medium) == 5
+
+        cached_apt_output(cache_dir, medium, hostname, parms, os.environ)
+        assert runs(medium) == 5
+
+apt_output = """Reading package lists...
+Building dependency tree...
+Reading state information...
+oldpkg is already the newest version (1.0).
+The following additional packages will be installed:
+  libdep
+Suggested packages:
+  extra
+The following packages will be REMOVED:
+  conflicting
+The following NEW packages will be installed:
+  libdep newpkg
+The following packages will be upgraded:
+  uppkg
+1 upgraded, 2 newly installed, 1 to remove and 3 not upgraded.
+Need to get 9 B of archives.
+After this operation, 1024 B of additional disk space will be used.
+'http://example.invalid/libdep_1%3a1.0_amd64.deb' libdep_1%3a1.0_amd64.deb 3 SHA256:00
+'http://example.invalid/newpkg_2.0_all.deb' newpkg_2.0_all.deb 3 SHA256:00
+'http://example.invalid/uppkg_3.0_amd64.deb' uppkg_3.0_amd64.deb 3 SHA256:00
+"""
+
+# Test turning apt-get output into a structured plan
+def test_parse_plan():
+    plan = parse_plan(apt_output.splitlines())
+    assert plan.installs() == ['libdep', 'newpkg', 'uppkg']
+    assert plan.names(SECTION_REMOVE) == ['conflicting']
+    assert plan.notices == ['oldpkg is already the newest version (1.0).']
+    assert plan.counts == {'upgraded': 1, 'newly installed': 2, 'to remove': 1, 'not upgraded': 3}
+    assert not plan.nothing_to_do()
+    assert plan.details[0] == 'oldpkg is already the newest version (1.0).'
+    assert plan.details[-1].startswith('1 upgraded, 2 newly installed')
+    assert [ (p.name, p.version, p.arch) for p in plan.packages ] == [('libdep', '1:1.0', 'amd64'), ('newpkg', '2.0', 'all'), ('uppkg', '3.0', 'amd64')]
+    assert uri_line(plan.packages[1]) == apt_output.splitlines()[-2]
+    assert [ pin_spec(p) for p in plan.packages ] == ['libdep:amd64=1:1.0', 'newpkg=2.0', 'uppkg:amd64=3.0']
+
+    plan = parse_plan(['pkg is already the newest version (1.0).', '0 upgraded, 0 newly installed, 0 to remove and 3 not upgraded.'])
+    assert plan.nothing_to_do()
+
+# Test that a cached plan is checked against what has been downloaded since
+def test_resolve_missing(hostname):
+    with init_cwd() as (retCode, medium):
+        cache_dir = os.path.join(medium, 'cache')
+        with open(os.path.join(medium, 'output'), 'w') as f:
+            f.write(apt_output)
+        parms = ['sh', '-c', 'cat "$0"', os.path.join(medium, 'output')]
+        plan = resolve(cache_dir, medium, hostname, parms, os.environ)
+        assert len(plan.missing(os.path.join(medium, 'archives'))) == 3
+        with open(os.path.join('archives', 'newpkg_2.0_all.deb'), 'w') as f:
+            f.write('abc')
+        os.unlink(os.path.join(medium, 'output'))
+        plan = resolve(cache_dir, medium, hostname, parms, os.environ)
+        assert [ p.name for p in plan.missing(os.path.join(medium, 'archives')) ] == ['libdep', 'uppkg']
+
+# Make a copy of a target on the medium under another name, as if it was a cloned machine
+def clone_target(hostname, clone):
+    shutil.copytree(os.path.join('system_info', hostname), os.path.join('system_info', clone))
+    conf = os.path.join('system_info', clone, 'etc', 'apt', 'apt-medium.conf')
+    with open(conf) as f:
+        data = f.read()
+    with open(conf, 'w') as f:
+        f.write(data.replace('system_info/' + hostname, 'system_info/' + clone))
+
+# Test that identical targets share a resolution and targets that differ don't
+def test_clone_resolution(hostname):
+    with init_cwd() as (retCode, medium):
+        clone_target(hostname, 'clone')
+        clone_target(hostname, 'different')
+        with open(os.path.join('system_info', 'different', 'dpkg-status'), 'a') as f:
+            f.write('\n')
+
+        keys = {}
+        for target in (hostname, 'clone', 'different'):
+            parms, _ = download_request(medium, target, ['pkg'])
+            assert os.path.join('system_info', target) in ' '.join(parms)
+            keys[target] = resolve_key(medium, target, parms)
+        assert keys[hostname] == keys['clone']
+        assert keys[hostname] != keys['different']
+
+        cache_dir = os.path.join(medium, 'cache')
+        parms = counting_command(medium)
+        cached_apt_output(cache_dir, medium, hostname, parms, os.environ)
+        cached_apt_output(cache_dir, medium, 'clone', parms, os.environ)
+        assert runs(medium) == 1
+        cached_apt_output(cache_dir, medium, 'different', parms, os.environ)
+        assert runs(medium) == 2
+
+# A stand-in for apt-get install --print-uris that needs each requested package at version 1.0
+fake_apt_get = """#!/bin/sh
+while [ $# -gt 0 ] && [ "$1" != install ]; do shift; done
+[ $# -gt 0 ] || exit 1
+shift
+echo run >> "$RUNS"
+for p in "$@"; do
+    case "$p" in -*|*=*) continue;; esac
+    echo "'http://example.invalid/${p}_1.0_all.deb' ${p}_1.0_all.deb 3 SHA256:00"
+done
+"""
+
+# Test resolving several targets' queues at once
+def test_concurrent_resolution(hostname, monkeypatch):
+    with init_cwd() as (retCode, medium):
+        bin_dir = os.path.join(medium, 'bin')
+        os.mkdir(bin_dir)
+        with open(os.path.join(bin_dir, 'apt-get'), 'w') as f:
+            f.write(fake_apt_get)
+        os.chmod(os.path.join(bin_dir, 'apt-get'), 0o755)
+        monkeypatch.setenv('PATH', bin_dir + os.pathsep + os.environ['PATH'])
+        monkeypatch.setenv('RUNS', os.path.join(medium, 'runs'))
+        for clone in ('clone-a', 'clone-b', 'clone-c'):
+            clone_target(hostname, clone)
+
+        queues = {hostname: ['pkg-a'], 'clone-a': ['pkg-a'], 'clone-b': ['pkg-b'], 'clone-c': ['pkg-c', 'pkg-a']}
+        resolved = resolve_download_queues(medium, os.path.join(medium, 'cache'), queues, jobs=3)
+        assert sorted(resolved) == sorted(queues)
+        for target, packages in queues.items():
+            assert sorted(p.name for p in resolved[target]) == sorted(packages)
+            assert sorted(p.name for p in load_pins('download_queue', target)) == sorted(packages)
+        # The two targets asking for pkg-a are clones and shared one run
+        assert runs(medium) == 3
@@ -0,0 +1,108 @@
+from .shared_test_code import run, init_cwd
+from apt_medium.gc import parse_queue_entry, parse_size
+from apt_medium.packages import archive_filename
+from apt_medium.resolve import PlannedPackage, uri_line
+from apt_medium.state import pins_add, queue_add, transaction
+import os
+import pytest
+
+def add_archive(name, version, data, age):
+    filename = archive_filename(name, version, 'all')
+    path = os.path.join('archives', filename)
+    with open(path, 'wb') as f:
+        f.write(data)
+    os.utime(path, (1000000000 + age, 1000000000 + age))
+    return filename
+
+# apt-get answering every request with the --print-uris lines in $RESOLUTION, exiting with $RESOLUTION_STATUS
+fake_apt_get = """#!/bin/sh
+cat "$RESOLUTION"
+exit ${RESOLUTION_STATUS:-0}
+"""
+
+def fake_resolution(monkeypatch, medium, pins):
+    bin_dir = os.path.join(medium, 'bin')
+    if not os.path.isdir(bin_dir):
+        os.mkdir(bin_dir)
+    with open(os.path.join(bin_dir, 'apt-get'), 'w') as f:
+        f.write(fake_apt_get)
+    os.chmod(os.path.join(bin_dir, 'apt-get'), 0o755)
+    with open(os.path.join(medium, 'resolution'), 'w') as f:
+        f.write(''.join(uri_line(PlannedPackage(*p)) + '\n' for p in pins))
+    monkeypatch.setenv('PATH', bin_dir + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('RESOLUTION', os.path.join(medium, 'resolution'))
+
+def pin(name, version, size):
+    filename = archive_filename(name, version, 'all')
+    return (name, version, 'all', 'http://example.invalid/' + filename, filename, size, 'SHA256:00')
+
+# Test parsing size limits
+def test_parse_size():
+    assert parse_size('1024') == 1024
+    assert parse_size('2k') == 2048
+    assert parse_size('64G') == 64 * 1024 ** 3
+    assert parse_size('1.5G') is None
+
+# Test splitting queue entries into the package, architecture and version they ask for
+def test_parse_queue_entry():
+    assert parse_queue_entry('foo') == ('foo', None, None)
+    assert parse_queue_entry('foo:amd64') == ('foo', 'amd64', None)
+    assert parse_queue_entry('foo=1:2.0-1') == ('foo', None, '1:2.0-1')
+    assert parse_queue_entry('foo:i386=2.0') == ('foo', 'i386', '2.0')
+    assert parse_queue_entry('foo/bookworm-backports') == ('foo', None, None)
+
+# Test that unpinned queue entries naming a version or architecture still keep their archives
+def test_gc_queue_entries(hostname, monkeypatch):
+    with init_cwd() as (retCode, medium):
+        # Whatever apt-get would pick now, the versions the entries name are kept
+        fake_resolution(monkeypatch, medium, [])
+        versioned = add_archive('gctest-versioned', '1:2.0', b'a' * 100, 0)
+        other_version = add_archive('gctest-versioned', '1.0', b'b' * 100, 1)
+        with_arch = add_archive('gctest-arch', '1.0', b'c' * 100, 2)
+        with transaction('medium_state') as conn:
+            queue_add(conn, 'download_queue', hostname, ['gctest-versioned=1:2.0', 'gctest-arch:amd64'])
+
+        assert run(['gc']) == 0
+        assert sorted(f for f in os.listdir('archives') if f.endswith('.deb')) == sorted([versioned, with_arch])
+        assert other_version not in os.listdir('archives')
+
+# Test that only archives no target installed or queued are removed, oldest first down to the limit
+def test_gc(hostname, capsys, monkeypatch):
+    with init_cwd() as (retCode, medium):
+        with open(os.path.join('system_info', hostname, 'dpkg-status'), 'a') as f:
+            f.write('\nPackage: gctest-installed\nStatus: install ok installed\nArchitecture: all\nVersion: 1:1.0\n\n'
+                    'Package: gctest-removed\nStatus: deinstall ok config-files\nArchitecture: all\nVersion: 1.0\n')
+        installed = add_archive('gctest-installed', '1:1.0', b'a' * 100, 0)
+        pinned = add_archive('gctest-pinned', '2.0', b'b' * 100, 1)
+        queued = add_archive('gctest-queued', '3.0', b'c' * 100, 2)
+        oldest = add_archive('gctest-removed', '1.0', b'd' * 100, 3)
+        older = add_archive('gctest-installed', '0.9', b'e' * 100, 4)
+        newest = add_archive('gctest-pinned', '1.0', b'f' * 100, 5)
+        # Only needed as a dependency of the unpinned download queue
+        dependency = add_archive('gctest-dep', '1.0', b'g' * 100, 6)
+        with transaction('medium_state') as conn:
+            queue_add(conn, 'install_queue', hostname, ['gctest-pinned'])
+            pins_add(conn, 'install_queue', hostname, [pin('gctest-pinned', '2.0', 100)])
+            queue_add(conn, 'download_queue', hostname, ['gctest-queued'])
+        fake_resolution(monkeypatch, medium, [pin('gctest-queued', '3.0', 100), pin('gctest-dep', '1.0', 100)])
+
+        assert run(['gc', '--max-size', '550', '--dry-run']) == 0
+        assert 'Would remove ' + oldest in capsys.readouterr().out
+        assert len([ f for f in os.listdir('archives') if f.endswith('.deb') ]) == 7
+
+        # The older version of an installed package is no longer referenced, so it goes next
+        assert run(['gc', '--max-size', '550']) == 0
+        assert capsys.readouterr().out.splitlines()[:2] == ['Removed ' + oldest, 'Removed ' + older]
+        assert sorted(f for f in os.listdir('archives') if f.endswith('.deb')) == sorted([installed, pinned, queued, newest, dependency])
+
+        assert run(['gc']) == 0
+        assert sorted(f for f in os.listdir('archives') if f.endswith('.deb')) == sorted([installed, pinned, queued, dependency])
+        assert capsys.readouterr().out.splitlines()[-1] == 'Freed 100 bytes, archives now use 400 bytes'
+
+        # Without a way to work out what the unpinned queue needs, nothing is removed
+        add_archive('gctest-unreferenced', '1.0', b'h' * 100, 7)
+        with transaction('medium_state') as conn:
+            queue_add(conn, 'download_queue', hostname, ['gctest-missing'])
+        monkeypatch.setenv('RESOLUTION_STATUS', '100')
+        assert run(['gc']) != 0
+        assert len([ f for f in os.listdir('archives') if f.endswith('.deb') ]) == 5
@@ -0,0 +1,34 @@
+from apt_medium.capacity import choose_targets, space_needed
+import os
+import pytest
+import shutil
+import tempfile
+
+target_files = {'a': set(['big', 'shared']), 'b': set(['shared', 'small']), 'c': set(['small']), 'd': set()}
+file_sizes = {'big': 500, 'shared': 100, 'small': 10}
+
+# Test that as many targets as possible are completed within the available space
+def test_choose_targets():
+    assert choose_targets(target_files, file_sizes, 1000) == (['d', 'c', 'b', 'a'], [])
+    # c and b share files so taking both costs no more than b alone
+    assert choose_targets(target_files, file_sizes, 110) == (['d', 'c', 'b'], ['a'])
+    assert choose_targets(target_files, file_sizes, 0) == (['d'], ['a', 'b', 'c'])
+
+# Test that priority targets are satisfied first when they fit
+def test_choose_targets_priority():
+    assert choose_targets(target_files, file_sizes, 700, ['a']) == (['a', 'd', 'b', 'c'], [])
+    assert choose_targets(target_files, file_sizes, 605, ['a']) == (['a', 'd'], ['b', 'c'])
+    assert choose_targets(target_files, file_sizes, 550, ['a']) == (['d', 'c', 'b'], ['a'])
+    assert choose_targets(target_files, file_sizes, 100, ['a', 'c']) == (['c', 'd'], ['a', 'b'])
+
+# Test that a resumable partial download reduces the space still needed
+def test_space_needed():
+    archives_dir = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(archives_dir, 'partial'))
+        assert space_needed(archives_dir, 'pkg_1.0_all.deb', 1000) == 1000
+        with open(os.path.join(archives_dir, 'partial', 'pkg_1.0_all.deb'), 'wb') as f:
+            f.write(b'x' * 400)
+        assert space_needed(archives_dir, 'pkg_1.0_all.deb', 1000) == 600
+    finally:
+        shutil.rmtree(archives_dir)
@@ -0,0 +1,38 @@
+from .shared_test_code import run, init_cwd
+from apt_medium.packages import referenced_lists
+import os
+import pytest
+
+# Test matching list files to the index targets of a target's sources
+def test_referenced_lists():
+    index_names = ['example.invalid_debian_dists_stable_main_binary-amd64_Packages',
+                   'example.invalid_debian_dists_stable_main_i18n_Translation-en']
+    list_files = ['example.invalid_debian_dists_stable_main_binary-amd64_Packages.gz',
+                  'example.invalid_debian_dists_stable_main_i18n_Translation-en.lz4',
+                  'example.invalid_debian_dists_stable_InRelease',
+                  'example.invalid_debian_dists_stable-updates_InRelease',
+                  'example.invalid_debian_dists_stable-updates_main_binary-amd64_Packages',
+                  'other.invalid_._Packages', 'other.invalid_._Release', 'other.invalid_._Release.gpg']
+    assert referenced_lists(index_names, list_files) == set(list_files[:3])
+    assert referenced_lists(['other.invalid_._Packages'], list_files) == set(list_files[5:])
+
+# Test moving lists no target's sources use out of the way
+def test_prune_lists(hostname, capsys):
+    with init_cwd() as (retCode, medium):
+        with open(os.path.join('system_info', hostname, 'etc', 'apt', 'sources.list'), 'a') as f:
+            f.write('\ndeb http://example.invalid/debian stable main\n')
+        used = ['example.invalid_debian_dists_stable_Release.gpg', 'example.invalid_debian_dists_stable_main_binary-all_Packages.gz']
+        unused = ['example.invalid_debian_dists_old_Release.gpg', 'example.invalid_debian_dists_old_main_binary-all_Packages.gz']
+        for name in used + unused:
+            open(os.path.join('lists', name), 'w').close()
+
+        assert run(['prune-lists', '--dry-run']) == 0
+        assert 'Would remove ' + unused[0] in capsys.readouterr().out
+        assert all(os.path.exists(os.path.join('lists', name)) for name in unused)
+
+        assert run(['prune-lists']) == 0
+        for name in used:
+            assert os.path.exists(os.path.join('lists', name))
+        for name in unused:
+            assert not os.path.exists(os.path.join('lists', name))
+            assert os.path.exists(os.path.join('var', 'lib', 'apt-medium', 'lists-archive', name))
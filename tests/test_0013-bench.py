@@ -0,0 +1,28 @@
+from benchmarks.run_benchmarks import ACTIONS, load_results, main
+import os
+import pytest
+import shutil
+import tempfile
+
+# Test that the benchmark harness runs every action on a small synthetic medium and records the results
+def test_benchmarks(capsys):
+    tempdir = tempfile.mkdtemp()
+    os.chdir(tempdir)
+    try:
+        results_file = os.path.join(tempdir, 'results.jsonl')
+        args = ['--targets', '3', '--sets', '2', '--lists', '2', '--list-packages', '10', '--archives', '4',
+                '--archive-size', '1024', '--latency', '0', '--results', results_file]
+        assert main(args) == 0
+        assert main(args + ['--actions', 'install,download']) == 0
+        assert 'Compared with commit' in capsys.readouterr().out
+
+        results = load_results(results_file)
+        assert len(results) == 2
+        assert sorted(results[0]['results']) == sorted(ACTIONS)
+        assert sorted(results[1]['results']) == ['download', 'install']
+        # Three targets queuing two distinct package sets are resolved with two apt-get runs,
+        # then each gets its install plan worked out
+        assert results[0]['results']['download']['subprocesses'] == 2 + 3
+        assert results[0]['results']['install']['subprocesses'] >= 1
+    finally:
+        shutil.rmtree(tempdir)
@@ -0,0 +1,51 @@
+from .shared_test_code import run, init_cwd
+from apt_medium import trace
+import json
+import os
+import pytest
+import subprocess
+
+def load_trace(path):
+    with open(path) as f:
+        return json.load(f)['traceEvents']
+
+# Test that nothing is recorded unless tracing was asked for
+def test_trace_off():
+    assert not trace.enabled()
+    assert trace.span('work', 'test') is trace.NULL_SPAN
+    assert trace.Popen(['true']).wait() == 0
+    assert not trace.enabled()
+
+# Test that subprocesses are recorded with their exit codes and output sizes
+def test_trace_subprocesses(tmpdir):
+    path = str(tmpdir.join('trace.json'))
+    trace.start()
+    assert trace.check_output(['sh', '-c', 'echo hello']) == b'hello\n'
+    with pytest.raises(subprocess.CalledProcessError):
+        trace.check_output(['sh', '-c', 'exit 2'])
+    proc = trace.Popen(['sh', '-c', 'cat >/dev/null; exit 3'], stdin=subprocess.PIPE)
+    proc.communicate(b'data')
+    with trace.span('work', 'test', items=1) as s:
+        s.set(bytes=10)
+    trace.save(path)
+    assert not trace.enabled()
+
+    events = load_trace(path)
+    assert [ (e['name'], e['args'].get('exit_code')) for e in events ] == [('sh', 0), ('sh', 2), ('sh', 3), ('work', None)]
+    assert events[0]['args']['bytes'] == 6
+    assert events[3]['args'] == {'items': 1, 'bytes': 10}
+    assert all(e['ph'] == 'X' and e['dur'] >= 0 for e in events)
+
+# Test tracing a whole action from the command line
+def test_trace_action(hostname):
+    with init_cwd() as (retCode, medium):
+        path = os.path.join(medium, 'trace.json')
+        assert run(['--trace', path, 'init']) == 0
+        events = load_trace(path)
+        names = [ e['name'] for e in events ]
+        assert names[-1] == 'init'
+        assert events[-1]['args']['exit_code'] == 0
+        assert 'sync /etc/apt' in names
+        assert 'state transaction' not in names
+        assert any(e['cat'] == 'state' for e in events)
+        assert trace.command_name(['apt-get', '--option', 'Dir=/', '--config-file', 'a.conf', 'install', 'pkg']) == 'apt-get install'
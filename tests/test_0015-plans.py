@@ -0,0 +1,167 @@
+from .shared_test_code import run, init_cwd
+from apt_medium.apt_medium import load_medium_state
+from apt_medium.plans import dpkg_commands, dpkg_hooks, load_plan, make_plan, parse_apt_config, parse_simulation, save_plan, stale_reason
+from apt_medium.resolve import PlannedPackage
+from apt_medium.state import pins_add, queue_add, transaction
+from io import StringIO
+import hashlib
+import os
+import pytest
+
+simulation = """NOTE: This is only a simulation!
+The following NEW packages will be installed:
+  plantest-a plantest-lib
+0 upgraded, 2 newly installed, 1 to remove and 0 not upgraded.
+Remv plantest-old [0.9]
+Inst plantest-lib:amd64 [1.0] (1:1.1 Debian:12.5/stable, Debian-Security:12/stable-security [amd64])
+Inst plantest-a (2.0 127.0.0.1 [all]) []
+Conf plantest-lib:amd64 (1:1.1 Debian:12.5/stable, Debian-Security:12/stable-security [amd64])
+Conf plantest-a (2.0 127.0.0.1 [all])
+""".splitlines()
+
+# Each pinned archive holds b'abc'
+abc_checksum = 'SHA256:' + hashlib.sha256(b'abc').hexdigest()
+pins = [PlannedPackage('plantest-lib', '1:1.1', 'amd64', 'http://example.invalid/lib.deb', 'plantest-lib_1%3a1.1_amd64.deb', 3, abc_checksum),
+        PlannedPackage('plantest-a', '2.0', 'all', 'http://example.invalid/a.deb', 'plantest-a_2.0_all.deb', 3, abc_checksum)]
+
+# Test turning apt-get's simulation into steps dpkg can carry out
+def test_parse_simulation():
+    steps = parse_simulation(simulation, pins)
+    assert steps == [('remove', 'plantest-old', None, '0.9', None),
+                     ('unpack', 'plantest-lib', 'amd64', '1:1.1', 'plantest-lib_1%3a1.1_amd64.deb'),
+                     ('unpack', 'plantest-a', 'all', '2.0', 'plantest-a_2.0_all.deb'),
+                     ('configure', 'plantest-lib', 'amd64', '1:1.1', None),
+                     ('configure', 'plantest-a', 'all', '2.0', None)]
+    # A simulation that unpacks something other than the pinned versions can't be applied offline
+    assert parse_simulation(simulation, pins[:1]) is None
+
+    plan = make_plan(['plantest-a'], __file__, simulation, pins)
+    assert dpkg_commands(plan, '/medium/archives') == [['dpkg', '--remove', 'plantest-old'],
+                                                       ['dpkg', '--unpack', '/medium/archives/plantest-lib_1%3a1.1_amd64.deb', '/medium/archives/plantest-a_2.0_all.deb'],
+                                                       ['dpkg', '--configure', 'plantest-lib:amd64', 'plantest-a']]
+
+# Test that multi-arch packages installed for several architectures at the same version each get their own archive
+def test_parse_simulation_multiarch():
+    lines = ['Remv libplantest-old:i386 [0.9]',
+             'Inst libplantest:i386 (2.36 Debian:12/stable [i386])',
+             'Inst libplantest (2.36 Debian:12/stable [amd64])',
+             'Conf libplantest:i386 (2.36 Debian:12/stable [i386])',
+             'Conf libplantest (2.36 Debian:12/stable [amd64])']
+    multiarch_pins = [PlannedPackage('libplantest', '2.36', arch, 'http://example.invalid/libplantest_' + arch + '.deb',
+                                     'libplantest_2.36_' + arch + '.deb', 3, 'SHA256:00') for arch in ('amd64', 'i386')]
+    plan = make_plan(['libplantest:i386'], __file__, lines, multiarch_pins)
+    assert plan.steps[1:3] == [('unpack', 'libplantest', 'i386', '2.36', 'libplantest_2.36_i386.deb'),
+                               ('unpack', 'libplantest', 'amd64', '2.36', 'libplantest_2.36_amd64.deb')]
+    assert dpkg_commands(plan, '/a') == [['dpkg', '--remove', 'libplantest-old:i386'],
+                                         ['dpkg', '--unpack', '/a/libplantest_2.36_i386.deb', '/a/libplantest_2.36_amd64.deb'],
+                                         ['dpkg', '--configure', 'libplantest:i386', 'libplantest:amd64']]
+    # Only the i386 archive pinned: the amd64 one mustn't be mistaken for it
+    assert parse_simulation(lines, multiarch_pins[1:]) is None
+
+# Test that plans are only used for the queue and dpkg status they were made for
+def test_stale_plan(tmpdir):
+    status = tmpdir.join('status')
+    status.write('Package: plantest\n')
+    archives_dir = tmpdir.mkdir('archives')
+    for p in pins:
+        archives_dir.join(p.filename).write('abc')
+    plan = make_plan(['plantest-a'], str(status), simulation, pins)
+    assert stale_reason(plan, ['plantest-a'], str(status), str(archives_dir), pins, {}) is None
+    assert 'queue' in stale_reason(plan, ['plantest-a', 'plantest-b'], str(status), str(archives_dir), pins, {})
+    archives_dir.join(pins[0].filename).remove()
+    assert pins[0].filename in stale_reason(plan, ['plantest-a'], str(status), str(archives_dir), pins, {})
+    status.write('\n', mode='a')
+    assert 'installed packages' in stale_reason(plan, ['plantest-a'], str(status), str(archives_dir), pins, {})
+
+# Test that archives are checked against their pins before a plan is used, as apt-get would before running dpkg
+def test_stale_plan_archives(tmpdir):
+    status = tmpdir.join('status')
+    status.write('Package: plantest\n')
+    archives_dir = tmpdir.mkdir('archives')
+    for p in pins:
+        archives_dir.join(p.filename).write('abc')
+    plan = make_plan(['plantest-a'], str(status), simulation, pins)
+
+    # Right name and size, wrong contents
+    archives_dir.join(pins[1].filename).write('xyz')
+    assert 'checksum' in stale_reason(plan, ['plantest-a'], str(status), str(archives_dir), pins, {})
+    # Truncated
+    archives_dir.join(pins[1].filename).write('ab')
+    assert 'size' in stale_reason(plan, ['plantest-a'], str(status), str(archives_dir), pins, {})
+    # Not pinned at all
+    archives_dir.join(pins[1].filename).write('abc')
+    assert 'no checksum' in stale_reason(plan, ['plantest-a'], str(status), str(archives_dir), pins[:1], {})
+
+    # A manifest entry for the archive as it is now stands in for hashing it, one for an older copy doesn't
+    archives_dir.join(pins[1].filename).write('xyz')
+    st = os.stat(str(archives_dir.join(pins[1].filename)))
+    manifest = {pins[1].filename: (st.st_size, st.st_mtime, pins[1].checksum)}
+    assert stale_reason(plan, ['plantest-a'], str(status), str(archives_dir), pins, manifest) is None
+    manifest = {pins[1].filename: (st.st_size, st.st_mtime - 1, pins[1].checksum)}
+    assert 'checksum' in stale_reason(plan, ['plantest-a'], str(status), str(archives_dir), pins, manifest)
+
+fake_command = """#!/bin/sh
+echo "$(basename "$0") $*" >> "$COMMANDS"
+[ "$1" = --print-architecture ] && echo amd64
+exit 0
+"""
+
+# apt-config answering with a hook of each kind and a dpkg option, each hook noting that it ran
+fake_apt_config = """#!/bin/sh
+echo "$(basename "$0") $*" >> "$COMMANDS"
+printf 'DPkg::Pre-Invoke::\\techo pre-invoke >> "$COMMANDS"\\n'
+printf 'DPkg::Pre-Install-Pkgs::\\techo pre-install-pkgs $(cat) >> "$COMMANDS"\\n'
+printf 'DPkg::Post-Invoke::\\techo post-invoke >> "$COMMANDS"\\n'
+printf 'DPkg::Options::\\t--force-confold\\n'
+"""
+
+# Test reading the hooks apt-get runs around dpkg from the apt configuration
+def test_dpkg_hooks():
+    config = parse_apt_config(['DPkg::Pre-Invoke\t', 'DPkg::Pre-Invoke::\techo one', 'Dpkg::Pre-Invoke::\techo two',
+                               'DPkg::Pre-Install-Pkgs::\t/usr/sbin/dpkg-preconfigure --apt || true',
+                               'DPkg::Options::\t--force-confdef', 'APT::Architecture\tamd64'])
+    assert dpkg_hooks(config) == {'pre-invoke': ['echo one', 'echo two'], 'post-invoke': [], 'options': ['--force-confdef'],
+                                  'pre-install-pkgs': ['/usr/sbin/dpkg-preconfigure --apt || true']}
+    # Hooks that want apt's version 2 (or later) description of the transaction need apt-get
+    config.append(('dpkg::tools::options::/usr/sbin/dpkg-preconfigure::version', '2'))
+    assert dpkg_hooks(config) is None
+
+# Test that installing the queue on the target applies its prepared plan with dpkg directly
+def test_apply_plan(hostname, monkeypatch):
+    with init_cwd() as (retCode, medium):
+        bin_dir = os.path.join(medium, 'bin')
+        os.mkdir(bin_dir)
+        for name, script in [('dpkg', fake_command), ('apt-mark', fake_command), ('apt-config', fake_apt_config)]:
+            with open(os.path.join(bin_dir, name), 'w') as f:
+                f.write(script)
+            os.chmod(os.path.join(bin_dir, name), 0o755)
+        monkeypatch.setenv('PATH', bin_dir + os.pathsep + os.environ['PATH'])
+        monkeypatch.setenv('COMMANDS', os.path.join(medium, 'commands'))
+        monkeypatch.setattr('sys.stdin', StringIO('y'))
+
+        for p in pins:
+            with open(os.path.join('archives', p.filename), 'w') as f:
+                f.write('abc')
+        with transaction('medium_state') as conn:
+            queue_add(conn, 'install_queue', hostname, ['plantest-a'])
+            pins_add(conn, 'install_queue', hostname, pins)
+        plans_dir = os.path.join(medium, 'var', 'lib', 'apt-medium', 'plans')
+        save_plan(plans_dir, hostname, make_plan(['plantest-a'], '/var/lib/dpkg/status', simulation, pins))
+
+        assert run(['install']) == 0
+        with open(os.path.join(medium, 'commands')) as f:
+            commands = f.read().splitlines()
+        archives_dir = os.path.join(medium, 'archives')
+        conf = os.path.join(medium, 'system_info', hostname, 'etc', 'apt', 'apt-medium.conf')
+        unpacked = os.path.join(archives_dir, pins[0].filename) + ' ' + os.path.join(archives_dir, pins[1].filename)
+        assert commands == ['apt-config --option Dir=' + medium + ' --config-file ' + conf + ' dump --format %f\t%v%n',
+                            'apt-mark --option Dir=' + medium + ' --config-file ' + conf + ' showmanual',
+                            'pre-invoke',
+                            'pre-install-pkgs ' + unpacked,
+                            'dpkg --force-confold --remove plantest-old',
+                            'dpkg --force-confold --unpack ' + unpacked,
+                            'dpkg --force-confold --configure plantest-lib:amd64 plantest-a',
+                            'post-invoke',
+                            'apt-mark --option Dir=' + medium + ' --config-file ' + conf + ' auto plantest-lib']
+        assert load_medium_state()['install_queue'][hostname] == []
+        assert load_plan(plans_dir, hostname) is None
@@ -0,0 +1,56 @@
+from .shared_test_code import run, init_cwd
+from apt_medium import localrepo
+from apt_medium.packages import iter_stanzas
+import os
+import pytest
+import subprocess
+
+def build_deb(work_dir, archives_dir, name, version, compression):
+    # Build a minimal package with dpkg-deb, named the way apt names downloaded archives
+    pkg_dir = os.path.join(work_dir, name)
+    os.makedirs(os.path.join(pkg_dir, 'DEBIAN'))
+    with open(os.path.join(pkg_dir, 'DEBIAN', 'control'), 'w') as f:
+        f.write('Package: ' + name + '\nVersion: ' + version + '\nArchitecture: all\nMaintainer: t <t@t>\n'
+                'Description: test package\n with a second line\n')
+    filename = name + '_' + version.replace(':', '%3a') + '_all.deb'
+    subprocess.check_call(['dpkg-deb', '-Z' + compression, '--build', pkg_dir, os.path.join(archives_dir, filename)], stdout=subprocess.PIPE)
+    return filename
+
+def packages(archives_dir):
+    return dict((s['Package'], s) for s in iter_stanzas(os.path.join(archives_dir, 'Packages.gz')))
+
+# Test that the index over archives/ only reads packages that are new since the last update
+def test_local_repo(tmpdir, monkeypatch):
+    archives_dir = str(tmpdir.mkdir('archives'))
+    manifest_file = str(tmpdir.join('manifest'))
+    build_deb(str(tmpdir), archives_dir, 'repotest-gz', '1.0', 'gzip')
+    build_deb(str(tmpdir), archives_dir, 'repotest-xz', '2:1.0', 'xz')
+
+    read = []
+    read_control = localrepo.read_control
+    monkeypatch.setattr(localrepo, 'read_control', lambda path: read.append(os.path.basename(path)) or read_control(path))
+
+    assert localrepo.update_local_repo(archives_dir, manifest_file, {})
+    index = packages(archives_dir)
+    assert sorted(index) == ['repotest-gz', 'repotest-xz']
+    assert index['repotest-xz']['Version'] == '2:1.0'
+    assert index['repotest-xz']['Filename'] == './repotest-xz_2%3a1.0_all.deb'
+    assert len(read) == 2
+    with open(os.path.join(archives_dir, 'Release')) as f:
+        assert ' Packages.gz' in f.read()
+
+    assert not localrepo.update_local_repo(archives_dir, manifest_file, {})
+    added = build_deb(str(tmpdir), archives_dir, 'repotest-new', '1.0', 'gzip')
+    os.unlink(os.path.join(archives_dir, 'repotest-gz_1.0_all.deb'))
+    assert localrepo.update_local_repo(archives_dir, manifest_file, {})
+    assert sorted(packages(archives_dir)) == ['repotest-new', 'repotest-xz']
+    assert read[2:] == [added]
+
+# Test that removing packages from the medium takes them out of the index
+def test_local_repo_gc(hostname):
+    with init_cwd() as (retCode, medium):
+        build_deb(medium, 'archives', 'repotest-unused', '1.0', 'gzip')
+        assert run(['gc', '--dry-run']) == 0
+        assert not os.path.exists(os.path.join('archives', 'Packages'))
+        assert run(['gc']) == 0
+        assert packages('archives') == {}
@@ -0,0 +1,178 @@
+from apt_medium.plans import ApplyPlan, save_plan
+from apt_medium.resolve import PlannedPackage
+from apt_medium.serve import MediumServer, fetch_archives, fetch_listing, fetch_plan, mirror_lists, parse_range
+from apt_medium.utils import save_pickle
+import hashlib
+import os
+import pytest
+import threading
+
+try:
+    from http.client import HTTPConnection
+except ImportError as _:
+    from httplib import HTTPConnection
+
+class medium_server:
+    # Serves a medium on a free localhost port for the duration of a with block
+    def __init__(self, medium):
+        self.server = MediumServer(medium, ('127.0.0.1', 0), quiet=True)
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return 'http://127.0.0.1:' + str(self.server.server_address[1])
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+def make_medium(root, files):
+    for path, data in files.items():
+        full_path = os.path.join(root, path)
+        if not os.path.isdir(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        with open(full_path, 'wb') as f:
+            f.write(data)
+    return root
+
+def request(url, path, method='GET', headers={}):
+    conn = HTTPConnection(url.split('//', 1)[1], timeout=10)
+    conn.request(method, path, headers=headers)
+    response = conn.getresponse()
+    body = response.read()
+    conn.close()
+    return (response, body)
+
+# Test parsing of the Range requests apt and apt-medium send
+def test_parse_range():
+    assert parse_range(None, 100) is None
+    assert parse_range('bytes=10-', 100) == (10, 99)
+    assert parse_range('bytes=10-19', 100) == (10, 19)
+    assert parse_range('bytes=90-200', 100) == (90, 99)
+    assert parse_range('bytes=-10', 100) == (90, 99)
+    assert parse_range('bytes=0-1,5-6', 100) is None
+    with pytest.raises(ValueError):
+        parse_range('bytes=100-', 100)
+    with pytest.raises(ValueError):
+        parse_range('bytes=20-10', 100)
+
+# Test that whole files, ranges and listings are served, and nothing outside archives/ and lists/
+def test_serve(tmpdir):
+    data = os.urandom(300000)
+    medium = make_medium(str(tmpdir), {'archives/foo_1.0_all.deb': data, 'lists/x_Packages': b'Package: foo\n', 'medium_state': b'secret'})
+    with medium_server(medium) as url:
+        response, body = request(url, '/archives/foo_1.0_all.deb')
+        assert response.status == 200 and body == data
+        assert response.getheader('Accept-Ranges') == 'bytes'
+
+        response, body = request(url, '/archives/foo_1.0_all.deb', headers={'Range': 'bytes=1000-'})
+        assert response.status == 206 and body == data[1000:]
+        assert response.getheader('Content-Range') == 'bytes 1000-299999/300000'
+
+        response, body = request(url, '/archives/foo_1.0_all.deb', headers={'Range': 'bytes=300000-'})
+        assert response.status == 416
+
+        response, body = request(url, '/archives/foo_1.0_all.deb', method='HEAD')
+        assert response.status == 200 and body == b'' and response.getheader('Content-Length') == '300000'
+
+        for path in ('/medium_state', '/archives/../medium_state', '/archives/partial', '/lists/missing'):
+            assert request(url, path)[0].status == 404
+
+        listing = fetch_listing(url, 'lists')
+        assert listing['x_Packages'][:1] == (len(b'Package: foo\n'),)
+        assert listing['x_Packages'][2] == hashlib.sha256(b'Package: foo\n').hexdigest()
+
+        # Several hosts at once, each over its own connection
+        results = []
+        def client():
+            results.append(request(url, '/archives/foo_1.0_all.deb')[1] == data)
+        threads = [ threading.Thread(target=client) for _ in range(8) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert results == [True] * 8
+
+# Test that archives with an epoch are found however the client encodes the name, and encoded paths can't escape
+def test_serve_epoch(tmpdir):
+    medium = make_medium(str(tmpdir), {'archives/foo_1%3a2.0_amd64.deb': b'apt naming', 'archives/bar_1:2.0_amd64.deb': b'plain naming',
+                                       'medium_state': b'secret'})
+    with medium_server(medium) as url:
+        # As apt asks for it from "deb [trusted=yes] http://host:port/archives ./", as is and percent-encoded
+        for path in ('/archives/foo_1%3a2.0_amd64.deb', '/archives/foo_1%253a2.0_amd64.deb', '/archives/foo_1:2.0_amd64.deb'):
+            response, body = request(url, path)
+            assert response.status == 200 and body == b'apt naming'
+        response, body = request(url, '/archives/bar_1%3a2.0_amd64.deb')
+        assert response.status == 200 and body == b'plain naming'
+        for path in ('/archives/%2e%2e%2fmedium_state', '/archives/%2e%2e', '/archives%2f..%2fmedium_state'):
+            assert request(url, path)[0].status == 404
+
+        archives_dir = str(tmpdir.mkdir('client'))
+        os.mkdir(os.path.join(archives_dir, 'partial'))
+        p = PlannedPackage('foo', '1:2.0', 'amd64', 'http://elsewhere/foo.deb', 'foo_1%3a2.0_amd64.deb', len(b'apt naming'),
+                           'SHA256:' + hashlib.sha256(b'apt naming').hexdigest())
+        assert fetch_archives(url, [p], archives_dir) == {}
+
+# Test that a host brings its lists in line with the server's and fetches only verified packages from it
+def test_mirror(tmpdir):
+    deb = os.urandom(5000)
+    server_medium = make_medium(str(tmpdir.mkdir('server')), {'archives/foo_1.0_all.deb': deb, 'lists/x_Packages.gz': b'new list'})
+    os.utime(os.path.join(server_medium, 'lists', 'x_Packages.gz'), (1000000000, 1000000000))
+    client_medium = make_medium(str(tmpdir.mkdir('client')), {'lists/x_Packages': b'old list', 'lists/partial/.keep': b'',
+                                                              'archives/partial/.keep': b''})
+    lists_dir = os.path.join(client_medium, 'lists')
+    archives_dir = os.path.join(client_medium, 'archives')
+
+    with medium_server(server_medium) as url:
+        assert mirror_lists(url, lists_dir) == {}
+        assert sorted(f for f in os.listdir(lists_dir) if f != 'partial') == ['x_Packages.gz']
+        assert os.path.getmtime(os.path.join(lists_dir, 'x_Packages.gz')) == 1000000000
+
+        good = PlannedPackage('foo', '1.0', 'all', 'http://elsewhere/foo_1.0_all.deb', 'foo_1.0_all.deb', len(deb),
+                              'SHA256:' + hashlib.sha256(deb).hexdigest())
+        absent = good._replace(name='bar', filename='bar_1.0_all.deb')
+        failures = fetch_archives(url, [good, absent], archives_dir)
+        assert sorted(failures) == ['bar_1.0_all.deb']
+        with open(os.path.join(archives_dir, 'foo_1.0_all.deb'), 'rb') as f:
+            assert f.read() == deb
+
+# Test that archives are listed with the checksums they were verified against rather than hashed on request
+def test_archive_listing(tmpdir):
+    medium = make_medium(str(tmpdir), {'archives/foo_1.0_all.deb': b'foo', 'archives/bar_1.0_all.deb': b'bar'})
+    st = os.stat(os.path.join(medium, 'archives', 'foo_1.0_all.deb'))
+    os.makedirs(os.path.join(medium, 'var', 'lib', 'apt-medium'))
+    save_pickle(os.path.join(medium, 'var', 'lib', 'apt-medium', 'archives-manifest'),
+                {'foo_1.0_all.deb': (st.st_size, st.st_mtime, 'SHA256:' + 'AB' * 32)})
+    with medium_server(medium) as url:
+        listing = fetch_listing(url, 'archives')
+    assert listing['foo_1.0_all.deb'][2] == 'ab' * 32
+    assert listing['bar_1.0_all.deb'][2] == ''
+
+# Test that a failed download leaves the host's old copy of a list in place
+def test_mirror_failure(tmpdir):
+    server_medium = make_medium(str(tmpdir.mkdir('server')), {'lists/x_Packages': b'new list'})
+    client_medium = make_medium(str(tmpdir.mkdir('client')), {'lists/x_Packages': b'old list'})
+    lists_dir = os.path.join(client_medium, 'lists')
+    served = medium_server(server_medium)
+    # A listed checksum the download won't match
+    path = os.path.join(server_medium, 'lists', 'x_Packages')
+    st = os.stat(path)
+    served.server.digests[path] = (st.st_size, st.st_mtime, '0' * 64)
+    with served as url:
+        assert list(mirror_lists(url, lists_dir)) == ['x_Packages']
+    with open(os.path.join(lists_dir, 'x_Packages'), 'rb') as f:
+        assert f.read() == b'old list'
+
+# Test that install plans are served as JSON, and only for targets that have one
+def test_serve_plan(tmpdir):
+    medium = str(tmpdir)
+    plan = ApplyPlan(['foo'], 'ab' * 32, [('unpack', 'foo', 'all', '1.0', 'foo_1.0_all.deb'), ('configure', 'foo', 'all', '1.0', None)],
+                     ['The following NEW packages will be installed:', '  foo'])
+    save_plan(os.path.join(medium, 'var', 'lib', 'apt-medium', 'plans'), 'host', plan)
+    with medium_server(medium) as url:
+        assert fetch_plan(url, 'host') == plan
+        assert fetch_plan(url, 'other') is None
+        response, body = request(url, '/plans/host')
+        assert response.getheader('Content-Type') == 'application/json'
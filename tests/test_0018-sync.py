@@ -0,0 +1,98 @@
+from .shared_test_code import run, init_cwd
+from apt_medium.state import add_target, connect, queue_add, queue_pins, pins_add, read_state, transaction
+from apt_medium.sync import compare_manifests, make_batches
+import os
+import pytest
+import shutil
+import tempfile
+
+def write(root, relpath, data, mtime):
+    path = os.path.join(root, relpath)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(data)
+    os.utime(path, (mtime, mtime))
+
+def read(root, relpath):
+    with open(os.path.join(root, relpath), 'rb') as f:
+        return f.read()
+
+def pin(name, version):
+    filename = name + '_' + version + '_all.deb'
+    return (name, version, 'all', 'http://example.invalid/' + filename, filename, 100, 'SHA256:00')
+
+# Test that files are grouped into batches of about the requested size, in order
+def test_make_batches():
+    manifest = {'a': (60, 0, ''), 'b': (60, 0, ''), 'c': (200, 0, ''), 'd': (10, 0, '')}
+    assert make_batches(['a', 'b', 'c', 'd'], manifest, 128) == [['a', 'b'], ['c'], ['d']]
+    assert make_batches([], manifest, 128) == []
+
+# Test which way differing copies go, and that copies modified at the same time are reported rather than picked
+def test_compare_manifests():
+    a = {'only_a': (1, 10, 'aa'), 'same': (1, 10, 'ss'), 'newer_a': (1, 20, 'n1'), 'newer_b': (1, 10, 'm1'), 'conflict': (1, 10, 'c1')}
+    b = {'only_b': (1, 10, 'bb'), 'same': (1, 30, 'ss'), 'newer_a': (1, 10, 'n2'), 'newer_b': (1, 20, 'm2'), 'conflict': (1, 10, 'c2')}
+    assert compare_manifests(a, b) == (['newer_a', 'only_a'], ['newer_b', 'only_b'], ['conflict'])
+
+# Test that a sync leaves both copies of a conflicting file alone and says so
+def test_sync_conflict(capsys):
+    with init_cwd() as (retCode, medium):
+        other = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(other, 'archives'))
+            write(medium, 'lists/x_Packages', b'one list', 1000000000)
+            write(other, 'lists/x_Packages', b'another list', 1000000000)
+            assert run(['sync', other]) != 0
+            assert 'Not copying lists/x_Packages' in capsys.readouterr().out
+            assert read(medium, 'lists/x_Packages') == b'one list'
+            assert read(other, 'lists/x_Packages') == b'another list'
+        finally:
+            shutil.rmtree(other)
+
+# Test that two media exchange what the other lacks, the newer copy of changed files wins and no queued package is lost
+def test_sync(hostname, capsys):
+    with init_cwd() as (retCode, medium):
+        other = tempfile.mkdtemp()
+        try:
+            write(medium, 'archives/here_1.0_all.deb', b'here', 1000000000)
+            write(other, 'archives/there_1.0_all.deb', b'there', 1000000000)
+            write(medium, 'lists/x_Packages.gz', b'old list', 1000000000)
+            write(other, 'lists/x_Packages.gz', b'new list', 1000000100)
+            write(other, 'archives/partial/incomplete_1.0_all.deb', b'inc', 1000000000)
+            write(other, 'system_info/remote/dpkg-status', b'Package: remote\n', 1000000000)
+
+            with transaction('medium_state') as conn:
+                queue_add(conn, 'download_queue', hostname, ['both', 'onlyhere'])
+                pins_add(conn, 'download_queue', hostname, [pin('both', '1.0')])
+            with transaction(os.path.join(other, 'medium_state')) as conn:
+                add_target(conn, hostname)
+                add_target(conn, 'remote')
+                queue_add(conn, 'install_queue', hostname, ['both'])
+                pins_add(conn, 'install_queue', hostname, [pin('both', '1.0')])
+                queue_add(conn, 'download_queue', 'remote', ['onlythere'])
+
+            assert run(['sync', other]) == 0
+            for root in (medium, other):
+                assert read(root, 'archives/here_1.0_all.deb') == b'here'
+                assert read(root, 'archives/there_1.0_all.deb') == b'there'
+                assert read(root, 'lists/x_Packages.gz') == b'new list'
+                assert os.path.getmtime(os.path.join(root, 'lists/x_Packages.gz')) == 1000000100
+                assert read(root, 'system_info/remote/dpkg-status') == b'Package: remote\n'
+                state = read_state(os.path.join(root, 'medium_state'))
+                # "both" was downloaded on the other medium, so it only needs installing now
+                assert state['install_queue'][hostname] == ['both']
+                assert state['download_queue'][hostname] == ['onlyhere']
+                assert state['download_queue']['remote'] == ['onlythere']
+            assert not os.path.exists(os.path.join(medium, 'archives', 'partial', 'incomplete_1.0_all.deb'))
+            conn = connect(os.path.join(medium, 'medium_state'))
+            try:
+                assert [ p[0] for p in queue_pins(conn, 'install_queue', hostname) ] == ['both']
+            finally:
+                conn.close()
+
+            # Nothing left to copy the second time round
+            capsys.readouterr()
+            assert run(['sync', other]) == 0
+            assert capsys.readouterr().out.count('Copying 0 files (0 bytes)') == 2
+        finally:
+            shutil.rmtree(other)
@@ -0,0 +1,89 @@
+from .shared_test_code import run, init_cwd
+from apt_medium.bundle import QUEUES_MEMBER, BundleError, member_path, read_bundle, write_bundle
+from apt_medium.state import connect, queue_add, queue_pins, pins_add, read_state, transaction
+from apt_medium.utils import load_pickle
+import hashlib
+import io
+import os
+import pytest
+import shutil
+import tarfile
+import tempfile
+
+def add_archive(name, data):
+    filename = name + '_1.0_all.deb'
+    with open(os.path.join('archives', filename), 'wb') as f:
+        f.write(data)
+    return (name, '1.0', 'all', 'http://example.invalid/' + filename, filename, len(data), 'SHA256:' + hashlib.sha256(data).hexdigest())
+
+# Test that bundles can only write inside the parts of a medium they carry
+def test_member_path():
+    assert member_path('archives/foo_1.0_all.deb') == os.path.join('archives', 'foo_1.0_all.deb')
+    assert member_path('./system_info/host/dpkg-status') == os.path.join('system_info', 'host', 'dpkg-status')
+    assert member_path('var/lib/apt-medium/plans/host') == os.path.join('var', 'lib', 'apt-medium', 'plans', 'host')
+    for name in ('archives/../medium_state', '/etc/passwd', 'medium_state', 'var/lib/apt-medium/resolve-cache', 'archives'):
+        assert member_path(name) is None
+
+# Test that a target's share of a medium can be carried to another medium and unpacked there
+def test_export_import(hostname, capsys):
+    with init_cwd() as (retCode, medium):
+        other = tempfile.mkdtemp()
+        try:
+            pinned = add_archive('bundletest', b'pinned package')
+            add_archive('bundletest-other', b'for another target')
+            with transaction('medium_state') as conn:
+                queue_add(conn, 'install_queue', hostname, ['bundletest'])
+                pins_add(conn, 'install_queue', hostname, [pinned])
+            bundle = os.path.join(other, 'bundle.tar.gz')
+
+            assert run(['export', '-o', bundle]) == 0
+            with tarfile.open(bundle, 'r:gz') as tar:
+                names = tar.getnames()
+            assert names[0] == QUEUES_MEMBER
+            assert 'archives/bundletest_1.0_all.deb' in names
+            assert 'archives/bundletest-other_1.0_all.deb' not in names
+            assert 'system_info/' + hostname + '/dpkg-status' in names
+
+            target_medium = os.path.join(other, 'medium')
+            os.mkdir(target_medium)
+            assert run(['-m', target_medium, 'import', bundle]) == 0
+            with open(os.path.join(target_medium, 'archives', 'bundletest_1.0_all.deb'), 'rb') as f:
+                assert f.read() == b'pinned package'
+            assert os.path.isfile(os.path.join(target_medium, 'system_info', hostname, 'dpkg-status'))
+            assert read_state(os.path.join(target_medium, 'medium_state'))['install_queue'][hostname] == ['bundletest']
+            conn = connect(os.path.join(target_medium, 'medium_state'))
+            try:
+                assert queue_pins(conn, 'install_queue', hostname) == [pinned]
+            finally:
+                conn.close()
+            manifest = load_pickle(os.path.join(target_medium, 'var', 'lib', 'apt-medium', 'archives-manifest'))
+            assert manifest['bundletest_1.0_all.deb'][2] == pinned[6]
+        finally:
+            shutil.rmtree(other)
+
+# Test that damaged archives and members outside the medium are refused
+def test_import_checks(tmpdir):
+    source = str(tmpdir.mkdir('source'))
+    os.mkdir(os.path.join(source, 'archives'))
+    with open(os.path.join(source, 'archives', 'bad_1.0_all.deb'), 'wb') as f:
+        f.write(b'damaged')
+    queues = {'host': {'install_queue': (['bad'], [('bad', '1.0', 'all', 'http://x/bad_1.0_all.deb', 'bad_1.0_all.deb', 7, 'SHA256:' + '0' * 64)]),
+                       'download_queue': ([], [])}}
+    out = io.BytesIO()
+    write_bundle(out, source, [os.path.join('archives', 'bad_1.0_all.deb')], queues)
+    medium = str(tmpdir.mkdir('medium'))
+    out.seek(0)
+    assert read_bundle(out, medium)[2] == ['bad_1.0_all.deb']
+    assert not os.path.exists(os.path.join(medium, 'archives', 'bad_1.0_all.deb'))
+
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode='w') as tar:
+        for name in (QUEUES_MEMBER, '../escape'):
+            info = tarfile.TarInfo(name)
+            data = b'{}'
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    out.seek(0)
+    with pytest.raises(BundleError):
+        read_bundle(out, medium)
+    assert not os.path.exists(os.path.join(str(tmpdir), 'escape'))